@@ -0,0 +1,157 @@
+"""
+Decoder for Apache AGE agtype values
+agtype text is JSON, except that vertices, edges and paths carry a
+`::vertex`, `::edge` or `::path` suffix and exact numbers a `::numeric`
+one. Plain values go straight to the C JSON decoder. A vertex or edge
+only has its suffix cut off (its properties cannot hold annotated
+values), a path is decoded element by element, and any other text with
+`::` is scanned for annotations, skipping string literals so property
+values are never altered. Vertices and edges decode to their JSON maps
+(id, label, properties, plus start_id / end_id for edges) and paths to
+the list of their elements.
+
+register_agtype() installs decode() as the psycopg2 caster of agtype on a
+connection, so rows arrive as Python values; decode_many() and
+column_arrays() convert whole columns at once.
+"""
+import json
+import re
+import weakref
+from decimal import Decimal
+import numpy as np
+import psycopg2.extensions
+
+_decoder = json.JSONDecoder()
+_loads = _decoder.decode
+_raw_decode = _decoder.raw_decode
+
+# Suffix -> length to cut, for values that only carry a top-level annotation
+_SUFFIXES = {'::vertex': 8, '::edge': 6}
+
+# A JSON string literal (kept as is) or a type annotation (dropped)
+_ANNOTATION = re.compile(r'"(?:[^"\\]|\\.)*"|::(?:vertex|edge|path|numeric)\b')
+
+AGTYPE_OIDS_SQL = """
+    SELECT t.oid, t.typarray FROM pg_type t
+    JOIN pg_namespace n ON n.oid = t.typnamespace
+    WHERE t.typname = 'agtype' AND n.nspname = 'ag_catalog'
+"""
+
+# Connections with the caster installed
+_registered = weakref.WeakSet()
+
+
+def _strip(match):
+    text = match.group(0)
+    return text if text[0] == '"' else ''
+
+
+def _decode_path(value):
+    """Elements of `[v::vertex, e::edge, ...]::path`"""
+    elements, position, end = [], 1, len(value) - 7
+    while position < end:
+        element, position = _raw_decode(value, position)
+        elements.append(element)
+        position = value.index('::', position)
+        position = value.find(',', position)
+        if position < 0:
+            break
+        position += 1
+        while value[position] == ' ':
+            position += 1
+    return elements
+
+
+def decode(value):
+    """Python value of one agtype text (None for SQL NULL)"""
+    if value is None:
+        return None
+    if '::' not in value:
+        return _loads(value)
+    if value[-1] == 'x' and value.endswith('::vertex'):
+        return _loads(value[:-8])
+    if value.endswith('::edge'):
+        return _loads(value[:-6])
+    if value.endswith('::path'):
+        return _decode_path(value)
+    if value.endswith('::numeric') and value[0] not in '[{':
+        return Decimal(value[:-9])
+    return _loads(_ANNOTATION.sub(_strip, value))
+
+
+def decode_many(values):
+    """
+    Decode a column of agtype texts. Columns of plain values, vertices or
+    edges are parsed as a single JSON array, one decoder call instead of
+    one per row.
+    """
+    present = [value for value in values if value is not None]
+    cut = 0
+    if any('::' in value for value in present):
+        suffix = present[0][present[0].rfind('::'):]
+        cut = _SUFFIXES.get(suffix)
+        if not cut or not all(value.endswith(suffix) for value in present):
+            return [decode(value) for value in values]
+    if cut:
+        texts = ('null' if value is None else value[:-cut] for value in values)
+    else:
+        texts = ('null' if value is None else value for value in values)
+    return _loads('[' + ','.join(texts) + ']')
+
+
+def to_numpy(values, dtype=None):
+    """
+    NumPy array of decoded values. Without a dtype, integer columns become
+    int64, numeric ones float64 (None as NaN) and anything else object.
+    """
+    if dtype is None:
+        present = [value for value in values if value is not None]
+        if present and all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+            dtype = np.int64 if len(present) == len(values) else np.float64
+        elif present and all(isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+                             for value in present):
+            dtype = np.float64
+        else:
+            dtype = object
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.fromiter((np.nan if value is None else value for value in values), dtype, count=len(values))
+    if dtype.kind in 'iub':
+        return np.fromiter(values, dtype, count=len(values))
+    array = np.empty(len(values), dtype=dtype)
+    array[:] = values
+    return array
+
+
+def column_arrays(rows, names, dtypes=None):
+    """{column name: NumPy array} for fetched rows (already decoded by the caster)"""
+    dtypes = dtypes or {}
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: to_numpy(list(column), dtypes.get(name)) for name, column in zip(names, columns)}
+
+
+def _cast(value, cursor):
+    return decode(value)
+
+
+def register_agtype(conn):
+    """
+    Decode agtype (and agtype[]) columns of this connection while rows are
+    fetched. Returns False when AGE is not installed in the database yet.
+    """
+    if conn in _registered:
+        return True
+    cursor = conn.cursor()
+    cursor.execute(AGTYPE_OIDS_SQL)
+    row = cursor.fetchone()
+    cursor.close()
+    if row is None:
+        return False
+    oid, array_oid = row
+    agtype = psycopg2.extensions.new_type((oid,), 'AGTYPE', _cast)
+    psycopg2.extensions.register_type(agtype, conn)
+    if array_oid:
+        psycopg2.extensions.register_type(
+            psycopg2.extensions.new_array_type((array_oid,), 'AGTYPE[]', agtype), conn)
+    _registered.add(conn)
+    return True
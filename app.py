@@ -7,8 +7,11 @@ from routes_auth import auth_bp
 from routes_menu import menu_bp
 from routes_orders import orders_bp
 from routes_web import web_bp
+from routes_graph import graph_bp
+from routes_fraud import fraud_bp
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
+from agtype import register_agtype
 import logging
 
 # Configure logging
@@ -36,10 +39,22 @@ def create_app():
     def receive_close(dbapi_conn, connection_record):
         logger.warning("Database connection closed")
     
+    if Config.GRAPH_SYNC_MODE == 'transactional':
+        # Orders write their graph elements on the ORM connection (graph_sync.py)
+        @event.listens_for(Engine, "connect")
+        def load_age(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            cursor.execute("LOAD 'age';")
+            cursor.close()
+            register_agtype(dbapi_conn)
+            dbapi_conn.commit()
+    
     # Register blueprints
     app.register_blueprint(auth_bp)  # API routes
     app.register_blueprint(menu_bp)  # API routes
     app.register_blueprint(orders_bp)  # API routes
+    app.register_blueprint(graph_bp)  # API routes
+    app.register_blueprint(fraud_bp)  # API routes
     app.register_blueprint(web_bp)  # Web UI routes
     
     # API health check endpoint
@@ -51,7 +66,9 @@ def create_app():
             'endpoints': {
                 'auth': '/api/auth',
                 'menu': '/api/menu',
-                'orders': '/api/orders'
+                'orders': '/api/orders',
+                'graph': '/api/graph',
+                'fraud': '/api/fraud'
             }
         })
     
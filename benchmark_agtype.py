@@ -0,0 +1,95 @@
+"""
+Benchmark of agtype decoding, without a database
+Builds columns of agtype texts shaped like the graph_utils results
+(scalars, maps, vertices, edges, paths) and times per-row json.loads
+with an annotation fallback (how results used to be parsed) against
+agtype.decode, agtype.decode_many and NumPy conversion.
+
+Usage:
+    python benchmark_agtype.py
+    python benchmark_agtype.py --rows 200000 --repeat 5
+"""
+import argparse
+import json
+import re
+import time
+import numpy as np
+from agtype import decode, decode_many, to_numpy
+
+_ANNOTATION = re.compile(r'::(?:vertex|edge|path|numeric)\b')
+
+
+def naive(value):
+    """Row-by-row parsing as done before agtype.py"""
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return json.loads(_ANNOTATION.sub('', value))
+
+
+def vertex(i):
+    return (f'{{"id": {844424930131969 + i}, "label": "User", '
+            f'"properties": {{"username": "user{i}", "city": "Paris"}}}}::vertex')
+
+
+def edge(i):
+    return (f'{{"id": {1125899906842625 + i}, "label": "USED_IP", "end_id": {1407374883553281 + i % 97}, '
+            f'"start_id": {844424930131969 + i}, "properties": {{"last_seen": {1700000000 + i}}}}}::edge')
+
+
+COLUMNS = {
+    'username': lambda i: f'"user{i}"',
+    'user_count': lambda i: str(2 + i % 50),
+    'last_seen': lambda i: str(1700000000 + i),
+    'users': lambda i: json.dumps([f'user{i}', f'user{i + 1}', f'user{i + 2}']),
+    'vertex': vertex,
+    'edge': edge,
+    'path': lambda i: f'[{vertex(i)}, {edge(i)}, {vertex(i + 1)}]::path',
+}
+
+
+def timed(function, repeat):
+    """Best wall time of repeat runs, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark agtype decoding')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("=" * 78)
+    print(f"agtype decoding, {args.rows} rows per column, best of {args.repeat}")
+    print("=" * 78)
+    print(f"{'column':<12} {'naive ms':>10} {'decode ms':>10} {'many ms':>10} {'speedup':>9}")
+
+    for name, make in COLUMNS.items():
+        values = [make(i) for i in range(args.rows)]
+        expected = [naive(value) for value in values]
+        assert [decode(value) for value in values] == expected
+        assert decode_many(values) == expected
+
+        naive_ms = timed(lambda: [naive(value) for value in values], args.repeat)
+        decode_ms = timed(lambda: [decode(value) for value in values], args.repeat)
+        many_ms = timed(lambda: decode_many(values), args.repeat)
+        print(f"{name:<12} {naive_ms:>10.1f} {decode_ms:>10.1f} {many_ms:>10.1f} "
+              f"{naive_ms / min(decode_ms, many_ms):>8.1f}x")
+
+    values = [COLUMNS['last_seen'](i) for i in range(args.rows)]
+    naive_ms = timed(lambda: np.array([naive(value) for value in values], dtype=np.int64), args.repeat)
+    numpy_ms = timed(lambda: to_numpy(decode_many(values), np.int64), args.repeat)
+    print()
+    print(f"int64 array  naive {naive_ms:.1f} ms, decode_many + to_numpy {numpy_ms:.1f} ms "
+          f"({naive_ms / numpy_ms:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmark of the in-memory CSR graph backend (graph_csr.py)
+Loads synthetic users and order locations, or the real tables with
+--database (plain PostgreSQL, AGE not needed), then times the snapshot
+build, an incremental refresh and each fraud query. Results are checked
+against straightforward dict / set implementations of the same queries.
+
+Usage:
+    python benchmark_csr.py
+    python benchmark_csr.py --users 100000 --orders 1000000
+    python benchmark_csr.py --database
+"""
+import argparse
+import random
+import time
+from itertools import permutations
+from graph_csr import CSRGraph
+
+RANDOM_SEED = 42
+T0 = 1700000000
+CITIES = [f'City{i}' for i in range(500)] + ['Unknown']
+
+
+def synthetic_rows(users, ips, orders, batch_size=10000):
+    """User and order-location batches; a few IPs get a heavy share of the orders"""
+    rng = random.Random(RANDOM_SEED)
+    user_rows = [(i + 1, f'user{i}', f'user{i}@example.com', rng.choice(CITIES[:-1])) for i in range(users)]
+    hot = max(1, ips // 10000)
+    locations = []
+    for i in range(orders):
+        ip = rng.randrange(hot) if rng.random() < 0.05 else rng.randrange(ips)
+        locations.append((i + 1, rng.randrange(users) + 1, f'10.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}',
+                          rng.choice(CITIES), T0 + rng.randrange(90 * 86400)))
+    def batches(rows):
+        return [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    return batches(user_rows), batches(locations)
+
+
+def reference_queries(user_batches, location_batches, threshold, since):
+    """Same answers from dicts and sets, as a correctness check"""
+    users = {uid: (name, city) for rows in user_batches for uid, name, _, city in rows}
+    seen, ip_cities = {}, {}
+    for rows in location_batches:
+        for _, uid, ip, city, ts in rows:
+            if uid in users:
+                key = (users[uid][0], ip)
+                seen[key] = max(seen.get(key, 0), ts)
+                ip_cities.setdefault(ip, set()).add(city)
+    ip_users = {}
+    for (name, ip), ts in seen.items():
+        if ts >= since:
+            ip_users.setdefault(ip, set()).add(name)
+    all_users = {}
+    for name, ip in seen:
+        all_users.setdefault(ip, set()).add(name)
+    allowed = {ip for ip, names in all_users.items() if len(names) < threshold}
+    city_of = {name: city for name, city in users.values()}
+    city_degree = {}
+    for cities in ip_cities.values():
+        for city in cities:
+            city_degree[city] = city_degree.get(city, 0) + 1
+    for city in city_of.values():
+        city_degree[city] = city_degree.get(city, 0) + 1
+    big_cities = {city for city, degree in city_degree.items() if degree >= threshold} | {'Unknown'}
+    return {
+        'shared_ips': {(u1, u2, ip) for ip, names in ip_users.items() if ip in allowed
+                       for u1, u2 in permutations(names, 2)},
+        'city_mismatches': {(name, city_of[name], city, ip) for (name, ip), ts in seen.items()
+                            if ts >= since and ip in allowed
+                            for city in ip_cities[ip] if city != city_of[name] and city not in big_cities},
+        'count_shared_ips': sum(1 for ip, names in all_users.items() if len(names) >= 2 and ip in allowed),
+    }
+
+
+def timed(function, repeat):
+    """Result and best wall time of repeat runs, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return result, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the in-memory CSR graph backend')
+    parser.add_argument('--database', action='store_true', help='load users / user_locations instead of synthetic rows')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--ips', type=int, default=30000)
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--threshold', type=int, default=1000, help='supernode degree')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("CSR graph backend, " + ("database tables" if args.database else
+                                   f"{args.users} users, {args.ips} IPs, {args.orders} orders (synthetic)"))
+    print("=" * 70)
+
+    graph = CSRGraph(threshold=args.threshold, allowlist='City:Unknown')
+    if args.database:
+        started = time.perf_counter()
+        loaded = graph.refresh()
+        print(f"  {'full load':<28} {(time.perf_counter() - started) * 1000:>10.1f} ms  {loaded}")
+        _, refresh_ms = timed(graph.refresh, args.repeat)
+        print(f"  {'incremental refresh (no-op)':<28} {refresh_ms:>10.1f} ms")
+        since = None
+    else:
+        user_batches, location_batches = synthetic_rows(args.users, args.ips, args.orders)
+        split = max(1, len(location_batches) * 9 // 10)
+        started = time.perf_counter()
+        graph.add_rows(user_batches, location_batches[:split])
+        print(f"  {'build (90% of orders)':<28} {(time.perf_counter() - started) * 1000:>10.1f} ms")
+        started = time.perf_counter()
+        graph.add_rows([], location_batches[split:])
+        print(f"  {'incremental add (10%)':<28} {(time.perf_counter() - started) * 1000:>10.1f} ms")
+        since = T0 + 60 * 86400
+
+    snapshot = graph.snapshot
+    print(f"  {snapshot.stats()}")
+    print()
+
+    usernames = snapshot.users.keys[:1000]
+    queries = {
+        'shared_ips (pairs)': lambda: snapshot.shared_ips(since),
+        'shared_ip_groups': lambda: snapshot.shared_ip_groups(50, 'users', 10, since=since),
+        'city_mismatches': lambda: snapshot.city_mismatches(since),
+        'count_shared_ips': lambda: snapshot.count_shared_ips(),
+        'user_graph x1000': lambda: [snapshot.user_graph(name) for name in usernames],
+        'supernodes': lambda: snapshot.supernodes(20),
+    }
+    results = {}
+    for name, query in queries.items():
+        result, ms = timed(query, args.repeat)
+        results[name] = result
+        size = f"{len(result)} rows" if isinstance(result, list) else result
+        print(f"  {name:<28} {ms:>10.1f} ms  ({size})")
+
+    if not args.database:
+        expected = reference_queries(user_batches, location_batches, args.threshold, since)
+        assert set(results['shared_ips (pairs)']) == expected['shared_ips']
+        assert set(results['city_mismatches']) == expected['city_mismatches']
+        assert results['count_shared_ips'] == expected['count_shared_ips']
+        print("\n  results match the dict / set reference")
+
+    print("✓ Done")
+
+
+if __name__ == '__main__':
+    main()
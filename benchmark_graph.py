@@ -0,0 +1,116 @@
+"""
+Graph write benchmark - per-order latency of graph writes on Apache AGE
+Compares the legacy nine-statement add_order_to_graph against the single
+parameterized Cypher round trip, with and without the known-element cache.
+Runs in a scratch graph that is dropped afterwards.
+"""
+import argparse
+import statistics
+import time
+from config import Config
+from graph_pool import init_age_session
+from graph_utils import get_db_connection, known_elements, write_order_event
+
+BENCH_GRAPH = 'restaurant_graph_bench'
+CITIES = ['Paris', 'London', 'Bordeaux', 'Lyon']
+
+
+def legacy_write_order(cursor, event, graph_name):
+    """Nine separate f-string Cypher statements, as add_order_to_graph used to do"""
+    statements = [
+        f"MERGE (u:User {{username: '{event['username']}', city: '{event['user_city']}'}}) RETURN u",
+        f"MERGE (e:Email {{address: '{event['email']}'}}) RETURN e",
+        f"MERGE (ip:IPAddress {{address: '{event['ip_address']}'}}) RETURN ip",
+        f"MERGE (c:City {{name: '{event['city_detected']}'}}) RETURN c",
+        f"MERGE (c:City {{name: '{event['user_city']}'}}) RETURN c",
+        f"MATCH (u:User {{username: '{event['username']}'}}), (e:Email {{address: '{event['email']}'}}) "
+        f"MERGE (u)-[r:HAS_EMAIL]->(e) RETURN r",
+        f"MATCH (u:User {{username: '{event['username']}'}}), (ip:IPAddress {{address: '{event['ip_address']}'}}) "
+        f"MERGE (u)-[r:USED_IP {{order_id: {event['order_ids'][0]}}}]->(ip) RETURN r",
+        f"MATCH (ip:IPAddress {{address: '{event['ip_address']}'}}), (c:City {{name: '{event['city_detected']}'}}) "
+        f"MERGE (ip)-[r:FROM_CITY]->(c) RETURN r",
+        f"MATCH (u:User {{username: '{event['username']}'}}), (c:City {{name: '{event['user_city']}'}}) "
+        f"MERGE (u)-[r:REGISTERED_IN]->(c) RETURN r",
+    ]
+    for statement in statements:
+        cursor.execute(f"SELECT * FROM cypher('{graph_name}', $$ {statement} $$) AS (r agtype);")
+
+
+def make_events(count, users, offset):
+    """Synthetic order events spread over a fixed set of users and IPs"""
+    events = []
+    started = int(time.time())
+    for i in range(count):
+        user_no = i % users
+        events.append({
+            'username': f'bench_user_{user_no}',
+            'email': f'bench_user_{user_no}@example.com',
+            'user_city': CITIES[user_no % len(CITIES)],
+            'ip_address': f'10.255.{(i // 7) % 256}.{i % 251}',
+            'city_detected': CITIES[i % len(CITIES)],
+            'order_ids': [offset + i],
+            'order_times': [started + i],
+            'first_seen': started + i,
+            'last_seen': started + i,
+        })
+    return events
+
+
+def run(cursor, label, write, events):
+    """Time each order write and print latency percentiles"""
+    timings = []
+    for event in events:
+        start = time.perf_counter()
+        write(cursor, event, BENCH_GRAPH)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) >= 20 else timings[-1]
+    print(f"{label:<28} {statistics.mean(timings):>9.2f} {statistics.median(timings):>9.2f} {p95:>9.2f}")
+    return statistics.mean(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark graph write latency per order')
+    parser.add_argument('--orders', type=int, default=200, help='orders written per variant')
+    parser.add_argument('--users', type=int, default=50, help='distinct users in the workload')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    init_age_session(conn)
+    cursor = conn.cursor()
+    cursor.execute("SELECT create_graph(%s);", (BENCH_GRAPH,))
+
+    try:
+        print("=" * 60)
+        print(f"Graph write latency per order ({args.orders} orders, {args.users} users)")
+        print("=" * 60)
+        print(f"{'Variant':<28} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        print("-" * 60)
+
+        before = run(cursor, 'legacy (9 statements)', legacy_write_order,
+                     make_events(args.orders, args.users, 0))
+
+        Config.GRAPH_CACHE_ENABLED = False
+        after = run(cursor, 'single parameterized', write_order_event,
+                    make_events(args.orders, args.users, args.orders))
+
+        # Same (user, IP) tuples again, now served from the known-element cache
+        Config.GRAPH_CACHE_ENABLED = True
+        known_elements.invalidate()
+        for event in make_events(args.orders, args.users, 2 * args.orders):
+            write_order_event(cursor, event, BENCH_GRAPH)
+        cached = run(cursor, 'known-element cache', write_order_event,
+                     make_events(args.orders, args.users, 3 * args.orders))
+
+        print("-" * 60)
+        print(f"Speedup: {before / after:.1f}x single statement, {before / cached:.1f}x with cache "
+              f"(hit rate {known_elements.stats()['hit_rate']:.0%})")
+    finally:
+        cursor.execute("SELECT drop_graph(%s, true);", (BENCH_GRAPH,))
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
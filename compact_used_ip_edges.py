@@ -0,0 +1,179 @@
+"""
+Compact parallel USED_IP edges into one aggregated edge per (user, IP)
+Each batch of users is rewritten in one transaction: the per-order edges of
+a pair are deleted and replaced by a single edge carrying order_count,
+first_seen, last_seen and recent_orders, the shape written when
+GRAPH_AGGREGATE_USED_IP is enabled. Timestamps come from orders.created_at.
+Pairs that already have a single aggregated edge are left untouched, so
+the script can be re-run to fold in edges written since the last run.
+
+Usage:
+    python compact_used_ip_edges.py
+    python compact_used_ip_edges.py --batch-size 200 --dry-run
+
+With GRAPH_SHARDING, the default compacts every region shard instead.
+"""
+import argparse
+import time
+from config import Config
+from graph_pool import graph_connection
+from graph_utils import GRAPH_NAME, read_graphs
+
+STATS_SQL = """
+    SELECT COUNT(*), COUNT(DISTINCT (start_id, end_id)) FROM {graph}."USED_IP"
+"""
+
+COMPACT_BATCH_SQL = """
+    WITH users AS (
+        SELECT DISTINCT start_id FROM {graph}."USED_IP"
+        WHERE start_id > %(after_id)s::text::graphid
+        ORDER BY start_id
+        LIMIT %(batch_size)s
+    ), targets AS (
+        SELECT r.start_id, r.end_id
+        FROM {graph}."USED_IP" r
+        JOIN users ON users.start_id = r.start_id
+        GROUP BY r.start_id, r.end_id
+        HAVING COUNT(*) > 1 OR bool_or(NOT r.properties::text::jsonb ? 'order_count')
+    ), removed AS (
+        DELETE FROM {graph}."USED_IP" r
+        USING targets t
+        WHERE r.start_id = t.start_id AND r.end_id = t.end_id
+        RETURNING r.start_id, r.end_id, r.properties::text::jsonb AS props
+    ), edge_orders AS (
+        SELECT start_id, end_id, (props->>'order_id')::bigint AS order_id
+        FROM removed WHERE props ? 'order_id'
+        UNION
+        SELECT start_id, end_id, jsonb_array_elements_text(props->'recent_orders')::bigint
+        FROM removed WHERE props ? 'recent_orders'
+    ), order_times AS (
+        SELECT e.start_id, e.end_id,
+               MIN(EXTRACT(EPOCH FROM o.created_at))::bigint AS first_seen,
+               MAX(EXTRACT(EPOCH FROM o.created_at))::bigint AS last_seen,
+               (array_agg(e.order_id ORDER BY e.order_id DESC))[1:%(recent_limit)s] AS recent
+        FROM edge_orders e
+        LEFT JOIN orders o ON o.id = e.order_id
+        GROUP BY e.start_id, e.end_id
+    ), pairs AS (
+        SELECT start_id, end_id,
+               SUM(coalesce((props->>'order_count')::bigint, 1)) AS order_count,
+               MIN((props->>'first_seen')::bigint) AS first_seen,
+               MAX((props->>'last_seen')::bigint) AS last_seen
+        FROM removed
+        GROUP BY start_id, end_id
+    ), inserted AS (
+        INSERT INTO {graph}."USED_IP" (start_id, end_id, properties)
+        SELECT p.start_id, p.end_id, jsonb_build_object(
+            'order_count', p.order_count,
+            'first_seen', least(p.first_seen, t.first_seen),
+            'last_seen', greatest(p.last_seen, t.last_seen),
+            'recent_orders', coalesce((SELECT jsonb_agg(x ORDER BY x) FROM unnest(t.recent) AS x), '[]')
+        )::text::agtype
+        FROM pairs p
+        LEFT JOIN order_times t ON t.start_id = p.start_id AND t.end_id = p.end_id
+        RETURNING 1
+    )
+    SELECT (SELECT start_id FROM users ORDER BY start_id DESC LIMIT 1)::text::bigint,
+           (SELECT COUNT(*) FROM removed),
+           (SELECT COUNT(*) FROM inserted)
+"""
+
+
+def edge_stats(cursor, graph_name):
+    """(USED_IP edges, distinct user-IP pairs)"""
+    cursor.execute(STATS_SQL.format(graph=graph_name))
+    return cursor.fetchone()
+
+
+def compact(graph_name, batch_size, dry_run=False):
+    """
+    Rewrite the USED_IP edges of graph_name batch by batch.
+    Returns (edges removed, edges inserted).
+    """
+    removed_total = inserted_total = 0
+    after_id = 0
+    started = time.monotonic()
+
+    with graph_connection() as conn:
+        conn.autocommit = False
+        cursor = conn.cursor()
+        try:
+            while True:
+                cursor.execute(COMPACT_BATCH_SQL.format(graph=graph_name), {
+                    'after_id': after_id,
+                    'batch_size': batch_size,
+                    'recent_limit': Config.GRAPH_RECENT_ORDERS_LIMIT,
+                })
+                last_id, removed, inserted = cursor.fetchone()
+                if last_id is None:
+                    conn.rollback()
+                    break
+                if dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+
+                after_id = last_id
+                removed_total += removed
+                inserted_total += inserted
+                print(f"  users up to #{last_id}: {removed} edges -> {inserted}  "
+                      f"({time.monotonic() - started:.1f}s)")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return removed_total, inserted_total
+
+
+def create_unique_index(graph_name):
+    """One edge per (user, IP) from now on; also serves the fast-path lookup"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS used_ip_start_end_uniq '
+            f'ON {graph_name}."USED_IP" USING BTREE (start_id, end_id)'
+        )
+        cursor.execute(f'ANALYZE {graph_name}."USED_IP"')
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact parallel USED_IP edges into aggregated edges')
+    parser.add_argument('--graph', default=GRAPH_NAME)
+    parser.add_argument('--batch-size', type=int, default=500, help='users rewritten per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change, then roll back')
+    args = parser.parse_args()
+    graphs = read_graphs() if args.graph == GRAPH_NAME else [args.graph]
+
+    for graph_name in graphs:
+        print("=" * 70)
+        print(f"Compacting USED_IP edges of '{graph_name}'" + (" (dry run)" if args.dry_run else ""))
+        print("=" * 70)
+
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            edges, pairs = edge_stats(cursor, graph_name)
+            cursor.close()
+        print(f"{edges} USED_IP edges over {pairs} user-IP pairs")
+
+        removed, inserted = compact(graph_name, args.batch_size, args.dry_run)
+        print()
+        print(f"✓ Replaced {removed} edges with {inserted} aggregated edges")
+
+        if not args.dry_run and Config.GRAPH_AGGREGATE_USED_IP:
+            create_unique_index(graph_name)
+            print("✓ Created used_ip_start_end_uniq")
+
+    if args.dry_run:
+        return
+    if not Config.GRAPH_AGGREGATE_USED_IP:
+        # Per-order writers still add parallel edges, which the index would reject
+        print("Set GRAPH_AGGREGATE_USED_IP=true so new orders keep the aggregated shape, "
+              "then run this script once more to fold in edges written in between "
+              "and create the unique index.")
+
+
+if __name__ == '__main__':
+    main()
@@ -26,3 +26,104 @@ class Config:
             'keepalives_count': 5,
         }
     }
+    
+    # Connection pool settings for Apache AGE graph queries (graph_pool.py)
+    GRAPH_POOL_OPTIONS = {
+        'min_size': int(os.getenv('GRAPH_POOL_MIN_SIZE', '1')),
+        'max_size': int(os.getenv('GRAPH_POOL_MAX_SIZE', '10')),
+        'pool_timeout': 30,  # Seconds to wait for a free connection
+        'pool_recycle': 3600,  # Recycle connections after 1 hour
+        'pool_pre_ping': True,  # Check connection health before using
+        'connect_args': {
+            'connect_timeout': 10,
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 5,
+        }
+    }
+    
+    # How new orders reach the graph (graph_sync.py): 'inline', 'async', 'outbox' or 'transactional'
+    GRAPH_SYNC_MODE = os.getenv('GRAPH_SYNC_MODE', 'async').lower()
+    
+    # Background graph ingestion for checkout (graph_ingest.py)
+    GRAPH_INGEST_QUEUE_SIZE = int(os.getenv('GRAPH_INGEST_QUEUE_SIZE', '10000'))
+    GRAPH_INGEST_BATCH_SIZE = int(os.getenv('GRAPH_INGEST_BATCH_SIZE', '200'))
+    GRAPH_INGEST_FLUSH_INTERVAL = float(os.getenv('GRAPH_INGEST_FLUSH_INTERVAL', '0.5'))  # Seconds
+    GRAPH_INGEST_PUT_TIMEOUT = 0.05  # Seconds a request waits on a full queue before writing inline
+    GRAPH_INGEST_RETRIES = int(os.getenv('GRAPH_INGEST_RETRIES', '3'))  # Then the batch goes to graph_outbox
+    GRAPH_INGEST_RETRY_BACKOFF = float(os.getenv('GRAPH_INGEST_RETRY_BACKOFF', '0.5'))  # Seconds, doubled per retry
+    
+    # Transactional outbox drainer (graph_outbox.py)
+    GRAPH_OUTBOX_BATCH_SIZE = int(os.getenv('GRAPH_OUTBOX_BATCH_SIZE', '500'))
+    GRAPH_OUTBOX_MAX_ATTEMPTS = int(os.getenv('GRAPH_OUTBOX_MAX_ATTEMPTS', '5'))  # Rows failing more often are parked
+    GRAPH_OUTBOX_POLL_INTERVAL = float(os.getenv('GRAPH_OUTBOX_POLL_INTERVAL', '1.0'))  # Seconds
+    
+    # Known vertex / edge cache for graph writes (graph_cache.py)
+    GRAPH_CACHE_ENABLED = os.getenv('GRAPH_CACHE_ENABLED', 'true').lower() == 'true'
+    GRAPH_CACHE_MAX_VERTICES = int(os.getenv('GRAPH_CACHE_MAX_VERTICES', '100000'))
+    GRAPH_CACHE_MAX_EDGES = int(os.getenv('GRAPH_CACHE_MAX_EDGES', '300000'))
+    
+    # Versioned cache of graph read query results (graph_cache.py)
+    GRAPH_RESULT_CACHE_ENABLED = os.getenv('GRAPH_RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+    GRAPH_RESULT_CACHE_SIZE = int(os.getenv('GRAPH_RESULT_CACHE_SIZE', '1024'))
+    GRAPH_RESULT_CACHE_TTL = float(os.getenv('GRAPH_RESULT_CACHE_TTL', '60'))  # Seconds, covers writes from other processes
+    GRAPH_RESULT_CACHE_MIN_REFRESH = float(os.getenv('GRAPH_RESULT_CACHE_MIN_REFRESH', '5'))  # Seconds between whole-graph recomputes
+    
+    # One USED_IP edge per (user, IP) with order_count, first_seen, last_seen and
+    # recent_orders instead of one edge per order. Run compact_used_ip_edges.py first.
+    GRAPH_AGGREGATE_USED_IP = os.getenv('GRAPH_AGGREGATE_USED_IP', 'false').lower() == 'true'
+    GRAPH_RECENT_ORDERS_LIMIT = int(os.getenv('GRAPH_RECENT_ORDERS_LIMIT', '10'))  # Order ids kept per edge
+    
+    # Graph retention job (prune_graph.py)
+    GRAPH_RETENTION_DAYS = int(os.getenv('GRAPH_RETENTION_DAYS', '365'))
+    GRAPH_PRUNE_BATCH_SIZE = int(os.getenv('GRAPH_PRUNE_BATCH_SIZE', '1000'))
+    GRAPH_PRUNE_PAUSE = float(os.getenv('GRAPH_PRUNE_PAUSE', '0.1'))  # Seconds between batches
+    
+    # Shared-IP ranking (graph_utils.top_shared_ips, admin graph page)
+    FRAUD_TOP_SHARED_IPS = int(os.getenv('FRAUD_TOP_SHARED_IPS', '50'))  # IPs listed
+    FRAUD_SHARED_IP_SAMPLE = int(os.getenv('FRAUD_SHARED_IP_SAMPLE', '10'))  # Usernames shown per IP
+    
+    # Persisted fraud alerts (fraud_alerts.py), updated on each user location insert
+    FRAUD_ALERTS_ENABLED = os.getenv('FRAUD_ALERTS_ENABLED', 'true').lower() == 'true'
+    FRAUD_RECENT_ALERTS = int(os.getenv('FRAUD_RECENT_ALERTS', '20'))  # City mismatch alerts on the admin graph page
+    
+    # Supernodes: IPAddress / City vertices with so many edges that traversing them
+    # dominates fraud queries (graph_degrees.py keeps the degree of each vertex)
+    GRAPH_SUPERNODE_DEGREE = int(os.getenv('GRAPH_SUPERNODE_DEGREE', '1000'))  # Edges that make a supernode
+    GRAPH_SUPERNODE_ALLOWLIST = os.getenv('GRAPH_SUPERNODE_ALLOWLIST', 'City:Unknown')  # Label:key,... always supernodes
+    GRAPH_SUPERNODE_POLICY = os.getenv('GRAPH_SUPERNODE_POLICY', 'sample')  # 'skip', 'sample' or 'include'
+    GRAPH_SUPERNODE_SAMPLE = int(os.getenv('GRAPH_SUPERNODE_SAMPLE', '20'))  # Neighbors listed per supernode
+    GRAPH_DEGREES_ON_WRITE = os.getenv('GRAPH_DEGREES_ON_WRITE', 'true').lower() == 'true'  # Recount touched vertices on write
+    
+    # Link analysis between two users (graph_paths.py, /api/graph/path)
+    GRAPH_PATH_MAX_DEPTH = int(os.getenv('GRAPH_PATH_MAX_DEPTH', '6'))  # Hops, upper bound for callers
+    GRAPH_PATH_TIMEOUT = float(os.getenv('GRAPH_PATH_TIMEOUT', '2'))  # Seconds per search
+    GRAPH_PATH_MAX_FRONTIER = int(os.getenv('GRAPH_PATH_MAX_FRONTIER', '10000'))  # Vertices per search level
+    
+    # Backend answering the graph_utils read queries: 'age' (Apache AGE) or 'csr'
+    # (graph_csr.py, in-memory arrays loaded from the relational tables, no AGE needed)
+    GRAPH_BACKEND = os.getenv('GRAPH_BACKEND', 'age')
+    GRAPH_CSR_REFRESH_INTERVAL = float(os.getenv('GRAPH_CSR_REFRESH_INTERVAL', '30'))  # Seconds between incremental loads
+    GRAPH_CSR_BATCH_SIZE = int(os.getenv('GRAPH_CSR_BATCH_SIZE', '10000'))  # Rows per fetch
+    GRAPH_CSR_RESCAN_ROWS = int(os.getenv('GRAPH_CSR_RESCAN_ROWS', '1000'))  # Ids below the mark re-read for late commits
+    
+    # Region sharding (graph_shards.py): one graph per region, picked from the country
+    # detected for the order's IP, with reads fanned out across the shards
+    GRAPH_SHARDING = os.getenv('GRAPH_SHARDING', 'false').lower() == 'true'
+    GRAPH_SHARD_PREFIX = os.getenv('GRAPH_SHARD_PREFIX', 'restaurant_graph_region_')
+    GRAPH_SHARD_REGIONS = os.getenv('GRAPH_SHARD_REGIONS', '')  # Country=region,... e.g. France=eu,Germany=eu
+    GRAPH_SHARD_DEFAULT = os.getenv('GRAPH_SHARD_DEFAULT', 'unknown')  # Region when no country was detected
+    GRAPH_SHARD_WORKERS = int(os.getenv('GRAPH_SHARD_WORKERS', '4'))  # Shards queried in parallel
+    
+    # Local fraud checks on each live graph write (graph_alerts.py): the written user's
+    # and IP's neighborhood only, with alerts passed to the registered handlers
+    GRAPH_WRITE_CHECKS = os.getenv('GRAPH_WRITE_CHECKS', 'true').lower() == 'true'
+    GRAPH_WRITE_CHECK_DAYS = int(os.getenv('GRAPH_WRITE_CHECK_DAYS', '30'))  # Edge age considered, 0 for all history
+    GRAPH_WRITE_CHECK_LIMIT = int(os.getenv('GRAPH_WRITE_CHECK_LIMIT', '20'))  # Other users listed per shared IP
+    GRAPH_WRITE_CHECK_LOG = os.getenv('GRAPH_WRITE_CHECK_LOG', 'true').lower() == 'true'  # Print each alert
+    
+    # Latency budgets for graph reads (graph_pool.budgeted_connection). A read that
+    # runs past its budget is cancelled and the last cached result is served as stale.
+    GRAPH_READ_BUDGET = float(os.getenv('GRAPH_READ_BUDGET', '3'))  # Seconds per call, 0 disables
+    GRAPH_READ_BUDGETS = os.getenv('GRAPH_READ_BUDGETS', '')  # query=seconds,... e.g. fraud_patterns=10,user_graph=1
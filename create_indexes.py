@@ -5,6 +5,9 @@ Reference: https://learn.microsoft.com/en-us/azure/postgresql/flexible-server/ge
 from app import create_app
 from models import db
 from sqlalchemy import text
+from config import Config
+from graph_pool import graph_connection
+from graph_utils import GRAPH_NAME, GRAPH_VERTEX_KEYS, GRAPH_EDGE_LABELS, read_graphs
 
 app = create_app()
 
@@ -50,6 +53,109 @@ INDEXES = [
     ('user_locations_ip_city_idx', 'CREATE INDEX IF NOT EXISTS user_locations_ip_city_idx ON user_locations USING BTREE (ip_address, city)'),
 ]
 
+# Edge labels that hold at most one edge between two vertices
+GRAPH_UNIQUE_EDGE_LABELS = ['HAS_EMAIL', 'FROM_CITY', 'REGISTERED_IN']
+
+# Edge labels carrying a last_seen time (epoch seconds)
+GRAPH_TIMESTAMPED_EDGE_LABELS = ['USED_IP']
+
+# Vertex labels carrying degree / supernode properties (graph_degrees.py)
+GRAPH_SUPERNODE_LABELS = ['IPAddress', 'City']
+
+
+def graph_property_expr(prop):
+    """Index expression matching how AGE compiles `n.prop` in Cypher"""
+    return f"""ag_catalog.agtype_access_operator(VARIADIC ARRAY[properties, '"{prop}"'::ag_catalog.agtype])"""
+
+
+def graph_indexes(graph_name=GRAPH_NAME):
+    """
+    Indexes for the AGE label tables of the graph
+    - GIN on properties: property maps in MATCH/MERGE patterns compile to `properties @> {...}`
+    - Unique BTREE on the key property: WHERE n.key = ... lookups, and MERGE cannot duplicate vertices
+    - BTREE on id, start_id, end_id: vertex lookups by id and edge traversal
+    - Partial BTREE on degree of supernodes: listing them without scanning every vertex
+    - BTREE on USED_IP last_seen: time-windowed fraud queries only read recent edges
+    """
+    indexes = []
+    for label, prop in GRAPH_VERTEX_KEYS.items():
+        table = f'{graph_name}."{label}"'
+        name = label.lower()
+        indexes += [
+            (f'{name}_id_idx', f'CREATE INDEX IF NOT EXISTS {name}_id_idx ON {table} USING BTREE (id)'),
+            (f'{name}_properties_gin_idx', f'CREATE INDEX IF NOT EXISTS {name}_properties_gin_idx ON {table} USING GIN (properties)'),
+            (f'{name}_{prop}_uniq', f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_{prop}_uniq ON {table} USING BTREE ({graph_property_expr(prop)})'),
+        ]
+        if label in GRAPH_SUPERNODE_LABELS:
+            indexes.append((f'{name}_supernode_idx', f"CREATE INDEX IF NOT EXISTS {name}_supernode_idx ON {table} USING BTREE ({graph_property_expr('degree')}) WHERE {graph_property_expr('supernode')} = 'true'::ag_catalog.agtype"))
+    for label in GRAPH_EDGE_LABELS:
+        table = f'{graph_name}."{label}"'
+        name = label.lower()
+        indexes += [
+            (f'{name}_start_id_idx', f'CREATE INDEX IF NOT EXISTS {name}_start_id_idx ON {table} USING BTREE (start_id)'),
+            (f'{name}_end_id_idx', f'CREATE INDEX IF NOT EXISTS {name}_end_id_idx ON {table} USING BTREE (end_id)'),
+        ]
+        if label in GRAPH_TIMESTAMPED_EDGE_LABELS:
+            indexes.append((f'{name}_last_seen_idx', f"CREATE INDEX IF NOT EXISTS {name}_last_seen_idx ON {table} USING BTREE ({graph_property_expr('last_seen')})"))
+        if label in GRAPH_UNIQUE_EDGE_LABELS or (label == 'USED_IP' and Config.GRAPH_AGGREGATE_USED_IP):
+            indexes.append((f'{name}_start_end_uniq', f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_start_end_uniq ON {table} USING BTREE (start_id, end_id)'))
+    return indexes
+
+
+def ensure_graph_labels(cursor, graph_name=GRAPH_NAME):
+    """Create missing label tables so their indexes exist before the first write"""
+    cursor.execute("""
+        SELECT l.name FROM ag_catalog.ag_label l
+        JOIN ag_catalog.ag_graph g ON g.graphid = l.graph
+        WHERE g.name = %s
+    """, (graph_name,))
+    existing = {row[0] for row in cursor.fetchall()}
+    
+    for label in GRAPH_VERTEX_KEYS:
+        if label not in existing:
+            cursor.execute("SELECT create_vlabel(%s, %s);", (graph_name, label))
+    for label in GRAPH_EDGE_LABELS:
+        if label not in existing:
+            cursor.execute("SELECT create_elabel(%s, %s);", (graph_name, label))
+
+
+def create_graph_indexes(graph_name=GRAPH_NAME):
+    """Create property, id and uniqueness indexes on the AGE label tables"""
+    print("=" * 70)
+    print(f"Creating Apache AGE Label Indexes for '{graph_name}'")
+    print("=" * 70)
+    print()
+    
+    created = 0
+    errors = 0
+    indexes = graph_indexes(graph_name)
+    
+    try:
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            ensure_graph_labels(cursor, graph_name)
+            
+            for idx_name, sql in indexes:
+                try:
+                    print(f"Creating index: {idx_name}...", end=" ")
+                    cursor.execute(sql)
+                    print("✓ Created")
+                    created += 1
+                except Exception as e:
+                    # Unique indexes fail if the graph already holds duplicates
+                    print(f"✗ Error: {e}")
+                    errors += 1
+            cursor.close()
+    except Exception as e:
+        print(f"✗ Could not reach graph '{graph_name}': {e}")
+        return
+    
+    print()
+    print(f"Graph indexes: {len(indexes)}  Created: {created}  Errors: {errors}")
+    if errors:
+        print("⚠ Unique index errors mean duplicate vertices or edges exist; run rebuild_graph.py --shadow to rebuild a clean graph.")
+    print()
+
 def create_indexes():
     """Create all performance indexes"""
     with app.app_context():
@@ -128,6 +234,21 @@ def analyze_tables():
         
         print("✓ Table statistics updated!")
         print()
+    
+    print("Running ANALYZE on graph label tables...")
+    try:
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            for graph_name in read_graphs():
+                for label in list(GRAPH_VERTEX_KEYS) + GRAPH_EDGE_LABELS:
+                    print(f"  Analyzing {graph_name}.{label}...", end=" ")
+                    cursor.execute(f'ANALYZE {graph_name}."{label}"')
+                    print("✓")
+            cursor.close()
+        print("✓ Graph statistics updated!")
+    except Exception as e:
+        print(f"✗ Error: {e}")
+    print()
 
 def show_index_usage():
     """Show index usage statistics"""
@@ -145,12 +266,12 @@ def show_index_usage():
                 idx_tup_read as tuples_read,
                 idx_tup_fetch as tuples_fetched
             FROM pg_stat_user_indexes
-            WHERE schemaname = 'public'
+            WHERE schemaname IN ('public', :graph_name)
             ORDER BY tablename, indexname
         """)
         
         try:
-            result = db.session.execute(query)
+            result = db.session.execute(query, {'graph_name': GRAPH_NAME})
             rows = result.fetchall()
             
             if rows:
@@ -168,6 +289,10 @@ def show_index_usage():
 
 if __name__ == '__main__':
     create_indexes()
+    create_graph_indexes()
+    if Config.GRAPH_SHARDING:
+        for shard in read_graphs():
+            create_graph_indexes(shard)
     analyze_tables()
     
     print("=" * 70)
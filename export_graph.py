@@ -0,0 +1,286 @@
+"""
+Streaming export of restaurant_graph for offline analysis
+Vertices and edges are read with server-side cursors inside one
+repeatable-read snapshot and written out as they arrive, so memory stays
+constant whatever the graph size. Vertex ids are remapped to dense
+integers 0..n-1 (ordered by graphid) in SQL, so edge lists load straight
+into sparse matrices.
+
+Formats:
+  ndjson  - one JSON object per line, nodes first, then edges
+  graphml - GraphML with label and properties (as JSON) attributes
+  npz     - NumPy archive: node_labels (n,), edges (m,) with fields
+            src/dst/label, plus node_label_names / edge_label_names
+
+Usage:
+    python export_graph.py --format npz --output graph.npz
+    python export_graph.py --format ndjson > graph.ndjson
+
+With GRAPH_SHARDING, each region shard is a graph of its own (with its
+own copy of users seen in several regions) and is exported separately:
+    python export_graph.py --graph restaurant_graph_region_eu --output eu.npz
+"""
+import argparse
+import json
+import sys
+import zipfile
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+import numpy as np
+from config import Config
+from graph_pool import graph_connection
+from graph_shards import list_shard_graphs
+from graph_utils import GRAPH_NAME, GRAPH_VERTEX_KEYS, GRAPH_EDGE_LABELS
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'graphml': ('application/graphml+xml', 'graphml'),
+    'npz': ('application/octet-stream', 'npz'),
+}
+
+EDGE_DTYPE = np.dtype([('src', '<i8'), ('dst', '<i8'), ('label', 'i1')])
+
+
+def _labels_sql(graph_name, labels, columns):
+    """UNION ALL over the label tables, tagging rows with the label's position"""
+    return "\n UNION ALL ".join(
+        f'SELECT {code} AS label, {columns} FROM {graph_name}."{label}"'
+        for code, label in enumerate(labels)
+    )
+
+
+def vertices_sql(graph_name, labels):
+    return f"""
+        SELECT row_number() OVER (ORDER BY id) - 1, label, properties::text
+        FROM ({_labels_sql(graph_name, labels, 'id, properties')}) v
+        ORDER BY id
+    """
+
+
+def edges_sql(graph_name, vertex_labels, edge_labels):
+    return f"""
+        WITH dense AS (
+            SELECT id, row_number() OVER (ORDER BY id) - 1 AS idx
+            FROM ({_labels_sql(graph_name, vertex_labels, 'id')}) v
+        )
+        SELECT s.idx, t.idx, e.label, e.properties::text
+        FROM ({_labels_sql(graph_name, edge_labels, 'start_id, end_id, properties')}) e
+        JOIN dense s ON s.id = e.start_id
+        JOIN dense t ON t.id = e.end_id
+    """
+
+
+class GraphSnapshot:
+    """Consistent read-only view of one graph, streamed in batches"""
+
+    def __init__(self, conn, graph_name=GRAPH_NAME, batch_size=10000):
+        self.conn = conn
+        self.graph_name = graph_name
+        self.batch_size = batch_size
+
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("""
+            SELECT l.name FROM ag_catalog.ag_label l
+            JOIN ag_catalog.ag_graph g ON g.graphid = l.graph
+            WHERE g.name = %s
+        """, (graph_name,))
+        existing = {row[0] for row in cursor.fetchall()}
+        self.vertex_labels = [label for label in GRAPH_VERTEX_KEYS if label in existing]
+        self.edge_labels = [label for label in GRAPH_EDGE_LABELS if label in existing]
+
+        self.vertex_count = self._count(self.vertex_labels)
+        self.edge_count = self._count(self.edge_labels)
+        cursor.close()
+
+    def _count(self, labels):
+        if not labels:
+            return 0
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM ({_labels_sql(self.graph_name, labels, 'id')}) t")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+
+    def _stream(self, name, sql):
+        cursor = self.conn.cursor(name=name)
+        cursor.itersize = self.batch_size
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+    def vertices(self):
+        """Batches of (dense_id, label_code, properties_json)"""
+        if self.vertex_labels:
+            yield from self._stream('graph_export_vertices',
+                                    vertices_sql(self.graph_name, self.vertex_labels))
+
+    def edges(self):
+        """Batches of (src, dst, label_code, properties_json)"""
+        if self.vertex_labels and self.edge_labels:
+            yield from self._stream('graph_export_edges',
+                                    edges_sql(self.graph_name, self.vertex_labels, self.edge_labels))
+
+
+@contextmanager
+def graph_snapshot(graph_name=GRAPH_NAME, batch_size=10000):
+    """Open a snapshot on a pooled connection for the duration of an export"""
+    with graph_connection() as conn:
+        conn.autocommit = False
+        try:
+            yield GraphSnapshot(conn, graph_name, batch_size)
+        finally:
+            conn.rollback()
+
+
+def iter_ndjson(snapshot):
+    """Nodes, then edges, one JSON object per line"""
+    for rows in snapshot.vertices():
+        yield "".join(
+            f'{{"type": "node", "id": {idx}, "label": {json.dumps(snapshot.vertex_labels[label])}, '
+            f'"properties": {props}}}\n'
+            for idx, label, props in rows
+        ).encode()
+    for rows in snapshot.edges():
+        yield "".join(
+            f'{{"type": "edge", "source": {src}, "target": {dst}, '
+            f'"label": {json.dumps(snapshot.edge_labels[label])}, "properties": {props}}}\n'
+            for src, dst, label, props in rows
+        ).encode()
+
+
+def iter_graphml(snapshot):
+    """Directed GraphML; properties are kept as a JSON string attribute"""
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+        '  <key id="label" for="all" attr.name="label" attr.type="string"/>\n'
+        '  <key id="properties" for="all" attr.name="properties" attr.type="string"/>\n'
+        f'  <graph id={quoteattr(snapshot.graph_name)} edgedefault="directed">\n'
+    ).encode()
+    for rows in snapshot.vertices():
+        yield "".join(
+            f'    <node id="n{idx}"><data key="label">{snapshot.vertex_labels[label]}</data>'
+            f'<data key="properties">{escape(props)}</data></node>\n'
+            for idx, label, props in rows
+        ).encode()
+    for rows in snapshot.edges():
+        yield "".join(
+            f'    <edge source="n{src}" target="n{dst}"><data key="label">{snapshot.edge_labels[label]}</data>'
+            f'<data key="properties">{escape(props)}</data></edge>\n'
+            for src, dst, label, props in rows
+        ).encode()
+    yield b'  </graph>\n</graphml>\n'
+
+
+class _StreamBuffer:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _npy_member(archive, name, dtype, shape):
+    """Open a .npy member of the archive and write its header"""
+    member = archive.open(f'{name}.npy', 'w', force_zip64=True)
+    np.lib.format.write_array_header_1_0(member, {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': shape,
+    })
+    return member
+
+
+def iter_npz(snapshot):
+    """
+    NumPy .npz archive built on the fly: each array's header is written from
+    the snapshot's counts, then its rows are appended batch by batch.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        written = 0
+        with _npy_member(archive, 'node_labels', np.dtype('i1'), (snapshot.vertex_count,)) as member:
+            for rows in snapshot.vertices():
+                member.write(np.fromiter((row[1] for row in rows), dtype='i1', count=len(rows)).tobytes())
+                written += len(rows)
+                yield buffer.drain()
+        if written != snapshot.vertex_count:
+            raise RuntimeError(f"Expected {snapshot.vertex_count} vertices, streamed {written}")
+
+        written = 0
+        with _npy_member(archive, 'edges', EDGE_DTYPE, (snapshot.edge_count,)) as member:
+            for rows in snapshot.edges():
+                member.write(np.array([row[:3] for row in rows], dtype=EDGE_DTYPE).tobytes())
+                written += len(rows)
+                yield buffer.drain()
+        if written != snapshot.edge_count:
+            raise RuntimeError(f"Expected {snapshot.edge_count} edges, streamed {written}")
+
+        for name, labels in (('node_label_names', snapshot.vertex_labels),
+                             ('edge_label_names', snapshot.edge_labels)):
+            with archive.open(f'{name}.npy', 'w') as member:
+                np.lib.format.write_array(member, np.array(labels, dtype='U32'))
+    yield buffer.drain()
+
+
+EXPORTERS = {
+    'ndjson': iter_ndjson,
+    'graphml': iter_graphml,
+    'npz': iter_npz,
+}
+
+
+def exportable_graphs():
+    """Graphs that can be exported: the region shards with GRAPH_SHARDING, else restaurant_graph"""
+    return list_shard_graphs() if Config.GRAPH_SHARDING else [GRAPH_NAME]
+
+
+def iter_export(fmt, graph_name=GRAPH_NAME, batch_size=10000):
+    """Bytes of the whole export in the given format, produced incrementally"""
+    with graph_snapshot(graph_name, batch_size) as snapshot:
+        for chunk in EXPORTERS[fmt](snapshot):
+            if chunk:
+                yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the Apache AGE graph to an offline format')
+    parser.add_argument('--graph', default=GRAPH_NAME)
+    parser.add_argument('--format', choices=sorted(EXPORTERS), default='npz')
+    parser.add_argument('--output', help='file to write (default: stdout)')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows fetched per round trip')
+    args = parser.parse_args()
+    if Config.GRAPH_SHARDING and args.graph == GRAPH_NAME:
+        parser.error(f"with GRAPH_SHARDING, export one shard at a time with --graph "
+                     f"({', '.join(exportable_graphs()) or 'no shards yet'})")
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        size = 0
+        for chunk in iter_export(args.format, args.graph, args.batch_size):
+            out.write(chunk)
+            size += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+    print(f"✓ Exported '{args.graph}' as {args.format} ({size} bytes)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
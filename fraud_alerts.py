@@ -0,0 +1,257 @@
+"""
+Persisted fraud alerts, kept up to date as user locations are recorded
+Every UserLocation insert (logins and orders) updates, in the same flush:
+  shared_ip_users   the (IP, user) pairs seen, so each user counts once per IP
+  shared_ip_groups  one row per IP with its distinct user count and a sample
+                    of usernames
+  fraud_alerts      one row per finding, deduplicated on alert_key:
+                    'shared_ip' for each user of an IP shared by 2 or more
+                    users, 'city_mismatch' for each (user, IP, city) outside
+                    the user's registered city
+Each insert costs a few keyed upserts, so the admin page and /api/fraud/alerts
+read the alerts instead of rescanning user_locations or the graph. Alerts and
+groups keep their status (see FRAUD_ALERT_STATUSES) across updates; a dismissed
+group is reopened when a new user joins it.
+
+Usage:
+    python fraud_alerts.py              # rebuild the tables from user_locations
+"""
+import argparse
+import time
+from datetime import datetime
+from sqlalchemy import event, text
+from config import Config
+from graph_alerts import alert_key
+from models import FraudAlert, SharedIpGroup, UserLocation
+
+FRAUD_ALERT_TYPES = ('shared_ip', 'city_mismatch')
+FRAUD_ALERT_STATUSES = ('open', 'investigating', 'confirmed', 'dismissed')
+
+USER_SQL = text("SELECT username, city FROM users WHERE id = :user_id")
+
+# xmax = 0 only for a freshly inserted row: the user is new to this IP
+RECORD_MEMBER_SQL = text("""
+    INSERT INTO shared_ip_users AS m (ip_address, user_id, first_seen, last_seen, locations)
+    VALUES (:ip, :user_id, :seen, :seen, 1)
+    ON CONFLICT (ip_address, user_id) DO UPDATE
+    SET last_seen = GREATEST(m.last_seen, EXCLUDED.last_seen),
+        locations = m.locations + 1
+    RETURNING xmax = 0
+""")
+
+JOIN_GROUP_SQL = text("""
+    INSERT INTO shared_ip_groups AS g (ip_address, user_count, users, status, first_seen, last_seen, updated_at)
+    VALUES (:ip, 1, ARRAY[CAST(:username AS varchar)], 'open', :seen, :seen, :now)
+    ON CONFLICT (ip_address) DO UPDATE
+    SET user_count = g.user_count + 1,
+        users = CASE WHEN cardinality(g.users) < :sample THEN array_append(g.users, EXCLUDED.users[1])
+                     ELSE g.users END,
+        status = CASE WHEN g.status = 'dismissed' THEN 'open' ELSE g.status END,
+        last_seen = GREATEST(g.last_seen, EXCLUDED.last_seen),
+        updated_at = EXCLUDED.updated_at
+    RETURNING user_count
+""")
+
+TOUCH_GROUP_SQL = text("""
+    UPDATE shared_ip_groups
+    SET last_seen = GREATEST(last_seen, :seen), updated_at = :now
+    WHERE ip_address = :ip
+""")
+
+# The member already on an IP that just became shared
+FIRST_MEMBER_SQL = text("""
+    SELECT m.user_id, u.username, u.city, m.first_seen, m.last_seen, m.locations
+    FROM shared_ip_users m
+    JOIN users u ON u.id = m.user_id
+    WHERE m.ip_address = :ip AND m.user_id <> :user_id
+    LIMIT 1
+""")
+
+UPSERT_ALERT_SQL = text("""
+    INSERT INTO fraud_alerts AS a (alert_key, alert_type, status, user_id, username, ip_address,
+                                   registered_city, detected_city, occurrences, first_seen, last_seen, updated_at)
+    VALUES (:alert_key, :alert_type, 'open', :user_id, :username, :ip,
+            :registered_city, :detected_city, :occurrences, :first_seen, :last_seen, :now)
+    ON CONFLICT (alert_key) DO UPDATE
+    SET occurrences = a.occurrences + EXCLUDED.occurrences,
+        registered_city = EXCLUDED.registered_city,
+        last_seen = GREATEST(a.last_seen, EXCLUDED.last_seen),
+        updated_at = EXCLUDED.updated_at
+""")
+
+# Another location for a pair that may already have a shared_ip alert
+TOUCH_ALERT_SQL = text("""
+    UPDATE fraud_alerts
+    SET occurrences = occurrences + 1, last_seen = GREATEST(last_seen, :seen), updated_at = :now
+    WHERE alert_key = :alert_key
+""")
+
+# Rebuild: the same tables computed from every location, statuses kept
+REBUILD_SQL = [
+    "DELETE FROM shared_ip_users",
+    """
+    INSERT INTO shared_ip_users (ip_address, user_id, first_seen, last_seen, locations)
+    SELECT ip_address, user_id, MIN(timestamp), MAX(timestamp), COUNT(*)
+    FROM user_locations
+    GROUP BY ip_address, user_id
+    """,
+    "DELETE FROM shared_ip_groups WHERE ip_address NOT IN (SELECT ip_address FROM shared_ip_users)",
+    """
+    INSERT INTO shared_ip_groups AS g (ip_address, user_count, users, status, first_seen, last_seen, updated_at)
+    SELECT m.ip_address, COUNT(*),
+           (array_agg(u.username ORDER BY m.first_seen, u.username))[1:%(sample)s],
+           'open', MIN(m.first_seen), MAX(m.last_seen), %(now)s
+    FROM shared_ip_users m
+    JOIN users u ON u.id = m.user_id
+    GROUP BY m.ip_address
+    ON CONFLICT (ip_address) DO UPDATE
+    SET user_count = EXCLUDED.user_count, users = EXCLUDED.users,
+        first_seen = EXCLUDED.first_seen, last_seen = EXCLUDED.last_seen, updated_at = EXCLUDED.updated_at
+    """,
+    """
+    INSERT INTO fraud_alerts AS a (alert_key, alert_type, status, user_id, username, ip_address,
+                                   registered_city, occurrences, first_seen, last_seen, updated_at)
+    SELECT concat_ws('|', 'shared_ip', m.ip_address, u.username), 'shared_ip', 'open', m.user_id, u.username,
+           m.ip_address, u.city, m.locations, m.first_seen, m.last_seen, %(now)s
+    FROM shared_ip_users m
+    JOIN users u ON u.id = m.user_id
+    JOIN shared_ip_groups g ON g.ip_address = m.ip_address
+    WHERE g.user_count >= 2 AND g.user_count < %(max_users)s
+    ON CONFLICT (alert_key) DO UPDATE
+    SET occurrences = EXCLUDED.occurrences, registered_city = EXCLUDED.registered_city,
+        first_seen = EXCLUDED.first_seen, last_seen = EXCLUDED.last_seen, updated_at = EXCLUDED.updated_at
+    """,
+    """
+    INSERT INTO fraud_alerts AS a (alert_key, alert_type, status, user_id, username, ip_address,
+                                   registered_city, detected_city, occurrences, first_seen, last_seen, updated_at)
+    SELECT concat_ws('|', 'city_mismatch', u.username, l.ip_address, l.city), 'city_mismatch', 'open',
+           l.user_id, u.username, l.ip_address, u.city, l.city, COUNT(*), MIN(l.timestamp), MAX(l.timestamp), %(now)s
+    FROM user_locations l
+    JOIN users u ON u.id = l.user_id
+    WHERE l.matches_user_city IS FALSE AND l.city <> 'Unknown'
+    GROUP BY l.user_id, u.username, u.city, l.ip_address, l.city
+    ON CONFLICT (alert_key) DO UPDATE
+    SET occurrences = EXCLUDED.occurrences, registered_city = EXCLUDED.registered_city,
+        first_seen = EXCLUDED.first_seen, last_seen = EXCLUDED.last_seen, updated_at = EXCLUDED.updated_at
+    """,
+]
+
+
+def _alert_params(alert_type, user_id, username, registered_city, ip, detected_city, occurrences,
+                  first_seen, last_seen, now):
+    key = alert_key({'type': alert_type, 'username': username, 'ip': ip, 'detected_city': detected_city})
+    return {
+        'alert_key': '|'.join(key), 'alert_type': alert_type, 'user_id': user_id, 'username': username,
+        'ip': ip, 'registered_city': registered_city, 'detected_city': detected_city,
+        'occurrences': occurrences, 'first_seen': first_seen, 'last_seen': last_seen, 'now': now
+    }
+
+
+def record_location(connection, location):
+    """Update the alert tables for one inserted UserLocation, on the flushing connection"""
+    user = connection.execute(USER_SQL, {'user_id': location.user_id}).first()
+    if user is None:
+        return
+    username, registered_city = user
+    ip = location.ip_address
+    now = datetime.utcnow()
+    seen = location.timestamp or now
+    member = {'ip': ip, 'user_id': location.user_id, 'seen': seen, 'now': now}
+
+    if connection.execute(RECORD_MEMBER_SQL, member).scalar():
+        user_count = connection.execute(JOIN_GROUP_SQL, dict(member, username=username,
+                                                             sample=Config.FRAUD_SHARED_IP_SAMPLE)).scalar()
+        # Proxies and NAT addresses with supernode-sized user counts get a group, not per-user alerts
+        if 2 <= user_count < Config.GRAPH_SUPERNODE_DEGREE:
+            alerts = [_alert_params('shared_ip', location.user_id, username, registered_city, ip, None,
+                                    1, seen, seen, now)]
+            if user_count == 2:
+                other = connection.execute(FIRST_MEMBER_SQL, member).first()
+                if other is not None:
+                    other_id, other_name, other_city, first_seen, last_seen, locations = other
+                    alerts.append(_alert_params('shared_ip', other_id, other_name, other_city, ip, None,
+                                                locations, first_seen, last_seen, now))
+            for params in alerts:
+                connection.execute(UPSERT_ALERT_SQL, params)
+    else:
+        connection.execute(TOUCH_GROUP_SQL, member)
+        key = alert_key({'type': 'shared_ip', 'username': username, 'ip': ip})
+        connection.execute(TOUCH_ALERT_SQL, dict(member, alert_key='|'.join(key)))
+
+    if location.matches_user_city is False and location.city and location.city != 'Unknown':
+        connection.execute(UPSERT_ALERT_SQL, _alert_params('city_mismatch', location.user_id, username,
+                                                           registered_city, ip, location.city,
+                                                           1, seen, seen, now))
+
+
+@event.listens_for(UserLocation, 'after_insert')
+def _location_inserted(mapper, connection, location):
+    if Config.FRAUD_ALERTS_ENABLED:
+        record_location(connection, location)
+
+
+def shared_ip_groups(limit, min_users=2, status='open'):
+    """IPs with at least min_users users, most users first (status None for any)"""
+    query = SharedIpGroup.query.filter(SharedIpGroup.user_count >= min_users)
+    if status:
+        query = query.filter(SharedIpGroup.status == status)
+    return query.order_by(SharedIpGroup.user_count.desc(), SharedIpGroup.last_seen.desc(),
+                          SharedIpGroup.ip_address).limit(limit).all()
+
+
+def count_shared_ip_groups(min_users=2, status='open'):
+    query = SharedIpGroup.query.filter(SharedIpGroup.user_count >= min_users)
+    if status:
+        query = query.filter(SharedIpGroup.status == status)
+    return query.count()
+
+
+def recent_alerts(limit, alert_type=None, status='open'):
+    """Most recently seen alerts"""
+    query = FraudAlert.query
+    if alert_type:
+        query = query.filter(FraudAlert.alert_type == alert_type)
+    if status:
+        query = query.filter(FraudAlert.status == status)
+    return query.order_by(FraudAlert.last_seen.desc(), FraudAlert.id.desc()).limit(limit).all()
+
+
+def rebuild_alert_tables(connection):
+    """Recompute the three tables from user_locations; alert and group statuses are kept"""
+    params = {'sample': Config.FRAUD_SHARED_IP_SAMPLE, 'max_users': Config.GRAPH_SUPERNODE_DEGREE,
+              'now': datetime.utcnow()}
+    for sql in REBUILD_SQL:
+        connection.exec_driver_sql(sql, params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the fraud alert tables from user_locations')
+    parser.parse_args()
+
+    # Imported here: app imports this module through routes_fraud
+    from app import create_app
+    from models import db
+
+    print("=" * 70)
+    print("Rebuilding fraud_alerts / shared_ip_groups from user_locations")
+    print("=" * 70)
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        started = time.monotonic()
+        with db.engine.begin() as connection:
+            rebuild_alert_tables(connection)
+            groups, shared, alerts = connection.execute(text(
+                "SELECT (SELECT COUNT(*) FROM shared_ip_groups),"
+                " (SELECT COUNT(*) FROM shared_ip_groups WHERE user_count >= 2),"
+                " (SELECT COUNT(*) FROM fraud_alerts)"
+            )).first()
+    print(f"  {'IP groups':<20} {groups:>10}")
+    print(f"  {'shared IPs':<20} {shared:>10}")
+    print(f"  {'alerts':<20} {alerts:>10}")
+    print(f"✓ Done in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Fraud checks run on each graph write
+Instead of waiting for detect_fraud_patterns to match the whole graph,
+every batch of order events written by the live sync paths is checked
+against the neighborhood of its (user, IP) pairs only: the other users of
+the IP (2 hops) and the cities of the IP against the user's registered
+city (1 hop each). The cost follows the size of the batch, not of the
+graph. Supernodes are skipped, as in the global fraud queries.
+
+Alerts are plain dicts passed in batches to the registered handlers:
+    shared_ip      username, ip, users (other users of the IP), user_count
+    city_mismatch  username, ip, registered_city, detected_city
+both with type, graph, order_ids and detected_at (epoch seconds).
+"""
+import threading
+import time
+from config import Config
+from graph_statements import CypherStatement
+
+ALERT_TYPES = ('shared_ip', 'city_mismatch')
+
+# Other users of each written IP, seen within $since. The IP is matched and
+# filtered first, so a supernode is never expanded; the user list is cut to
+# $limit names, the count is not.
+LOCAL_SHARED_IP_CYPHER = """
+    UNWIND $pairs AS p
+    MATCH (ip:IPAddress {address: p.ip})
+    WHERE NOT coalesce(ip.supernode, false)
+    MATCH (u:User)-[r:USED_IP]->(ip)
+    WHERE u.username <> p.username AND coalesce(r.last_seen, r.ts) >= $since
+    WITH p, ip, collect(DISTINCT u.username) AS users
+    RETURN p.idx, users[0..$limit], size(users)
+"""
+
+# The city each order was placed from, when it differs from the user's
+# registered city; other cities the IP was seen in before are not rechecked
+LOCAL_CITY_MISMATCH_CYPHER = """
+    UNWIND $pairs AS p
+    MATCH (u:User {username: p.username})-[:REGISTERED_IN]->(reg_city:City),
+          (ip:IPAddress {address: p.ip})-[:FROM_CITY]->(det_city:City)
+    WHERE reg_city.name <> det_city.name AND det_city.name = p.city_detected
+      AND NOT (coalesce(ip.supernode, false) OR coalesce(det_city.supernode, false))
+    RETURN p.idx, reg_city.name, det_city.name
+"""
+
+LOCAL_SHARED_IP = CypherStatement('local_shared_ip', LOCAL_SHARED_IP_CYPHER,
+                                  'idx agtype, users agtype, user_count agtype')
+LOCAL_CITY_MISMATCH = CypherStatement('local_city_mismatch', LOCAL_CITY_MISMATCH_CYPHER,
+                                      'idx agtype, registered_city agtype, detected_city agtype')
+
+
+class WriteCheckStats:
+    """Thread-safe counters of the write-time checks and the alerts they raised"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, events, alerts, elapsed_ms, error=False):
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['events'] += events
+            self._stats['errors'] += int(error)
+            self._stats['total_ms'] += elapsed_ms
+            self._stats['max_ms'] = max(self._stats['max_ms'], elapsed_ms)
+            for alert in alerts:
+                self._stats[alert['type']] += 1
+
+    def snapshot(self):
+        with self._lock:
+            batches = self._stats['batches']
+            return {
+                **self._stats,
+                'total_ms': round(self._stats['total_ms'], 2),
+                'max_ms': round(self._stats['max_ms'], 2),
+                'avg_ms': round(self._stats['total_ms'] / batches, 2) if batches else 0.0,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats = {'batches': 0, 'events': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                           **{alert_type: 0 for alert_type in ALERT_TYPES}}
+
+
+write_check_stats = WriteCheckStats()
+
+# Callables taking a list of alerts, run by emit_alerts
+alert_handlers = []
+
+
+def register_alert_handler(handler):
+    """Add a handler for the alerts of each checked write (usable as a decorator)"""
+    if handler not in alert_handlers:
+        alert_handlers.append(handler)
+    return handler
+
+
+def unregister_alert_handler(handler):
+    if handler in alert_handlers:
+        alert_handlers.remove(handler)
+
+
+def emit_alerts(alerts):
+    """Pass alerts to every handler; a failing handler does not stop the others"""
+    if not alerts:
+        return
+    for handler in list(alert_handlers):
+        try:
+            handler(alerts)
+        except Exception as e:
+            print(f"Warning: fraud alert handler {getattr(handler, '__name__', handler)} failed: {e}")
+
+
+def check_order_events(cursor, events, graph_name):
+    """
+    Run the local fraud checks for order events just written to graph_name,
+    on the writer's cursor so the new edges are visible. Returns the alerts;
+    a failing check is counted and returns none rather than failing the write.
+    """
+    # Shared IPs are checked per (user, IP), city mismatches per (user, IP, city)
+    pairs, cities = {}, {}
+    for event in events:
+        for groups, key in ((pairs, (event['username'], event['ip_address'])),
+                            (cities, (event['username'], event['ip_address'], event['city_detected']))):
+            group = groups.setdefault(key, {
+                'idx': len(groups), 'username': event['username'], 'ip': event['ip_address'],
+                'city_detected': event['city_detected'], 'order_ids': []
+            })
+            group['order_ids'] += event['order_ids']
+    pairs, cities = list(pairs.values()), list(cities.values())
+    if not pairs:
+        return []
+
+    started = time.perf_counter()
+    now = int(time.time())
+    since = now - Config.GRAPH_WRITE_CHECK_DAYS * 86400 if Config.GRAPH_WRITE_CHECK_DAYS > 0 else 0
+    # A savepoint keeps a failed check from aborting the writer's transaction
+    savepoint = not cursor.connection.autocommit
+    alerts = []
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT graph_write_check")
+        shared = LOCAL_SHARED_IP.fetchall(cursor, {
+            'pairs': [{key: pair[key] for key in ('idx', 'username', 'ip')} for pair in pairs],
+            'since': since, 'limit': Config.GRAPH_WRITE_CHECK_LIMIT
+        }, graph_name)
+        mismatches = LOCAL_CITY_MISMATCH.fetchall(cursor, {
+            'pairs': [{key: pair[key] for key in ('idx', 'username', 'ip', 'city_detected')} for pair in cities]
+        }, graph_name)
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT graph_write_check")
+    except Exception as e:
+        if savepoint:
+            cursor.execute("ROLLBACK TO SAVEPOINT graph_write_check")
+        write_check_stats.record(len(events), [], (time.perf_counter() - started) * 1000, error=True)
+        print(f"Warning: write-time fraud check failed: {e}")
+        return []
+
+    def alert(alert_type, pair, **fields):
+        return {'type': alert_type, 'username': pair['username'], 'ip': pair['ip'], **fields,
+                'graph': graph_name, 'order_ids': pair['order_ids'], 'detected_at': now}
+
+    alerts += [alert('shared_ip', pairs[idx], users=users, user_count=user_count)
+               for idx, users, user_count in shared if user_count]
+    alerts += [alert('city_mismatch', cities[idx], registered_city=registered, detected_city=detected)
+               for idx, registered, detected in mismatches]
+    write_check_stats.record(len(events), alerts, (time.perf_counter() - started) * 1000)
+    return alerts
+
+
+def alert_key(alert):
+    """What an alert is about, without when it was raised: equal keys are the same finding"""
+    if alert['type'] == 'shared_ip':
+        return ('shared_ip', alert['ip'], alert['username'])
+    return ('city_mismatch', alert['username'], alert['ip'], alert['detected_city'])
+
+
+def log_alerts(alerts):
+    """Default handler: one line per alert"""
+    for alert in alerts:
+        if alert['type'] == 'shared_ip':
+            others = ', '.join(alert['users'])
+            more = alert['user_count'] - len(alert['users'])
+            print(f"Fraud alert: {alert['username']} shares IP {alert['ip']} with {others}"
+                  + (f" (+{more} more)" if more > 0 else ""))
+        else:
+            print(f"Fraud alert: {alert['username']} (registered in {alert['registered_city']}) "
+                  f"ordered from {alert['detected_city']} via {alert['ip']}")
+
+
+if Config.GRAPH_WRITE_CHECK_LOG:
+    register_alert_handler(log_alerts)
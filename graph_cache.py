@@ -0,0 +1,248 @@
+"""
+In-process caches for the Apache AGE graph
+KnownElementCache remembers the graphids of vertices and the static edges
+already written, so repeat orders skip the MERGE sequence and only add
+their USED_IP edge by id. GraphResultCache keeps the results of read
+queries until a write touches the users or IPs they depend on, and the
+last result of each as a fallback when a read runs past its budget.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used key"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class KnownElementCache:
+    """
+    (graph, label, key) -> graphid for vertices, and the set of static edges
+    (HAS_EMAIL, FROM_CITY, REGISTERED_IN) known to exist.
+    Ids are only valid for the graph instance they were read from, so the
+    cache also records each graph's ag_graph.graphid; writes check it and a
+    rebuilt or swapped graph invalidates everything.
+    """
+
+    def __init__(self, max_vertices=100000, max_edges=300000):
+        self._vertices = LRUCache(max_vertices)
+        self._edges = LRUCache(max_edges)
+        self._graph_oids = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'stale': 0, 'invalidations': 0}
+
+    def graph_oid(self, graph_name):
+        return self._graph_oids.get(graph_name)
+
+    def set_graph_oid(self, graph_name, oid):
+        """Record which graph instance the cached ids belong to"""
+        previous = self._graph_oids.get(graph_name)
+        if previous is not None and previous != oid:
+            self.invalidate()
+        self._graph_oids[graph_name] = oid
+
+    def lookup(self, graph_name, event):
+        """
+        Return (user_id, ip_id) when every vertex and static edge of the
+        event is known, otherwise None.
+        """
+        ids = self._lookup(graph_name, event)
+        with self._lock:
+            self._counters['hits' if ids else 'misses'] += 1
+        return ids
+
+    def _lookup(self, graph_name, event):
+        if graph_name not in self._graph_oids:
+            return None
+        vertices = self._vertices
+        user_id = vertices.get((graph_name, 'User', event['username']))
+        ip_id = vertices.get((graph_name, 'IPAddress', event['ip_address']))
+        if user_id is None or ip_id is None:
+            return None
+        edges = (
+            (graph_name, 'HAS_EMAIL', event['username'], event['email']),
+            (graph_name, 'REGISTERED_IN', event['username'], event['user_city']),
+            (graph_name, 'FROM_CITY', event['ip_address'], event['city_detected']),
+        )
+        if not all(self._edges.get(edge) for edge in edges):
+            return None
+        return user_id, ip_id
+
+    def remember(self, graph_name, event, user_id, ip_id):
+        """Record the vertices and static edges written for an event"""
+        self._vertices.put((graph_name, 'User', event['username']), user_id)
+        self._vertices.put((graph_name, 'IPAddress', event['ip_address']), ip_id)
+        self._edges.put((graph_name, 'HAS_EMAIL', event['username'], event['email']), True)
+        self._edges.put((graph_name, 'REGISTERED_IN', event['username'], event['user_city']), True)
+        self._edges.put((graph_name, 'FROM_CITY', event['ip_address'], event['city_detected']), True)
+
+    def forget(self, graph_name, event):
+        """Drop the vertices of an event whose cached ids turned out not to exist"""
+        self._vertices.pop((graph_name, 'User', event['username']))
+        self._vertices.pop((graph_name, 'IPAddress', event['ip_address']))
+        with self._lock:
+            self._counters['stale'] += 1
+
+    def invalidate(self):
+        """Forget everything, e.g. after the graph was rebuilt"""
+        self._vertices.clear()
+        self._edges.clear()
+        self._graph_oids.clear()
+        with self._lock:
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        """Hit rate and sizes"""
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters['hits'] + counters['misses']
+        return {
+            **counters,
+            'hit_rate': round(counters['hits'] / lookups, 4) if lookups else 0.0,
+            'vertices': len(self._vertices),
+            'edges': len(self._edges),
+        }
+
+
+class GraphResultCache:
+    """
+    Read-through cache of graph query results, tagged with graph versions.
+    Every write bumps the global version and the version of each scope it
+    touches, e.g. ('user', username) or ('ip', address). An entry is served
+    while the versions it was loaded under are unchanged and it is younger
+    than ttl seconds. Queries over the whole graph depend on GLOBAL and may
+    pass min_refresh to be recomputed at most that often under constant
+    writes. Versions are per process, so writes made elsewhere are only
+    picked up through the TTL.
+    """
+
+    GLOBAL = '*'
+
+    def __init__(self, max_entries=1024, ttl=60, max_scopes=100000):
+        self.ttl = ttl
+        self.max_scopes = max_scopes
+        self._entries = LRUCache(max_entries)
+        self._versions = {self.GLOBAL: 0}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidated': 0, 'expired': 0, 'bumps': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def bump(self, scopes):
+        """Record a write touching the given scopes"""
+        with self._lock:
+            self._counters['bumps'] += 1
+            self._versions[self.GLOBAL] += 1
+            for scope in set(scopes):
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+            if len(self._versions) > self.max_scopes:
+                self._bump_all()
+
+    def bump_all(self):
+        """Invalidate every entry, e.g. after the graph was rebuilt"""
+        with self._lock:
+            self._bump_all()
+
+    def _bump_all(self):
+        self._epoch += 1
+        self._versions = {self.GLOBAL: self._versions[self.GLOBAL] + 1}
+
+    def _is_current(self, epoch, versions):
+        return epoch == self._epoch and all(
+            self._versions.get(scope, 0) == version for scope, version in versions.items()
+        )
+
+    def get_or_load(self, key, loader, scopes, min_refresh=0):
+        """
+        Return the cached result for key, or call loader() and cache it.
+        scopes lists what the result depends on, or is a callable building
+        that list from the loaded result.
+        """
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None:
+            value, epoch, versions, stored_at = entry
+            age = now - stored_at
+            if age >= self.ttl:
+                self._count('expired')
+            elif epoch == self._epoch and (age < min_refresh or self._is_current(epoch, versions)):
+                self._count('hits')
+                return value
+            else:
+                self._count('invalidated')
+        self._count('misses')
+
+        with self._lock:
+            epoch, written = self._epoch, self._versions[self.GLOBAL]
+            if not callable(scopes):
+                versions = {scope: self._versions.get(scope, 0) for scope in scopes}
+        value = loader()
+
+        # Tag the entry with the versions read before the load, so one raced
+        # by a write counts as invalidated but is still there for min_refresh
+        # and last_result
+        with self._lock:
+            if callable(scopes):
+                versions = {scope: self._versions.get(scope, 0) for scope in scopes(value)}
+                if self._versions[self.GLOBAL] != written:
+                    # Which scopes the raced writes touched is unknown
+                    versions[self.GLOBAL] = written
+            self._entries.put(key, (value, epoch, versions, now))
+        return value
+
+    def last_result(self, key):
+        """
+        (value, age in seconds) of whatever is cached for key, current or not,
+        or None. For serving a stale result when a fresh load is not possible.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, _, _, stored_at = entry
+        return value, time.monotonic() - stored_at
+
+    def stats(self):
+        """Hit rate, invalidation counters and size"""
+        with self._lock:
+            counters = dict(self._counters)
+            scopes = len(self._versions) - 1
+        lookups = counters['hits'] + counters['misses']
+        return {
+            **counters,
+            'hit_rate': round(counters['hits'] / lookups, 4) if lookups else 0.0,
+            'entries': len(self._entries),
+            'scopes': scopes,
+        }
@@ -0,0 +1,503 @@
+"""
+In-memory CSR backend for read-only graph analytics
+Loads the User / IPAddress / Email / City relations straight from the
+users and user_locations tables (no AGE needed) into compressed sparse
+row adjacency arrays, with every key interned to a dense integer id, and
+answers the shared-IP, city-mismatch and neighborhood queries of
+graph_utils in memory. Each refresh only reads the rows added since the
+previous one, plus the last GRAPH_CSR_RESCAN_ROWS ids below that mark:
+ids are assigned at insert, not commit, so a row can become visible after
+a higher id was already loaded. Re-read rows are recognized by id and not
+counted twice. Rows committed later than that window are only picked up by
+a full refresh. Enable it with GRAPH_BACKEND=csr.
+
+USED_IP is kept as one edge per (user, IP) with first_seen, last_seen and
+order_count, as in GRAPH_AGGREGATE_USED_IP graphs, so a time window
+matches an edge on its last_seen. Edits to existing users (city, email)
+are only picked up by a full refresh.
+"""
+import threading
+import time
+from itertools import permutations
+import numpy as np
+import psycopg2
+from config import Config
+from graph_pool import connection_params
+
+ORDER_LOCATIONS_SQL = """
+    SELECT id, user_id, ip_address, COALESCE(city, 'Unknown'),
+           EXTRACT(EPOCH FROM timestamp)::bigint
+    FROM user_locations
+    WHERE action = 'order' AND id > %s
+    ORDER BY id
+"""
+
+USERS_SQL = """
+    SELECT id, username, email, city
+    FROM users
+    WHERE id > %s
+    ORDER BY id
+"""
+
+# (row, column) pairs are packed into one int64 so edges sort and dedupe as numbers
+_SHIFT = 32
+_MASK = (1 << _SHIFT) - 1
+
+
+class Interner:
+    """Dense integer ids for string keys, in first-seen order"""
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def intern(self, key):
+        idx = self.ids.get(key)
+        if idx is None:
+            idx = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return idx
+
+    def get(self, key, limit=None):
+        """Id of key, or None if unknown (or not below limit)"""
+        idx = self.ids.get(key)
+        if idx is None or (limit is not None and idx >= limit):
+            return None
+        return idx
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CSR:
+    """Sparse adjacency: row i's neighbors are indices[indptr[i]:indptr[i + 1]], with optional data"""
+
+    def __init__(self, indptr, indices, data=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self._row_ids = None
+
+    @classmethod
+    def from_sorted(cls, rows, cols, n_rows, data=None):
+        """Build from COO arrays already sorted by row"""
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        return cls(indptr, cols, data)
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def row_data(self, i):
+        return self.data[self.indptr[i]:self.indptr[i + 1]]
+
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    def row_ids(self):
+        """Row of every stored entry (the COO row array), computed once"""
+        if self._row_ids is None:
+            self._row_ids = np.repeat(np.arange(len(self.indptr) - 1), self.degrees())
+        return self._row_ids
+
+    def expand(self, rows):
+        """(position in rows, neighbor) for every neighbor of each given row"""
+        counts = self.indptr[rows + 1] - self.indptr[rows]
+        owners = np.repeat(np.arange(len(rows)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return owners, self.indices[np.repeat(self.indptr[rows], counts) + offsets]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.indptr, self.indices, self.data) if a is not None)
+
+
+def _window_mask(seen, since, until):
+    mask = np.ones(len(seen), dtype=bool)
+    if since is not None:
+        mask &= seen >= int(since)
+    if until is not None:
+        mask &= seen < int(until)
+    return mask
+
+
+def _merge_used_ip(keys, first, last, count):
+    """Collapse duplicate (user, IP) keys: earliest first_seen, latest last_seen, summed count"""
+    if not len(keys):
+        return keys, first, last, count
+    order = np.argsort(keys, kind='stable')
+    keys, first, last, count = keys[order], first[order], last[order], count[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return (keys[starts], np.minimum.reduceat(first, starts),
+            np.maximum.reduceat(last, starts), np.add.reduceat(count, starts))
+
+
+def parse_allowlist(value):
+    """'Label:key,Label:key' -> {label: {key, ...}} (as GRAPH_SUPERNODE_ALLOWLIST)"""
+    allowlist = {}
+    for item in value.split(','):
+        label, _, key = item.strip().partition(':')
+        if label and key:
+            allowlist.setdefault(label, set()).add(key)
+    return allowlist
+
+
+class CSRSnapshot:
+    """
+    Read-only view of the graph at one refresh. Query methods return the
+    same shapes as their graph_utils counterparts. Its arrays are never
+    modified; the interners are shared with the loader, which only appends
+    to them, so the snapshot looks up ids below its own n_* counts only.
+    """
+
+    def __init__(self, users, ips, cities, emails, user_city, user_email,
+                 used_ip, from_city, threshold, allowlist):
+        self.users, self.ips, self.cities, self.emails = users, ips, cities, emails
+        self.n_users, self.n_ips, self.n_cities = len(users), len(ips), len(cities)
+        self.n_emails = len(emails)
+        self.user_city = user_city
+        self.user_email = user_email
+
+        keys, first, last, count = used_ip
+        user_of, ip_of = keys >> _SHIFT, keys & _MASK
+        self.user_ips = CSR.from_sorted(user_of, ip_of, self.n_users, last)
+        by_ip = np.lexsort((user_of, ip_of))
+        self.ip_users = CSR.from_sorted(ip_of[by_ip], user_of[by_ip], self.n_ips, last[by_ip])
+        self.order_count = int(count.sum())
+
+        ip_of, city_of = from_city >> _SHIFT, from_city & _MASK
+        self.ip_cities = CSR.from_sorted(ip_of, city_of, self.n_ips)
+        by_city = np.lexsort((ip_of, city_of))
+        self.city_ips = CSR.from_sorted(city_of[by_city], ip_of[by_city], self.n_cities)
+
+        # Degrees as graph_degrees.py counts them: distinct users of an IP;
+        # FROM_CITY plus REGISTERED_IN edges of a city
+        self.ip_degree = self.ip_users.degrees()
+        self.city_degree = self.city_ips.degrees() + np.bincount(user_city, minlength=self.n_cities)
+        self.ip_supernode = self._supernodes(self.ip_degree, threshold, ips, allowlist.get('IPAddress', ()))
+        self.city_supernode = self._supernodes(self.city_degree, threshold, cities, allowlist.get('City', ()))
+
+    def _supernodes(self, degree, threshold, interner, allowed):
+        flags = degree >= threshold
+        for key in allowed:
+            idx = interner.get(key, len(degree))
+            if idx is not None:
+                flags[idx] = True
+        return flags
+
+    def _ip_mask(self, include_supernodes):
+        return np.ones(self.n_ips, dtype=bool) if include_supernodes else ~self.ip_supernode
+
+    def user_graph(self, username, since=None, until=None):
+        """(username, ip, city) for each IP the user ordered from, as query_user_graph"""
+        user = self.users.get(username, self.n_users)
+        if user is None:
+            return []
+        ips = self.user_ips.row(user)[_window_mask(self.user_ips.row_data(user), since, until)]
+        return [(username, self.ips.keys[ip], self.cities.keys[city])
+                for ip in ips for city in self.ip_cities.row(ip)]
+
+    def neighbors(self, label, key, since=None, until=None):
+        """One-hop neighborhood of a vertex: [{'edge', 'direction', 'label', 'key'}]"""
+        def rows(edge, direction, other, interner, ids):
+            return [{'edge': edge, 'direction': direction, 'label': other, 'key': interner.keys[i]}
+                    for i in ids]
+
+        if label == 'User':
+            user = self.users.get(key, self.n_users)
+            if user is None:
+                return []
+            ips = self.user_ips.row(user)[_window_mask(self.user_ips.row_data(user), since, until)]
+            return (rows('USED_IP', 'out', 'IPAddress', self.ips, ips)
+                    + rows('HAS_EMAIL', 'out', 'Email', self.emails, [self.user_email[user]])
+                    + rows('REGISTERED_IN', 'out', 'City', self.cities, [self.user_city[user]]))
+        if label == 'IPAddress':
+            ip = self.ips.get(key, self.n_ips)
+            if ip is None:
+                return []
+            users = self.ip_users.row(ip)[_window_mask(self.ip_users.row_data(ip), since, until)]
+            return (rows('USED_IP', 'in', 'User', self.users, users)
+                    + rows('FROM_CITY', 'out', 'City', self.cities, self.ip_cities.row(ip)))
+        if label == 'City':
+            city = self.cities.get(key, self.n_cities)
+            if city is None:
+                return []
+            return (rows('FROM_CITY', 'in', 'IPAddress', self.ips, self.city_ips.row(city))
+                    + rows('REGISTERED_IN', 'in', 'User', self.users, np.flatnonzero(self.user_city == city)))
+        if label == 'Email':
+            email = self.emails.get(key, self.n_emails)
+            if email is None:
+                return []
+            return rows('HAS_EMAIL', 'in', 'User', self.users, np.flatnonzero(self.user_email == email))
+        raise ValueError(f"unknown vertex label: {label}")
+
+    def _windowed_ip_users(self, since, until):
+        """(ip, user, last_seen) of the USED_IP edges in the window, grouped by IP"""
+        mask = _window_mask(self.ip_users.data, since, until)
+        return self.ip_users.row_ids()[mask], self.ip_users.indices[mask], self.ip_users.data[mask]
+
+    def shared_ips(self, since=None, until=None, include_supernodes=False):
+        """(user1, user2, ip) for every ordered pair of users on the same IP, as SHARED_IPS"""
+        ip_of, user_of, _ = self._windowed_ip_users(since, until)
+        counts = np.bincount(ip_of, minlength=self.n_ips)
+        starts = np.r_[0, np.cumsum(counts)]
+        results = []
+        for ip in np.flatnonzero((counts >= 2) & self._ip_mask(include_supernodes)):
+            names = [self.users.keys[u] for u in user_of[starts[ip]:starts[ip + 1]]]
+            address = self.ips.keys[ip]
+            results += [(u1, u2, address) for u1, u2 in permutations(names, 2)]
+        return results
+
+    def city_mismatches(self, since=None, until=None, include_supernodes=False):
+        """(username, registered_city, detected_city, ip) as CITY_MISMATCHES"""
+        mask = _window_mask(self.user_ips.data, since, until)
+        user_of, ip_of = self.user_ips.row_ids()[mask], self.user_ips.indices[mask]
+        edge, city = self.ip_cities.expand(ip_of)
+        user_of, ip_of = user_of[edge], ip_of[edge]
+        keep = city != self.user_city[user_of]
+        if not include_supernodes:
+            keep &= ~(self.ip_supernode[ip_of] | self.city_supernode[city])
+        users, cities, ips = self.users.keys, self.cities.keys, self.ips.keys
+        return [(users[u], cities[self.user_city[u]], cities[c], ips[i])
+                for u, c, i in zip(user_of[keep], city[keep], ip_of[keep])]
+
+    def shared_ip_groups(self, limit=20, rank='users', sample_size=5, min_users=2, since=None, until=None,
+                         include_supernodes=False):
+        """Top IPs by user count or recency, as top_shared_ips"""
+        ip_of, user_of, seen = self._windowed_ip_users(since, until)
+        counts = np.bincount(ip_of, minlength=self.n_ips)
+        starts = np.r_[0, np.cumsum(counts)]
+        last_seen = np.zeros(self.n_ips, dtype=np.int64)
+        present = np.flatnonzero(counts)
+        if len(present):
+            last_seen[present] = np.maximum.reduceat(seen, starts[present])
+
+        candidates = np.flatnonzero((counts >= min_users) & self._ip_mask(include_supernodes))
+        addresses = np.array([self.ips.keys[ip] for ip in candidates], dtype=str)
+        count, recent = -counts[candidates], -last_seen[candidates]
+        keys = (addresses, recent, count) if rank == 'users' else (addresses, count, recent)
+        top = candidates[np.lexsort(keys)[:limit]]
+        return [{
+            'ip': self.ips.keys[ip],
+            'user_count': int(counts[ip]),
+            'users': [self.users.keys[u] for u in user_of[starts[ip]:starts[ip] + min(sample_size, counts[ip])]],
+            'last_seen': int(last_seen[ip]),
+        } for ip in top]
+
+    def count_shared_ips(self, min_users=2, include_supernodes=False):
+        """Number of IPs used by at least min_users users"""
+        return int(np.count_nonzero((self.ip_degree >= min_users) & self._ip_mask(include_supernodes)))
+
+    def supernodes(self, sample_size=20):
+        """Supernode IPs and cities with a sample of neighbors, as list_supernodes"""
+        found = [('IPAddress', ip, int(self.ip_degree[ip]), self.ip_users.row(ip), self.users)
+                 for ip in np.flatnonzero(self.ip_supernode)]
+        found += [('City', city, int(self.city_degree[city]), self.city_ips.row(city), self.ips)
+                  for city in np.flatnonzero(self.city_supernode)]
+        found.sort(key=lambda item: -item[2])
+        interners = {'IPAddress': self.ips, 'City': self.cities}
+        return [{
+            'label': label,
+            'key': interners[label].keys[idx],
+            'degree': degree,
+            'sample': [neighbors.keys[n] for n in sample[:sample_size]],
+        } for label, idx, degree, sample, neighbors in found]
+
+    def stats(self):
+        arrays = (self.user_ips, self.ip_users, self.ip_cities, self.city_ips)
+        return {
+            'users': self.n_users,
+            'ips': self.n_ips,
+            'cities': self.n_cities,
+            'emails': self.n_emails,
+            'used_ip_edges': len(self.user_ips.indices),
+            'from_city_edges': len(self.ip_cities.indices),
+            'orders': self.order_count,
+            'supernodes': int(self.ip_supernode.sum() + self.city_supernode.sum()),
+            'array_bytes': sum(csr.nbytes for csr in arrays) + self.user_city.nbytes + self.user_email.nbytes,
+        }
+
+
+class CSRGraph:
+    """
+    Accumulates rows from the relational tables and publishes a new
+    CSRSnapshot after each refresh; readers keep using the previous one
+    meanwhile.
+    """
+
+    def __init__(self, batch_size=None, threshold=None, allowlist=None, rescan_rows=None):
+        self.batch_size = batch_size or Config.GRAPH_CSR_BATCH_SIZE
+        self.rescan_rows = Config.GRAPH_CSR_RESCAN_ROWS if rescan_rows is None else rescan_rows
+        self.threshold = Config.GRAPH_SUPERNODE_DEGREE if threshold is None else threshold
+        self.allowlist = parse_allowlist(Config.GRAPH_SUPERNODE_ALLOWLIST if allowlist is None else allowlist)
+        self._lock = threading.Lock()
+        self.snapshot = None
+        self.refreshed_at = None
+        self._reset()
+
+    def _reset(self):
+        self.users, self.ips, self.cities, self.emails = Interner(), Interner(), Interner(), Interner()
+        self._user_index = np.full(0, -1, dtype=np.int64)  # users.id -> user id
+        self._user_city = []
+        self._user_email = []
+        empty = np.empty(0, dtype=np.int64)
+        self._used_ip = (empty, empty, empty, empty)
+        self._from_city = empty
+        self._recent_location_ids = empty  # Loaded ids within rescan_rows of the mark
+        self.last_location_id = 0
+        self.last_user_id = 0
+
+    def refresh(self, full=False):
+        """Read the rows added since the last refresh (all of them if full) and publish a snapshot"""
+        with self._lock:
+            return self._refresh(full)
+
+    def refresh_if_older(self, max_age):
+        """
+        Refresh when the snapshot is older than max_age seconds. Only the
+        first load blocks: while another thread refreshes, readers keep the
+        current snapshot.
+        """
+        if self.snapshot is None:
+            with self._lock:
+                return self._refresh() if self.snapshot is None else None
+        if time.monotonic() - self.refreshed_at < max_age or not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def _refresh(self, full=False):
+        if full:
+            self._reset()
+        started = time.monotonic()
+        conn = psycopg2.connect(**connection_params())
+        try:
+            # Locations first: every user they reference is then in the users read.
+            # Both re-read the ids just below their mark, for late commits.
+            locations = list(self._fetch(conn, ORDER_LOCATIONS_SQL,
+                                         max(self.last_location_id - self.rescan_rows, 0)))
+            users = list(self._fetch(conn, USERS_SQL, max(self.last_user_id - self.rescan_rows, 0)))
+        finally:
+            conn.close()
+        added = self._add(users, locations)
+        self.refreshed_at = time.monotonic()
+        added['seconds'] = round(self.refreshed_at - started, 3)
+        return added
+
+    def _fetch(self, conn, sql, after_id):
+        """Batches of rows past after_id, read with a server-side cursor"""
+        cursor = conn.cursor(name='graph_csr_load')
+        cursor.itersize = self.batch_size
+        cursor.execute(sql, (after_id,))
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+    def add_rows(self, users, locations):
+        """
+        Add users (id, username, email, city) and order locations
+        (id, user_id, ip_address, city, epoch seconds) without a database,
+        e.g. for benchmarks; each argument is a list of row batches.
+        """
+        with self._lock:
+            added = self._add(users, locations)
+            self.refreshed_at = time.monotonic()
+            return added
+
+    def _add(self, user_batches, location_batches):
+        new_users = 0
+        for rows in user_batches:
+            top = rows[-1][0]
+            if top >= len(self._user_index):
+                grown = np.full(max(top + 1, 2 * len(self._user_index)), -1, dtype=np.int64)
+                grown[:len(self._user_index)] = self._user_index
+                self._user_index = grown
+            for user_id, username, email, city in rows:
+                idx = self.users.intern(username)
+                self._user_index[user_id] = idx
+                if idx == len(self._user_city):
+                    self._user_city.append(0)
+                    self._user_email.append(0)
+                    new_users += 1
+                self._user_city[idx] = self.cities.intern(city)
+                self._user_email[idx] = self.emails.intern(email)
+            self.last_user_id = max(self.last_user_id, top)
+
+        chunks = []
+        for rows in location_batches:
+            ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            ips = np.fromiter((self.ips.intern(row[2]) for row in rows), dtype=np.int64, count=len(rows))
+            cities = np.fromiter((self.cities.intern(row[3]) for row in rows), dtype=np.int64, count=len(rows))
+            user_ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+            seen = np.fromiter((row[4] or 0 for row in rows), dtype=np.int64, count=len(rows))
+            chunks.append((ids, user_ids, ips, cities, seen))
+            self.last_location_id = max(self.last_location_id, rows[-1][0])
+
+        new_locations = skipped = 0
+        if chunks:
+            ids, user_ids, ips, cities, seen = (np.concatenate(parts) for parts in zip(*chunks))
+            known = user_ids < len(self._user_index)
+            users = np.full(len(user_ids), -1, dtype=np.int64)
+            users[known] = self._user_index[user_ids[known]]
+            # Locations of deleted users are dropped, re-read ones already counted
+            fresh = ~np.isin(ids, self._recent_location_ids)
+            valid = (users >= 0) & fresh
+            skipped = int(fresh.sum() - valid.sum())
+            ids, users, ips, cities, seen = ids[valid], users[valid], ips[valid], cities[valid], seen[valid]
+            new_locations = len(users)
+            recent = np.union1d(self._recent_location_ids, ids)
+            self._recent_location_ids = recent[recent > self.last_location_id - self.rescan_rows]
+
+            keys, first, last, count = self._used_ip
+            self._used_ip = _merge_used_ip(
+                np.concatenate([keys, (users << _SHIFT) | ips]),
+                np.concatenate([first, seen]),
+                np.concatenate([last, seen]),
+                np.concatenate([count, np.ones(len(users), dtype=np.int64)]),
+            )
+            self._from_city = np.union1d(self._from_city, (ips << _SHIFT) | cities)
+
+        if new_users or new_locations or self.snapshot is None:
+            self.snapshot = CSRSnapshot(
+                self.users, self.ips, self.cities, self.emails,
+                np.array(self._user_city, dtype=np.int64), np.array(self._user_email, dtype=np.int64),
+                self._used_ip, self._from_city, self.threshold, self.allowlist
+            )
+        return {'users': new_users, 'locations': new_locations, 'skipped': skipped}
+
+    def stats(self):
+        """Snapshot sizes and load position, or None before the first load"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        return {
+            **snapshot.stats(),
+            'last_location_id': self.last_location_id,
+            'last_user_id': self.last_user_id,
+            'age': round(time.monotonic() - self.refreshed_at, 1),
+        }
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_csr_graph():
+    """Process-wide CSR graph, loaded on first use"""
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = CSRGraph()
+        return _graph
+
+
+def csr_snapshot():
+    """Current snapshot, refreshed first if older than GRAPH_CSR_REFRESH_INTERVAL seconds"""
+    graph = get_csr_graph()
+    graph.refresh_if_older(Config.GRAPH_CSR_REFRESH_INTERVAL)
+    return graph.snapshot
@@ -0,0 +1,181 @@
+"""
+Degree statistics for high-fan-in graph vertices
+Counts the edges of every IPAddress (distinct users on USED_IP) and City
+(FROM_CITY and REGISTERED_IN) vertex and stores them as `degree` and
+`supernode` properties. Vertices at or above GRAPH_SUPERNODE_DEGREE, or
+listed in GRAPH_SUPERNODE_ALLOWLIST, are supernodes: fraud queries in
+graph_utils skip their neighborhoods, or only sample them, depending on
+GRAPH_SUPERNODE_POLICY. Only vertices whose values changed are updated.
+
+With GRAPH_DEGREES_ON_WRITE, graph writes that create vertices or edges
+also recount the IPs and cities they touched (update_written_degrees), so
+a vertex is flagged as soon as it becomes a supernode. The refresh is
+still needed after prune_graph.py (removing edges lowers degrees) and to
+correct the degree of vertices already flagged, which writes skip.
+
+Usage:
+    python graph_degrees.py                  # refresh restaurant_graph
+    python graph_degrees.py --threshold 200 --dry-run
+
+With GRAPH_SHARDING, the default refreshes every region shard instead.
+"""
+import argparse
+import json
+import time
+from config import Config
+from graph_pool import graph_connection
+from graph_utils import GRAPH_NAME, GRAPH_VERTEX_KEYS, read_graphs
+
+# Vertex label -> SQL giving (vertex id, degree) for the vertices with edges
+DEGREE_RULES = {
+    'IPAddress': 'SELECT end_id AS id, COUNT(DISTINCT start_id) AS degree FROM {graph}."USED_IP" GROUP BY end_id',
+    'City': """
+        SELECT id, SUM(n) AS degree FROM (
+            SELECT end_id AS id, COUNT(*) AS n FROM {graph}."FROM_CITY" GROUP BY end_id
+            UNION ALL
+            SELECT end_id AS id, COUNT(*) AS n FROM {graph}."REGISTERED_IN" GROUP BY end_id
+        ) e GROUP BY id
+    """,
+}
+
+REFRESH_DEGREES_SQL = """
+    WITH degrees AS ({degrees}), stats AS (
+        SELECT v.id, coalesce(d.degree, 0) AS degree,
+               coalesce(d.degree, 0) >= %(threshold)s
+                   OR v.properties::text::jsonb->>%(key)s = ANY(%(allowlist)s::text[]) AS supernode
+        FROM {graph}."{label}" v
+        LEFT JOIN degrees d ON d.id = v.id
+    ), updated AS (
+        UPDATE {graph}."{label}" v
+        SET properties = (v.properties::text::jsonb
+                          || jsonb_build_object('degree', s.degree, 'supernode', s.supernode))::text::agtype
+        FROM stats s
+        WHERE v.id = s.id
+          AND ((v.properties::text::jsonb->'degree') IS DISTINCT FROM to_jsonb(s.degree)
+               OR (v.properties::text::jsonb->'supernode') IS DISTINCT FROM to_jsonb(s.supernode))
+        RETURNING s.supernode
+    )
+    SELECT (SELECT COUNT(*) FROM updated),
+           (SELECT COUNT(*) FROM stats WHERE supernode)
+"""
+
+
+# Vertex label -> SQL giving the degree of vertex v, counted as in DEGREE_RULES
+VERTEX_DEGREE_RULES = {
+    'IPAddress': 'SELECT COUNT(DISTINCT start_id) FROM {graph}."USED_IP" WHERE end_id = v.id',
+    'City': """
+        SELECT (SELECT COUNT(*) FROM {graph}."FROM_CITY" WHERE end_id = v.id)
+             + (SELECT COUNT(*) FROM {graph}."REGISTERED_IN" WHERE end_id = v.id)
+    """,
+}
+
+# Recount the given vertices, unless already supernodes. Vertices another
+# writer has locked are skipped rather than waited for: that writer
+# recounts them itself.
+UPDATE_WRITTEN_DEGREES_SQL = """
+    WITH stats AS (
+        SELECT v.id, d.degree,
+               d.degree >= %(threshold)s
+                   OR v.properties::text::jsonb->>%(key)s = ANY(%(allowlist)s::text[]) AS supernode
+        FROM {graph}."{label}" v
+        CROSS JOIN LATERAL ({degree}) d(degree)
+        WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[v.properties, '"{key}"'::ag_catalog.agtype])
+              = ANY(%(keys)s::text[]::ag_catalog.agtype[])
+          AND (v.properties::text::jsonb->'supernode') IS DISTINCT FROM 'true'::jsonb
+    ), changed AS (
+        SELECT v.id FROM {graph}."{label}" v
+        JOIN stats s ON s.id = v.id
+        WHERE (v.properties::text::jsonb->'degree') IS DISTINCT FROM to_jsonb(s.degree)
+           OR (v.properties::text::jsonb->'supernode') IS DISTINCT FROM to_jsonb(s.supernode)
+        ORDER BY v.id
+        FOR UPDATE OF v SKIP LOCKED
+    )
+    UPDATE {graph}."{label}" v
+    SET properties = (v.properties::text::jsonb
+                      || jsonb_build_object('degree', s.degree, 'supernode', s.supernode))::text::agtype
+    FROM stats s
+    JOIN changed c ON c.id = s.id
+    WHERE v.id = s.id
+"""
+
+
+def supernode_allowlist(value=None):
+    """Parse 'Label:key,Label:key' into {label: [key, ...]}"""
+    allowlist = {}
+    for item in (Config.GRAPH_SUPERNODE_ALLOWLIST if value is None else value).split(','):
+        label, _, key = item.strip().partition(':')
+        if label in DEGREE_RULES and key:
+            allowlist.setdefault(label, []).append(key)
+    return allowlist
+
+
+def refresh_degrees(graph_name=GRAPH_NAME, threshold=None, allowlist=None, dry_run=False):
+    """
+    Recompute degree / supernode properties; returns
+    {label: (vertices updated, supernodes)}
+    """
+    threshold = Config.GRAPH_SUPERNODE_DEGREE if threshold is None else threshold
+    allowlist = supernode_allowlist() if allowlist is None else allowlist
+    results = {}
+    with graph_connection() as conn:
+        conn.autocommit = False
+        cursor = conn.cursor()
+        try:
+            for label, degrees in DEGREE_RULES.items():
+                cursor.execute(
+                    REFRESH_DEGREES_SQL.format(graph=graph_name, label=label,
+                                               degrees=degrees.format(graph=graph_name)),
+                    {'threshold': threshold, 'key': GRAPH_VERTEX_KEYS[label],
+                     'allowlist': allowlist.get(label, [])}
+                )
+                results[label] = cursor.fetchone()
+                # One short transaction per label
+                if dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+        finally:
+            cursor.close()
+    return results
+
+
+def update_written_degrees(cursor, events, graph_name=GRAPH_NAME):
+    """Recount the degree / supernode properties of the IPs and cities of just-written events"""
+    keys = {
+        'IPAddress': sorted({event['ip_address'] for event in events}),
+        'City': sorted({event['city_detected'] for event in events} | {event['user_city'] for event in events}),
+    }
+    allowlist = supernode_allowlist()
+    for label, degree in VERTEX_DEGREE_RULES.items():
+        cursor.execute(
+            UPDATE_WRITTEN_DEGREES_SQL.format(graph=graph_name, label=label,
+                                              key=GRAPH_VERTEX_KEYS[label],
+                                              degree=degree.format(graph=graph_name)),
+            {'threshold': Config.GRAPH_SUPERNODE_DEGREE, 'key': GRAPH_VERTEX_KEYS[label],
+             'allowlist': allowlist.get(label, []), 'keys': [json.dumps(key) for key in keys[label]]}
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh vertex degrees and supernode flags')
+    parser.add_argument('--graph', default=GRAPH_NAME)
+    parser.add_argument('--threshold', type=int, default=Config.GRAPH_SUPERNODE_DEGREE,
+                        help='edges from which a vertex is a supernode')
+    parser.add_argument('--dry-run', action='store_true', help='count the changes, then roll back')
+    args = parser.parse_args()
+    graphs = read_graphs() if args.graph == GRAPH_NAME else [args.graph]
+
+    started = time.monotonic()
+    for graph_name in graphs:
+        print("=" * 70)
+        print(f"Refreshing vertex degrees of '{graph_name}' (supernode threshold {args.threshold})"
+              + (" (dry run)" if args.dry_run else ""))
+        print("=" * 70)
+        for label, (updated, supernodes) in refresh_degrees(graph_name, args.threshold,
+                                                             dry_run=args.dry_run).items():
+            print(f"  {label:<12} {updated:>10} updated  {supernodes:>6} supernodes")
+    print(f"✓ Done in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
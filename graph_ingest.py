@@ -0,0 +1,185 @@
+"""
+Background graph ingestion for checkout
+Order events are queued in-process and written to Apache AGE by a worker
+thread in merged batches, so requests never wait on graph writes. A batch
+that keeps failing is stored in graph_outbox for graph_outbox.py to write.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from config import Config
+from graph_outbox import enqueue_order_events
+from graph_utils import add_orders_to_graph, merge_order_events
+
+
+class GraphIngestWorker:
+    """Bounded queue of order events drained in batches by one worker thread"""
+
+    def __init__(self, max_queue=10000, batch_size=200, flush_interval=0.5, put_timeout=0.05,
+                 retries=3, retry_backoff=0.5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'enqueued': 0,
+            'rejected': 0,
+            'written': 0,
+            'retried': 0,
+            'outboxed': 0,
+            'failed': 0,
+            'batches': 0,
+            'merged': 0,
+        }
+        self._flush_ms_total = 0.0
+        self._flush_ms_last = 0.0
+        self._flush_ms_max = 0.0
+
+    def start(self):
+        """Start the worker thread if it is not running"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='graph-ingest', daemon=True)
+                self._thread.start()
+
+    def submit(self, event):
+        """
+        Queue an event for the worker.
+        Returns False when the queue stays full for put_timeout seconds, so
+        the caller can apply backpressure instead of losing the event.
+        """
+        if self._stopping.is_set():
+            return False
+        self.start()
+        try:
+            self._queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('enqueued')
+        return True
+
+    def stop(self, timeout=10):
+        """Stop accepting events and drain what is already queued"""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=max(remaining, 0.01)))
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    self._flush(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+            if self._stopping.is_set() and self._queue.empty():
+                if batch:
+                    self._flush(batch)
+                return
+
+    def _flush(self, batch):
+        events = merge_order_events(batch)
+        start = time.perf_counter()
+        ok = add_orders_to_graph(events)
+        for attempt in range(self.retries):
+            if ok:
+                break
+            self._count('retried')
+            time.sleep(self.retry_backoff * 2 ** attempt)
+            ok = add_orders_to_graph(events)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        outcome = 'written' if ok else self._park(batch)
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['merged'] += len(batch) - len(events)
+            self._counters[outcome] += len(batch)
+            self._flush_ms_total += elapsed_ms
+            self._flush_ms_last = elapsed_ms
+            self._flush_ms_max = max(self._flush_ms_max, elapsed_ms)
+
+    def _park(self, batch):
+        """Hand a batch the graph keeps rejecting to the outbox; returns the counter to bump"""
+        try:
+            enqueue_order_events(batch)
+            return 'outboxed'
+        except Exception as e:
+            print(f"Warning: Could not store {len(batch)} order events in the graph outbox: {e}")
+            return 'failed'
+
+    def stats(self):
+        """Queue depth, event counters and flush latency"""
+        with self._lock:
+            batches = self._counters['batches']
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self._queue.maxsize,
+                **self._counters,
+                'flush_ms_last': round(self._flush_ms_last, 2),
+                'flush_ms_avg': round(self._flush_ms_total / batches, 2) if batches else 0.0,
+                'flush_ms_max': round(self._flush_ms_max, 2),
+            }
+
+
+_worker = None
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+
+def get_ingest_worker():
+    """Process-wide ingestion worker, created on first use (and again after a fork)"""
+    global _worker, _worker_pid
+    with _worker_lock:
+        if _worker is None or _worker_pid != os.getpid():
+            _worker = GraphIngestWorker(
+                max_queue=Config.GRAPH_INGEST_QUEUE_SIZE,
+                batch_size=Config.GRAPH_INGEST_BATCH_SIZE,
+                flush_interval=Config.GRAPH_INGEST_FLUSH_INTERVAL,
+                put_timeout=Config.GRAPH_INGEST_PUT_TIMEOUT,
+                retries=Config.GRAPH_INGEST_RETRIES,
+                retry_backoff=Config.GRAPH_INGEST_RETRY_BACKOFF
+            )
+            _worker_pid = os.getpid()
+        return _worker
+
+
+def submit_order_event(event):
+    """
+    Send an order event to the graph.
+    In 'async' mode the event is queued for the worker; when the queue is
+    full the event is written inline, which slows the caller down rather than
+    dropping it.
+    """
+    if Config.GRAPH_SYNC_MODE == 'async' and get_ingest_worker().submit(event):
+        return True
+    return add_orders_to_graph([event])
+
+
+@atexit.register
+def _drain_on_exit():
+    if _worker is not None and _worker_pid == os.getpid():
+        _worker.stop()
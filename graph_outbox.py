@@ -0,0 +1,221 @@
+"""
+Graph outbox drainer - projects graph_outbox rows into Apache AGE
+Rows are claimed in bulk with FOR UPDATE SKIP LOCKED, written to the graph
+and deleted in one transaction, so any number of drainer threads or
+processes can run side by side without double-processing or losing events.
+A row that cannot be written is retried on later passes and parked after
+GRAPH_OUTBOX_MAX_ATTEMPTS failures; the rows claimed with it still go through.
+
+Usage:
+    python graph_outbox.py --workers 4
+    python graph_outbox.py --once
+"""
+import argparse
+import json
+import threading
+import time
+from config import Config
+from graph_pool import graph_connection
+from graph_alerts import emit_alerts
+from graph_utils import known_elements, merge_order_events, write_order_events
+
+CLAIM_SQL = """
+    SELECT id, payload FROM graph_outbox
+    WHERE attempts < %s
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+LAG_SQL = """
+    SELECT
+        COUNT(*) FILTER (WHERE attempts < %(max_attempts)s),
+        COUNT(*) FILTER (WHERE attempts >= %(max_attempts)s),
+        EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'utc')
+                - MIN(created_at) FILTER (WHERE attempts < %(max_attempts)s))
+    FROM graph_outbox
+"""
+
+
+def drain_batch(batch_size=None, max_attempts=None):
+    """
+    Claim up to batch_size pending rows, project them into the graph and
+    delete them, all in one transaction. Returns the number of rows drained.
+    If the batch write fails, its rows are retried one at a time, so only
+    the rows that fail on their own have their attempts counted.
+    """
+    batch_size = batch_size or Config.GRAPH_OUTBOX_BATCH_SIZE
+    max_attempts = max_attempts or Config.GRAPH_OUTBOX_MAX_ATTEMPTS
+
+    with graph_connection() as conn:
+        conn.autocommit = False
+        cursor = conn.cursor()
+        try:
+            cursor.execute(CLAIM_SQL, (max_attempts, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                return 0
+
+            try:
+                written, alerts = [row[0] for row in rows], _write_rows(cursor, rows)
+                failed = []
+            except Exception:
+                written, failed, alerts = [], [], []
+                # Ids cached by the rolled back write may not exist
+                known_elements.invalidate()
+                for row in rows:
+                    try:
+                        alerts += _write_rows(cursor, [row])
+                        written.append(row[0])
+                    except Exception as e:
+                        known_elements.invalidate()
+                        failed.append((row[0], str(e)))
+
+            cursor.execute("DELETE FROM graph_outbox WHERE id = ANY(%s)", (written,))
+            for row_id, error in failed:
+                # Counted so a poison row is eventually parked, without its batch
+                cursor.execute(
+                    "UPDATE graph_outbox SET attempts = attempts + 1, last_error = %s WHERE id = %s",
+                    (error, row_id)
+                )
+                print(f"Warning: graph outbox row {row_id} failed: {error}")
+            conn.commit()
+            emit_alerts(alerts)
+            return len(written)
+
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+def enqueue_order_events(events):
+    """
+    Store order events in graph_outbox for the drainer, e.g. when the
+    ingestion worker could not write them. Raises if they cannot be stored.
+    """
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.executemany(
+                "INSERT INTO graph_outbox (event_type, payload, attempts, created_at) "
+                "VALUES ('order', %s::json, 0, now() AT TIME ZONE 'utc')",
+                [(json.dumps(event),) for event in events]
+            )
+        finally:
+            cursor.close()
+
+
+def _write_rows(cursor, rows):
+    """Write outbox rows under a savepoint, so a failure leaves the claim intact"""
+    cursor.execute("SAVEPOINT outbox_write")
+    try:
+        alerts = write_order_events(cursor, merge_order_events([row[1] for row in rows]), check=True)
+    except Exception:
+        cursor.execute("ROLLBACK TO SAVEPOINT outbox_write")
+        raise
+    cursor.execute("RELEASE SAVEPOINT outbox_write")
+    return alerts
+
+
+def outbox_lag(max_attempts=None):
+    """Pending and parked row counts, and the age in seconds of the oldest pending row"""
+    max_attempts = max_attempts or Config.GRAPH_OUTBOX_MAX_ATTEMPTS
+    try:
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(LAG_SQL, {'max_attempts': max_attempts})
+            pending, parked, oldest = cursor.fetchone()
+            cursor.close()
+        return {
+            'pending': pending,
+            'parked': parked,
+            'lag_seconds': round(float(oldest), 3) if oldest is not None else 0.0
+        }
+    except Exception as e:
+        print(f"Error reading outbox lag: {e}")
+        return {'pending': None, 'parked': None, 'lag_seconds': None}
+
+
+class OutboxDrainer:
+    """Runs drain_batch in a loop on several threads"""
+
+    def __init__(self, workers=1, batch_size=None, poll_interval=None):
+        self.workers = workers
+        self.batch_size = batch_size or Config.GRAPH_OUTBOX_BATCH_SIZE
+        self.poll_interval = poll_interval or Config.GRAPH_OUTBOX_POLL_INTERVAL
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.drained = 0
+        self.errors = 0
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                count = drain_batch(self.batch_size)
+            except Exception as e:
+                print(f"Error draining graph outbox: {e}")
+                with self._lock:
+                    self.errors += 1
+                count = 0
+
+            with self._lock:
+                self.drained += count
+            if count < self.batch_size:
+                self._stopping.wait(self.poll_interval)
+
+    def run(self, report_interval=10):
+        """Drain until interrupted, printing throughput and lag periodically"""
+        threads = [
+            threading.Thread(target=self._work, name=f'outbox-drainer-{i}', daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            last_drained, last_time = 0, time.monotonic()
+            while True:
+                time.sleep(report_interval)
+                now = time.monotonic()
+                with self._lock:
+                    drained, errors = self.drained, self.errors
+                rate = (drained - last_drained) / (now - last_time)
+                lag = outbox_lag()
+                print(f"drained={drained} rate={rate:.1f}/s errors={errors} "
+                      f"pending={lag['pending']} parked={lag['parked']} lag={lag['lag_seconds']}s")
+                last_drained, last_time = drained, now
+        except KeyboardInterrupt:
+            print("Stopping drainers...")
+        finally:
+            self._stopping.set()
+            for thread in threads:
+                thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Project graph_outbox rows into the Apache AGE graph')
+    parser.add_argument('--workers', type=int, default=1, help='parallel drainer threads')
+    parser.add_argument('--batch-size', type=int, default=Config.GRAPH_OUTBOX_BATCH_SIZE)
+    parser.add_argument('--poll-interval', type=float, default=Config.GRAPH_OUTBOX_POLL_INTERVAL)
+    parser.add_argument('--once', action='store_true', help='drain what is pending and exit')
+    args = parser.parse_args()
+
+    if args.once:
+        total = 0
+        while True:
+            count = drain_batch(args.batch_size)
+            total += count
+            if count < args.batch_size:
+                break
+        print(f"Drained {total} outbox rows. Lag: {outbox_lag()}")
+        return
+
+    print(f"Draining graph_outbox with {args.workers} worker(s)...")
+    OutboxDrainer(args.workers, args.batch_size, args.poll_interval).run()
+
+
+if __name__ == '__main__':
+    main()
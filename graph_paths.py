@@ -0,0 +1,282 @@
+"""
+Bounded link analysis between two users
+Breadth-first search from both users at once over every edge label, one
+SQL round trip per level on the label tables' start_id / end_id indexes.
+The smaller frontier is expanded first and the search stops at the first
+level where both sides meet, or when the depth, frontier or time budget
+runs out. Supernodes (graph_degrees.py) are never expanded, so a path
+only goes through one when both sides reach it.
+
+With GRAPH_SHARDING, the search runs in parallel in every region shard
+both users have been written to, and the shortest path wins. A chain that
+would only connect through two regions is not found.
+"""
+import json
+import time
+from config import Config
+from graph_cache import GraphResultCache
+from graph_pool import graph_connection
+from graph_shards import fan_out, user_shard_graphs
+from graph_utils import GRAPH_NAME, GRAPH_VERTEX_KEYS, GRAPH_EDGE_LABELS, cached_query, supernode_policy
+
+USER_IDS_SQL = """
+    SELECT properties::text::jsonb->>'username', id::text::bigint
+    FROM {graph}."User"
+    WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[properties, '"username"'::ag_catalog.agtype])
+          = ANY(%s::text[]::ag_catalog.agtype[])
+"""
+
+SUPERNODE_IDS_SQL = """
+    SELECT id::text::bigint FROM {graph}."{label}"
+    WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[properties, '"supernode"'::ag_catalog.agtype])
+          = 'true'::ag_catalog.agtype
+"""
+
+
+def neighbors_sql(graph_name, edge_labels):
+    """(vertex, neighbor, edge label, edge leaves vertex) for the vertex ids in %(ids)s"""
+    parts = []
+    for label in edge_labels:
+        table = f'{graph_name}."{label}"'
+        parts += [
+            f"SELECT start_id, end_id, '{label}', true FROM {table} WHERE start_id = ANY(%(ids)s::text[]::graphid[])",
+            f"SELECT end_id, start_id, '{label}', false FROM {table} WHERE end_id = ANY(%(ids)s::text[]::graphid[])",
+        ]
+    return ("SELECT DISTINCT v::text::bigint, n::text::bigint, label, outgoing FROM (\n    "
+            + "\n    UNION ALL ".join(parts) + "\n) e(v, n, label, outgoing)")
+
+
+def vertices_sql(graph_name, vertex_labels):
+    """(id, label, key) of the vertex ids in %(ids)s"""
+    return "\n UNION ALL ".join(
+        f"SELECT id::text::bigint, '{label}', properties::text::jsonb->>'{GRAPH_VERTEX_KEYS[label]}' "
+        f'FROM {graph_name}."{label}" WHERE id = ANY(%(ids)s::text[]::graphid[])'
+        for label in vertex_labels
+    )
+
+
+class PathTimeout(Exception):
+    """The time budget ran out; carries the partial result, which is not cached"""
+
+    def __init__(self, result):
+        super().__init__('path search timed out')
+        self.result = result
+
+
+class _Side:
+    """One direction of the search: parent links and the current frontier"""
+
+    def __init__(self, root):
+        # vertex -> (previous vertex, edge label, edge leaves previous vertex, depth)
+        self.parents = {root: (None, None, None, 0)}
+        self.frontier = [root]
+        self.depth = 0
+
+    def chain(self, vertex):
+        """Links from vertex back to the root"""
+        links = []
+        while self.parents[vertex][0] is not None:
+            previous, label, outgoing, _ = self.parents[vertex]
+            links.append((previous, vertex, label, outgoing))
+            vertex = previous
+        return links
+
+
+class PathSearch:
+    """Bidirectional BFS on one connection, within depth, frontier and time budgets"""
+
+    def __init__(self, cursor, graph_name=GRAPH_NAME, max_depth=None, timeout=None,
+                 max_frontier=None, supernodes=None):
+        self.cursor = cursor
+        self.graph_name = graph_name
+        self.max_depth = Config.GRAPH_PATH_MAX_DEPTH if max_depth is None else max_depth
+        self.deadline = time.monotonic() + (Config.GRAPH_PATH_TIMEOUT if timeout is None else timeout)
+        self.max_frontier = Config.GRAPH_PATH_MAX_FRONTIER if max_frontier is None else max_frontier
+        self.skip_supernodes = supernode_policy(supernodes) != 'include'
+        self.explored = 0
+
+        cursor.execute("""
+            SELECT l.name FROM ag_catalog.ag_label l
+            JOIN ag_catalog.ag_graph g ON g.graphid = l.graph
+            WHERE g.name = %s
+        """, (graph_name,))
+        existing = {row[0] for row in cursor.fetchall()}
+        self.vertex_labels = [label for label in GRAPH_VERTEX_KEYS if label in existing]
+        self.edge_labels = [label for label in GRAPH_EDGE_LABELS if label in existing]
+
+    def _set_budget(self):
+        """Cap the next statement at the time left; False once it is spent"""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        self.cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(remaining * 1000)),))
+        return True
+
+    def _supernodes(self):
+        if not self.skip_supernodes:
+            return set()
+        ids = set()
+        for label in ('IPAddress', 'City'):
+            if label in self.vertex_labels:
+                self.cursor.execute(SUPERNODE_IDS_SQL.format(graph=self.graph_name, label=label))
+                ids.update(row[0] for row in self.cursor.fetchall())
+        return ids
+
+    def _expand(self, side, other, supernodes):
+        """Visit the next level of side; returns the vertices where it meets other"""
+        self.cursor.execute(neighbors_sql(self.graph_name, self.edge_labels),
+                            {'ids': [str(vertex) for vertex in side.frontier]})
+        side.depth += 1
+        frontier, meets = [], []
+        for vertex, neighbor, label, outgoing in self.cursor.fetchall():
+            if neighbor in side.parents:
+                continue
+            side.parents[neighbor] = (vertex, label, outgoing, side.depth)
+            if neighbor in other.parents:
+                meets.append(neighbor)
+            elif neighbor not in supernodes:
+                frontier.append(neighbor)
+        side.frontier = frontier
+        self.explored += len(frontier) + len(meets)
+        return meets
+
+    def run(self, source, target):
+        """
+        (status, vertex ids, links) where status is 'found', 'not_found',
+        'depth_exceeded', 'frontier_exceeded' or 'timeout'
+        """
+        try:
+            return self._run(source, target)
+        except Exception as e:
+            if getattr(e, 'pgcode', None) == '57014':  # query_canceled by statement_timeout
+                return 'timeout', [], []
+            raise
+
+    def _run(self, source, target):
+        sides = (_Side(source), _Side(target))
+        if source == target:
+            return 'found', [source], []
+        if not self._set_budget():
+            return 'timeout', [], []
+        supernodes = self._supernodes()
+
+        while True:
+            if not all(side.frontier for side in sides):
+                return 'not_found', [], []
+            if sides[0].depth + sides[1].depth >= self.max_depth:
+                return 'depth_exceeded', [], []
+            if not self._set_budget():
+                return 'timeout', [], []
+
+            # Smaller frontier first; on a tie, the shallower side
+            side, other = sorted(sides, key=lambda side: (len(side.frontier), side.depth))
+            meets = self._expand(side, other, supernodes)
+
+            if meets:
+                # Every meeting vertex is side.depth hops from side's root; pick the one closest to other's
+                meet = min(meets, key=lambda vertex: other.parents[vertex][3])
+                links = list(reversed(sides[0].chain(meet))) + [
+                    (vertex, previous, label, not outgoing)
+                    for previous, vertex, label, outgoing in sides[1].chain(meet)
+                ]
+                vertices = [source] + [vertex for _, vertex, _, _ in links]
+                return 'found', vertices, links
+            if len(side.frontier) > self.max_frontier:
+                return 'frontier_exceeded', [], []
+
+    def describe(self, vertices):
+        """{vertex id: {'label', 'key'}}"""
+        if not vertices:
+            return {}
+        self.cursor.execute("SET LOCAL statement_timeout = 0")
+        self.cursor.execute(vertices_sql(self.graph_name, self.vertex_labels),
+                            {'ids': [str(vertex) for vertex in vertices]})
+        return {vertex: {'label': label, 'key': key} for vertex, label, key in self.cursor.fetchall()}
+
+
+# Outcome of a search that found nothing, most telling first: an incomplete
+# search in one shard outweighs a complete one elsewhere
+PATH_STATUSES = ['timeout', 'frontier_exceeded', 'depth_exceeded', 'not_found', 'unknown_user']
+
+
+def find_path(from_user, to_user, max_depth=None, supernodes=None, graph_name=GRAPH_NAME):
+    """
+    Shortest chain of vertices and edges linking two users, as
+    {'status', 'length', 'nodes', 'edges', 'explored', 'seconds'}.
+    Edges point into nodes by index and keep the graph's direction.
+    Cached per pair until the graph changes; timed-out searches are not cached.
+    """
+    max_depth = Config.GRAPH_PATH_MAX_DEPTH if max_depth is None else max_depth
+    policy = supernode_policy(supernodes)
+
+    def load():
+        started = time.monotonic()
+        if Config.GRAPH_SHARDING and graph_name == GRAPH_NAME:
+            from_graphs = user_shard_graphs(from_user)
+            to_graphs = user_shard_graphs(to_user)
+            shared = [name for name in from_graphs if name in to_graphs]
+            results = fan_out(shared, lambda name: _search(from_user, to_user, max_depth, policy, name))
+            if not results:
+                status = 'not_found' if from_graphs and to_graphs else 'unknown_user'
+                results = [_empty_result(from_user, to_user, max_depth, status)]
+        else:
+            results = [_search(from_user, to_user, max_depth, policy, graph_name)]
+
+        found = [result for result in results if result['status'] == 'found']
+        if found:
+            result = min(found, key=lambda result: result['length'])
+        else:
+            result = min(results, key=lambda result: PATH_STATUSES.index(result['status']))
+        result.update(explored=sum(r['explored'] for r in results),
+                      seconds=round(time.monotonic() - started, 3))
+        if result['status'] == 'timeout':
+            raise PathTimeout(result)
+        return result
+
+    try:
+        return cached_query(('path', graph_name, from_user, to_user, max_depth, policy), load,
+                            [GraphResultCache.GLOBAL])
+    except PathTimeout as e:
+        return e.result
+
+
+def _empty_result(from_user, to_user, max_depth, status, explored=0):
+    return {'from': from_user, 'to': to_user, 'max_depth': max_depth, 'length': None,
+            'nodes': [], 'edges': [], 'status': status, 'explored': explored}
+
+
+def _search(from_user, to_user, max_depth, policy, graph_name):
+    """Path search in one graph; the result of find_path without its timing"""
+    result = _empty_result(from_user, to_user, max_depth, None)
+    with graph_connection() as conn:
+        # SET LOCAL needs a transaction; the search only reads
+        conn.autocommit = False
+        cursor = conn.cursor()
+        try:
+            cursor.execute(USER_IDS_SQL.format(graph=graph_name),
+                           ([json.dumps(from_user), json.dumps(to_user)],))
+            ids = dict(cursor.fetchall())
+            if from_user not in ids or to_user not in ids:
+                status, vertices, links, explored = 'unknown_user', [], [], 0
+            else:
+                search = PathSearch(cursor, graph_name, max_depth, supernodes=policy)
+                status, vertices, links = search.run(ids[from_user], ids[to_user])
+                explored = search.explored
+                if status == 'found':
+                    described = search.describe(vertices)
+                    position = {vertex: index for index, vertex in enumerate(vertices)}
+                    result['length'] = len(links)
+                    result['nodes'] = [described.get(vertex, {'label': None, 'key': None})
+                                       for vertex in vertices]
+                    result['edges'] = [
+                        {'label': label,
+                         'source': position[previous] if outgoing else position[vertex],
+                         'target': position[vertex] if outgoing else position[previous]}
+                        for previous, vertex, label, outgoing in links
+                    ]
+            cursor.close()
+        finally:
+            conn.rollback()
+
+    result.update(status=status, explored=explored)
+    return result
@@ -0,0 +1,277 @@
+"""
+Connection pool for Apache AGE graph queries
+Connections load AGE, set the search path and install the agtype decoder
+once, when they are opened, and are then reused by every graph call in
+the process. Reads can borrow one under a latency budget, after which
+the server cancels what is still running.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qsl
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE, QueryCanceledError
+from config import Config
+from agtype import register_agtype
+
+
+class GraphPoolTimeout(Exception):
+    """Raised when no graph connection becomes available within pool_timeout"""
+
+
+class GraphReadTimeout(Exception):
+    """Raised when a graph read ran past its latency budget and was cancelled"""
+
+
+def connection_params(**connect_args):
+    """psycopg2 connection arguments for the configured database URL"""
+    parsed = urlparse(Config.SQLALCHEMY_DATABASE_URI)
+    params = dict(parse_qsl(parsed.query))
+    params.update(
+        host=parsed.hostname,
+        port=parsed.port,
+        database=parsed.path[1:],
+        user=parsed.username,
+        password=parsed.password
+    )
+    params.update(connect_args)
+    return params
+
+
+def init_age_session(conn):
+    """One-time AGE setup for a freshly opened connection"""
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cursor:
+        cursor.execute("LOAD 'age';")
+        cursor.execute("SET search_path = ag_catalog, '$user', public;")
+    # agtype columns come back as Python values
+    register_agtype(conn)
+
+
+class GraphConnectionPool:
+    """Thread-safe pool of AGE-ready psycopg2 connections"""
+
+    def __init__(self, min_size=1, max_size=10, pool_timeout=30, pool_recycle=3600,
+                 pool_pre_ping=True, connect_args=None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        self.connect_args = connect_args or {}
+
+        self._idle = []  # (connection, opened_at), most recently used last
+        self._size = 0
+        self._cond = threading.Condition()
+
+        for _ in range(min_size):
+            conn = self._open()
+            self._size += 1
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self):
+        conn = psycopg2.connect(**connection_params(**self.connect_args))
+        try:
+            init_age_session(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _is_usable(self, conn, opened_at):
+        if conn.closed:
+            return False
+        if self.pool_recycle and time.monotonic() - opened_at > self.pool_recycle:
+            return False
+        if self.pool_pre_ping:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.pool_timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, opened_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, opened_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise GraphPoolTimeout(f"No graph connection available after {self.pool_timeout}s")
+                self._cond.wait(remaining)
+
+        if conn is not None:
+            if self._is_usable(conn, opened_at):
+                return conn, opened_at
+            self._close_quietly(conn)
+
+        # Open a new connection in place of the discarded (or missing) one
+        try:
+            return self._open(), time.monotonic()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, conn, opened_at):
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if not conn.autocommit:
+                    conn.autocommit = True
+            except psycopg2.Error:
+                self._close_quietly(conn)
+
+        with self._cond:
+            if conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, opened_at))
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it is returned to the pool when the block exits"""
+        conn, opened_at = self._checkout()
+        try:
+            # Opened before the AGE extension existed: install the decoder now
+            register_agtype(conn)
+            yield conn
+        finally:
+            self._checkin(conn, opened_at)
+
+    def status(self):
+        """Current pool occupancy"""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size
+            }
+
+    def close(self):
+        """Close every idle connection"""
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_quietly(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_graph_pool():
+    """Process-wide graph pool, created on first use (and again after a fork)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = GraphConnectionPool(**Config.GRAPH_POOL_OPTIONS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def graph_connection():
+    """Borrow a warm AGE connection from the process-wide pool"""
+    with get_graph_pool().connection() as conn:
+        yield conn
+
+
+class ReadBudgetStats:
+    """Thread-safe per-query counters of budgeted reads and their timeouts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, query, outcome='ok'):
+        """outcome: 'ok', or 'stale' / 'unavailable' for a timeout with / without a cached result"""
+        with self._lock:
+            stats = self._stats.setdefault(query, {'calls': 0, 'timeouts': 0, 'stale': 0, 'unavailable': 0})
+            stats['calls'] += 1
+            if outcome != 'ok':
+                stats['timeouts'] += 1
+                stats[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {query: dict(stats) for query, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+read_budget_stats = ReadBudgetStats()
+
+
+def read_budget(query, budget=None):
+    """Seconds allowed for a read: budget, else GRAPH_READ_BUDGETS[query], else GRAPH_READ_BUDGET"""
+    if budget is not None:
+        return budget
+    for item in Config.GRAPH_READ_BUDGETS.split(','):
+        name, _, seconds = item.partition('=')
+        if name.strip() == query and seconds.strip():
+            return float(seconds)
+    return Config.GRAPH_READ_BUDGET
+
+
+@contextmanager
+def budgeted_connection(budget):
+    """
+    Borrow a graph connection whose work is cancelled after budget seconds.
+    The block runs in a transaction with statement_timeout set, so the
+    server stops a slow statement on its own; a watchdog also sends a
+    cancel request at the deadline, so several statements share one
+    budget. Raises GraphReadTimeout. A budget of 0 disables both.
+    """
+    with graph_connection() as conn:
+        if not budget:
+            yield conn
+            return
+
+        lock = threading.Lock()
+        active = [True]
+
+        def cancel():
+            with lock:
+                # Never cancel a query of the connection's next borrower
+                if active[0]:
+                    conn.cancel()
+
+        watchdog = threading.Timer(budget, cancel)
+        watchdog.daemon = True
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(budget * 1000)),))
+            watchdog.start()
+            yield conn
+        except QueryCanceledError as e:
+            raise GraphReadTimeout(f"graph read cancelled after its {budget}s budget") from e
+        finally:
+            with lock:
+                active[0] = False
+            watchdog.cancel()
+            # The pool rolls back and restores autocommit on checkin
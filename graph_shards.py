@@ -0,0 +1,247 @@
+"""
+Region sharding of the graph
+With GRAPH_SHARDING=true, order events are written to one graph per region
+instead of restaurant_graph, so label tables and write locks stay per
+region. The region comes from the country detected for the order's IP
+(get_location_from_ip), mapped through GRAPH_SHARD_REGIONS; countries not
+listed get a shard of their own. graph_shard_index records the regions
+each user has been seen in: per-user reads only visit those shards, and
+users active in several regions are found without a cross-shard query.
+
+Usage:
+    python graph_shards.py                     # list the shards
+    python graph_shards.py --create eu us      # create shard graphs with their indexes
+"""
+import argparse
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from config import Config
+from graph_pool import connection_params, graph_connection, init_age_session
+
+SHARD_INDEX_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS public.graph_shard_index (
+        username TEXT NOT NULL,
+        region TEXT NOT NULL,
+        first_seen BIGINT NOT NULL,
+        last_seen BIGINT NOT NULL,
+        PRIMARY KEY (username, region)
+    )
+"""
+
+# Rows are only rewritten when the seen range grows
+RECORD_SHARD_USERS_SQL = """
+    INSERT INTO public.graph_shard_index AS i (username, region, first_seen, last_seen)
+    SELECT * FROM unnest(%s::text[], %s::text[], %s::bigint[], %s::bigint[])
+    ON CONFLICT (username, region) DO UPDATE
+    SET first_seen = LEAST(i.first_seen, EXCLUDED.first_seen),
+        last_seen = GREATEST(i.last_seen, EXCLUDED.last_seen)
+    WHERE i.first_seen > EXCLUDED.first_seen OR i.last_seen < EXCLUDED.last_seen
+"""
+
+USER_REGIONS_SQL = """
+    SELECT region FROM public.graph_shard_index
+    WHERE username = %s
+    ORDER BY region
+"""
+
+CROSS_REGION_USERS_SQL = """
+    SELECT username, array_agg(region ORDER BY region), max(last_seen)
+    FROM public.graph_shard_index
+    WHERE last_seen >= %(since)s
+    GROUP BY username
+    HAVING count(*) >= %(min_regions)s
+    ORDER BY count(*) DESC, max(last_seen) DESC, username
+    LIMIT %(limit)s
+"""
+
+SHARD_GRAPHS_SQL = """
+    SELECT name FROM ag_catalog.ag_graph
+    WHERE left(name::text, %(length)s) = %(prefix)s
+    ORDER BY name
+"""
+
+SHARD_LIST_TTL = 30  # Seconds before shards created by other processes are noticed
+
+_created = set()  # Shard graphs this process has checked or created
+_index_ready = False
+_shard_list = (0.0, [])
+_lock = threading.Lock()
+_executor = None
+
+
+def shard_regions():
+    """GRAPH_SHARD_REGIONS 'Country=region,...' as a dict"""
+    regions = {}
+    for item in Config.GRAPH_SHARD_REGIONS.split(','):
+        country, _, region = item.partition('=')
+        if country.strip() and region.strip():
+            regions[country.strip()] = region.strip()
+    return regions
+
+
+def region_for_country(country):
+    """Shard region of a detected country, as a lowercase identifier"""
+    region = shard_regions().get(country) or country or Config.GRAPH_SHARD_DEFAULT
+    return re.sub(r'[^a-z0-9]+', '_', region.lower()).strip('_') or Config.GRAPH_SHARD_DEFAULT
+
+
+def shard_graph(region):
+    return f"{Config.GRAPH_SHARD_PREFIX}{region}"
+
+
+def shard_region(graph_name):
+    return graph_name[len(Config.GRAPH_SHARD_PREFIX):]
+
+
+def _ensure_index_table(cursor):
+    global _index_ready
+    if not _index_ready:
+        cursor.execute(SHARD_INDEX_TABLE_SQL)
+        _index_ready = True
+
+
+def ensure_shard_graph(graph_name):
+    """
+    Create a shard graph (and the shard index table) on first use. It runs
+    on a dedicated connection outside the pool, so the graph exists even if
+    the writer's transaction rolls back and a writer holding a pooled
+    connection never waits on a saturated pool, under an advisory lock so
+    writers do not race.
+    New shards have no label indexes until create_indexes.py or
+    graph_shards.py --create runs.
+    """
+    global _shard_list
+    if graph_name in _created:
+        return
+    conn = psycopg2.connect(**connection_params())
+    try:
+        init_age_session(conn)
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", (graph_name,))
+        try:
+            _ensure_index_table(cursor)
+            cursor.execute("SELECT COUNT(*) FROM ag_catalog.ag_graph WHERE name = %s", (graph_name,))
+            if cursor.fetchone()[0] == 0:
+                cursor.execute("SELECT create_graph(%s)", (graph_name,))
+                print(f"Created shard graph '{graph_name}' (run create_indexes.py to index it)")
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (graph_name,))
+            cursor.close()
+    finally:
+        conn.close()
+    with _lock:
+        _created.add(graph_name)
+        _shard_list = (0.0, [])
+
+
+def record_shard_users(cursor, events_by_graph):
+    """Upsert the (user, region) pairs of the events written to each shard"""
+    seen = {}
+    for graph_name, events in events_by_graph.items():
+        region = shard_region(graph_name)
+        for event in events:
+            key = (event['username'], region)
+            last_seen = event.get('last_seen') or int(time.time())
+            first_seen = event.get('first_seen') or last_seen
+            first, last = seen.get(key, (first_seen, last_seen))
+            seen[key] = (min(first, first_seen), max(last, last_seen))
+    if seen:
+        # Sorted so concurrent writers lock index rows in the same order
+        keys = sorted(seen)
+        cursor.execute(RECORD_SHARD_USERS_SQL, (
+            [username for username, _ in keys], [region for _, region in keys],
+            [seen[key][0] for key in keys], [seen[key][1] for key in keys]
+        ))
+
+
+def list_shard_graphs():
+    """Names of the existing shard graphs, re-read every SHARD_LIST_TTL seconds"""
+    global _shard_list
+    expires, names = _shard_list
+    if time.monotonic() < expires:
+        return names
+    prefix = Config.GRAPH_SHARD_PREFIX
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SHARD_GRAPHS_SQL, {'length': len(prefix), 'prefix': prefix})
+        names = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    _shard_list = (time.monotonic() + SHARD_LIST_TTL, names)
+    return names
+
+
+def user_shard_graphs(username):
+    """Shard graphs the user has been written to"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        _ensure_index_table(cursor)
+        cursor.execute(USER_REGIONS_SQL, (username,))
+        regions = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return [shard_graph(region) for region in regions]
+
+
+def cross_region_users(limit=50, min_regions=2, since=None):
+    """Users seen in at least min_regions regions (since epoch seconds), most regions first"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        _ensure_index_table(cursor)
+        cursor.execute(CROSS_REGION_USERS_SQL, {
+            'limit': limit, 'min_regions': min_regions, 'since': since or 0
+        })
+        rows = cursor.fetchall()
+        cursor.close()
+    return [
+        {'username': username, 'regions': regions, 'last_seen': last_seen}
+        for username, regions, last_seen in rows
+    ]
+
+
+def fan_out(graph_names, query):
+    """query(graph_name) on every graph, in parallel on GRAPH_SHARD_WORKERS threads; results in order"""
+    global _executor
+    if len(graph_names) <= 1:
+        return [query(graph_name) for graph_name in graph_names]
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.GRAPH_SHARD_WORKERS,
+                                           thread_name_prefix='graph-shard')
+    return list(_executor.map(query, graph_names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create and list region shard graphs')
+    parser.add_argument('--create', nargs='*', default=[], metavar='REGION',
+                        help='regions (or country names) to create shard graphs for')
+    args = parser.parse_args()
+
+    # Label indexes come from the same definitions as restaurant_graph's
+    from create_indexes import create_graph_indexes
+
+    for name in args.create:
+        graph_name = shard_graph(region_for_country(name))
+        ensure_shard_graph(graph_name)
+        create_graph_indexes(graph_name)
+
+    shards = list_shard_graphs()
+
+    print("=" * 70)
+    print(f"{len(shards)} shard graphs (prefix '{Config.GRAPH_SHARD_PREFIX}')")
+    print("=" * 70)
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        _ensure_index_table(cursor)
+        cursor.execute("SELECT region, COUNT(*) FROM public.graph_shard_index GROUP BY region")
+        users = dict(cursor.fetchall())
+        cursor.close()
+    for graph_name in shards:
+        print(f"  {graph_name:<40} {users.get(shard_region(graph_name), 0):>10} users")
+    print(f"  users in several regions: {len(cross_region_users(limit=100000))}")
+    print("✓ Done")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Prepared Cypher statements for Apache AGE
+Each statement is prepared once per connection and graph, then executed
+with its values bound as an agtype parameter map, so PostgreSQL neither
+re-parses nor re-plans it and values never end up in the query text.
+Execution counts and timings are kept per statement.
+"""
+import json
+import re
+import threading
+import time
+import weakref
+
+_PARAMETER = re.compile(r'\$[A-Za-z_]')
+
+
+class StatementStats:
+    """Thread-safe per-statement call counters and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, elapsed_ms, error=False, prepared=False):
+        with self._lock:
+            stats = self._stats.setdefault(name, {
+                'calls': 0, 'errors': 0, 'prepares': 0, 'total_ms': 0.0, 'max_ms': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['prepares'] += int(prepared)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+    def snapshot(self):
+        """Counters per statement, with the mean execution time"""
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    'total_ms': round(stats['total_ms'], 2),
+                    'max_ms': round(stats['max_ms'], 2),
+                    'avg_ms': round(stats['total_ms'] / stats['calls'], 2) if stats['calls'] else 0.0,
+                }
+                for name, stats in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+statement_stats = StatementStats()
+
+# Names of the statements already prepared on each open connection
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+class CypherStatement:
+    """
+    A Cypher query bound to a name and a result column list.
+    AGE only accepts a parameter map that is bound to a statement parameter,
+    so queries using $params are prepared as `cypher(..., $1)` and executed
+    with the map serialized as agtype.
+    """
+
+    def __init__(self, name, cypher_query, columns):
+        self.name = name
+        self.cypher_query = cypher_query
+        self.columns = columns
+        self.parameterized = bool(_PARAMETER.search(cypher_query))
+
+    def prepare_sql(self, graph_name):
+        statement = f"{self.name}_{graph_name}"
+        if self.parameterized:
+            return (f"PREPARE {statement}(agtype) AS "
+                    f"SELECT * FROM cypher('{graph_name}', $${self.cypher_query}$$, $1) AS ({self.columns});")
+        return (f"PREPARE {statement} AS "
+                f"SELECT * FROM cypher('{graph_name}', $${self.cypher_query}$$) AS ({self.columns});")
+
+    def execute(self, cursor, params, graph_name):
+        """Prepare on first use on this connection, then execute; rows are left on the cursor"""
+        statement = f"{self.name}_{graph_name}"
+        prepared = _prepared_statements.setdefault(cursor.connection, set())
+        just_prepared = statement not in prepared
+        if just_prepared:
+            # Sent on its own, so a failed EXECUTE never leaves the set out of sync
+            cursor.execute(self.prepare_sql(graph_name))
+            prepared.add(statement)
+
+        start = time.perf_counter()
+        try:
+            if self.parameterized:
+                cursor.execute(f"EXECUTE {statement}(%s);", (json.dumps(params or {}),))
+            else:
+                cursor.execute(f"EXECUTE {statement};")
+        except Exception:
+            statement_stats.record(self.name, (time.perf_counter() - start) * 1000,
+                                   error=True, prepared=just_prepared)
+            raise
+        statement_stats.record(self.name, (time.perf_counter() - start) * 1000, prepared=just_prepared)
+
+    def fetchall(self, cursor, params, graph_name):
+        """Execute and return every row"""
+        self.execute(cursor, params, graph_name)
+        return cursor.fetchall()
@@ -0,0 +1,76 @@
+"""
+Relational-to-graph synchronization for new orders
+Config.GRAPH_SYNC_MODE decides how an order reaches Apache AGE:
+  inline        - written to the graph right after the order commits
+  async         - queued for the background ingestion worker (graph_ingest.py)
+  outbox        - stored in graph_outbox in the order's own transaction and
+                  projected into the graph by graph_outbox.py
+  transactional - written on the ORM session's own connection, so the order
+                  and its graph elements commit (or roll back) together
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from config import Config
+from models import db, GraphOutbox
+from graph_alerts import emit_alerts
+from graph_ingest import submit_order_event
+from graph_utils import graph_results, known_elements, order_scopes, write_order_event
+
+
+def stage_order_event(event):
+    """Call before the order commits: outbox and transactional modes join the order's transaction"""
+    if Config.GRAPH_SYNC_MODE == 'outbox':
+        db.session.add(GraphOutbox(event_type='order', payload=event))
+    elif Config.GRAPH_SYNC_MODE == 'transactional':
+        write_order_event_in_session(event)
+
+
+def write_order_event_in_session(event):
+    """
+    Run the graph write on the connection of the current SQLAlchemy session.
+    AGE is loaded on that connection by the engine connect listener in app.py;
+    the search path only changes for the rest of this transaction.
+    """
+    db.session.flush()
+    dbapi_conn = db.session.connection().connection.dbapi_connection
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute("SET LOCAL search_path = ag_catalog, '$user', public;")
+        alerts = write_order_event(cursor, event, check=True)
+    finally:
+        cursor.close()
+    db.session.info['graph_written'] = True
+    db.session.info.setdefault('graph_scopes', []).extend(order_scopes([event]))
+    # Alerts wait for the commit, so a rolled back order raises none
+    db.session.info.setdefault('graph_alerts', []).extend(alerts)
+
+
+@event.listens_for(Session, 'after_commit')
+def _graph_write_committed(session):
+    session.info.pop('graph_written', None)
+    # Reads between the write and the commit may have cached the old graph
+    scopes = session.info.pop('graph_scopes', None)
+    if scopes:
+        graph_results.bump(scopes)
+    emit_alerts(session.info.pop('graph_alerts', None))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _graph_write_rolled_back(session):
+    session.info.pop('graph_scopes', None)
+    session.info.pop('graph_alerts', None)
+    # Ids cached during the rolled back write may not exist
+    if session.info.pop('graph_written', None):
+        known_elements.invalidate()
+
+
+def publish_order_event(event):
+    """Call after the order commits: sends the event unless it was already written or staged"""
+    if Config.GRAPH_SYNC_MODE in ('outbox', 'transactional'):
+        return True
+    
+    try:
+        return submit_order_event(event)
+    except Exception as e:
+        print(f"Warning: Could not add order to graph: {e}")
+        return False
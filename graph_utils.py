@@ -1,246 +1,977 @@
+import heapq
+import json
+import time
+from itertools import islice
+from datetime import timezone
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from config import Config
-from urllib.parse import urlparse
+from graph_cache import GraphResultCache, KnownElementCache
+from graph_alerts import check_order_events, emit_alerts
+from graph_csr import csr_snapshot
+from graph_shards import (cross_region_users, ensure_shard_graph, fan_out, list_shard_graphs,
+                          record_shard_users, region_for_country, shard_graph, user_shard_graphs)
+from graph_pool import (GraphReadTimeout, budgeted_connection, connection_params, graph_connection,
+                        read_budget, read_budget_stats)
+from graph_statements import CypherStatement
+
+GRAPH_NAME = 'restaurant_graph'
+
+# Vertex labels and the property that identifies each vertex
+GRAPH_VERTEX_KEYS = {
+    'User': 'username',
+    'Email': 'address',
+    'IPAddress': 'address',
+    'City': 'name',
+}
+GRAPH_EDGE_LABELS = ['HAS_EMAIL', 'USED_IP', 'FROM_CITY', 'REGISTERED_IN']
+
+# Vertices and static edges this process has already written
+known_elements = KnownElementCache(
+    max_vertices=Config.GRAPH_CACHE_MAX_VERTICES,
+    max_edges=Config.GRAPH_CACHE_MAX_EDGES
+)
+
+# Results of read queries, invalidated by writes to the users / IPs they cover
+graph_results = GraphResultCache(
+    max_entries=Config.GRAPH_RESULT_CACHE_SIZE,
+    ttl=Config.GRAPH_RESULT_CACHE_TTL
+)
+
+# Held shared by every graph write and exclusively by prune_graph while it
+# deletes orphaned vertices, so no vertex is deleted under an uncommitted edge
+PRUNE_LOCK_SQL = "SELECT pg_advisory_lock_shared(hashtext(%s))"
+PRUNE_XACT_LOCK_SQL = "SELECT pg_advisory_xact_lock_shared(hashtext(%s))"
+PRUNE_UNLOCK_SQL = "SELECT pg_advisory_unlock_shared(hashtext(%s))"
+
+
+def prune_lock_key(graph_name):
+    """Advisory lock name guarding graph_name's vertices against prune_graph"""
+    return f"{graph_name}:prune"
 
 
 def get_db_connection():
-    """Get database connection"""
-    db_url = Config.SQLALCHEMY_DATABASE_URI
-    parsed = urlparse(db_url)
-    
-    conn = psycopg2.connect(
-        host=parsed.hostname,
-        port=parsed.port,
-        database=parsed.path[1:],
-        user=parsed.username,
-        password=parsed.password
-    )
-    return conn
+    """Get a dedicated database connection (outside the graph pool)"""
+    return psycopg2.connect(**connection_params())
 
 
-def init_age_graph():
+def init_age_graph(graph_name=GRAPH_NAME):
     """Initialize Apache AGE graph"""
-    conn = get_db_connection()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cursor = conn.cursor()
-    
     try:
-        # Create AGE extension if not exists
-        print("Setting up Apache AGE extension...")
-        cursor.execute("CREATE EXTENSION IF NOT EXISTS age;")
-        
-        # Load AGE
-        cursor.execute("LOAD 'age';")
-        
-        # Set search path
-        cursor.execute("SET search_path = ag_catalog, '$user', public;")
-        
-        # Create graph if not exists
-        print("Creating restaurant_graph...")
-        cursor.execute("""
-            SELECT COUNT(*) FROM ag_catalog.ag_graph WHERE name = 'restaurant_graph';
-        """)
-        
-        if cursor.fetchone()[0] == 0:
-            cursor.execute("SELECT create_graph('restaurant_graph');")
-            print("Graph 'restaurant_graph' created successfully!")
-        else:
-            print("Graph 'restaurant_graph' already exists.")
-        
-        cursor.close()
-        conn.close()
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Create AGE extension if not exists
+            print("Setting up Apache AGE extension...")
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS age;")
+            
+            # Create graph if not exists
+            print(f"Creating {graph_name}...")
+            cursor.execute("""
+                SELECT COUNT(*) FROM ag_catalog.ag_graph WHERE name = %s;
+            """, (graph_name,))
+            
+            if cursor.fetchone()[0] == 0:
+                cursor.execute("SELECT create_graph(%s);", (graph_name,))
+                print(f"Graph '{graph_name}' created successfully!")
+            else:
+                print(f"Graph '{graph_name}' already exists.")
+            
+            cursor.close()
         return True
         
     except Exception as e:
         print(f"Error initializing AGE: {e}")
-        cursor.close()
-        conn.close()
         return False
 
 
-def add_order_to_graph(user, ip_address, city_detected, order_id):
+# Single round trip per write: every vertex and edge of a batch of order
+# events is upserted by one statement, with values bound as an agtype
+# parameter map. An event carries the ids of all orders placed by the same
+# user from the same IP, so repeated tuples cost one MERGE per vertex.
+# Vertices are merged on their key property only (see GRAPH_VERTEX_KEYS),
+# which the unique indexes from create_indexes.py enforce.
+_MERGE_ORDER_ELEMENTS = """
+    UNWIND $events AS ev
+    MERGE (u:User {username: ev.username})
+    SET u.city = ev.user_city
+    MERGE (e:Email {address: ev.email})
+    MERGE (ip:IPAddress {address: ev.ip_address})
+    MERGE (dc:City {name: ev.city_detected})
+    MERGE (rc:City {name: ev.user_city})
+    MERGE (u)-[:HAS_EMAIL]->(e)
+    MERGE (ip)-[:FROM_CITY]->(dc)
+    MERGE (u)-[:REGISTERED_IN]->(rc)
+    WITH u, ip, ev
+"""
+
+# One USED_IP edge per order, stamped with its own order time (epoch
+# seconds) from order_times. last_seen holds the same time, so time windows
+# filter every USED_IP edge on one indexed property, whichever mode wrote it.
+ADD_ORDERS_CYPHER = _MERGE_ORDER_ELEMENTS + """
+    UNWIND range(0, size(ev.order_ids) - 1) AS i
+    WITH u, ip, ev, ev.order_ids[i] AS order_id, coalesce(ev.order_times[i], ev.last_seen) AS ts
+    MERGE (u)-[r:USED_IP {order_id: order_id}]->(ip)
+    SET r.ts = ts, r.last_seen = ts
+    RETURN DISTINCT ev.idx, id(u), id(ip)
+"""
+
+# One USED_IP edge per (user, IP) pair (Config.GRAPH_AGGREGATE_USED_IP).
+# Order ids already in recent_orders are skipped, so a replayed event does
+# not count its orders twice.
+ADD_ORDERS_AGGREGATED_CYPHER = _MERGE_ORDER_ELEMENTS + f"""
+    MERGE (u)-[r:USED_IP]->(ip)
+    WITH u, ip, ev, r, coalesce(r.recent_orders, []) AS seen
+    UNWIND ev.order_ids AS order_id
+    WITH u, ip, ev, r, seen, order_id
+    WHERE NOT order_id IN seen
+    WITH u, ip, ev, r, seen, collect(order_id) AS fresh
+    SET r.order_count = coalesce(r.order_count, 0) + size(fresh),
+        r.first_seen = CASE WHEN r.first_seen IS NULL OR ev.first_seen < r.first_seen
+                            THEN ev.first_seen ELSE r.first_seen END,
+        r.last_seen = CASE WHEN r.last_seen IS NULL OR ev.last_seen > r.last_seen
+                           THEN ev.last_seen ELSE r.last_seen END,
+        r.recent_orders = (seen + fresh)[-{Config.GRAPH_RECENT_ORDERS_LIMIT}..]
+    RETURN DISTINCT ev.idx, id(u), id(ip)
+"""
+
+# Fast path for events whose vertices and static edges are all cached: the
+# USED_IP edges are inserted straight into the label table by vertex id.
+# `found` only keeps ids that still exist in the same graph instance, and
+# events missing from the result fall back to ADD_ORDERS_CYPHER.
+ADD_KNOWN_ORDERS_SQL = """
+    WITH ev AS (
+        SELECT * FROM unnest(%(idx)s::int[], %(user_ids)s::bigint[], %(ip_ids)s::bigint[],
+                             %(last_seen)s::bigint[])
+            AS t(idx, user_id, ip_id, last_seen)
+    ), found AS (
+        SELECT ev.idx, u.id AS user_id, ip.id AS ip_id, ev.last_seen
+        FROM ev
+        JOIN {graph}."User" u ON u.id = ev.user_id::text::graphid
+        JOIN {graph}."IPAddress" ip ON ip.id = ev.ip_id::text::graphid
+        WHERE (SELECT graphid FROM ag_catalog.ag_graph WHERE name = %(graph_name)s) = %(graph_oid)s
+    ), new_edges AS (
+        SELECT f.user_id, f.ip_id,
+               jsonb_build_object('order_id', o.order_id)::text::agtype AS match,
+               jsonb_strip_nulls(jsonb_build_object('order_id', o.order_id,
+                                                    'ts', coalesce(o.ts, f.last_seen),
+                                                    'last_seen', coalesce(o.ts, f.last_seen)))::text::agtype
+                   AS properties
+        FROM found f
+        JOIN unnest(%(order_idx)s::int[], %(order_ids)s::bigint[], %(order_times)s::bigint[])
+            AS o(idx, order_id, ts) ON o.idx = f.idx
+    ), inserted AS (
+        INSERT INTO {graph}."USED_IP" (start_id, end_id, properties)
+        SELECT n.user_id, n.ip_id, n.properties FROM new_edges n
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {graph}."USED_IP" r
+            WHERE r.start_id = n.user_id AND r.end_id = n.ip_id AND r.properties @> n.match
+        )
+    )
+    SELECT idx, true FROM found
+"""
+
+# Aggregated counterpart of ADD_KNOWN_ORDERS_SQL: the (user, IP) edge is
+# locked and its counters updated in place. Events whose pair has no edge
+# yet come back with written = false and go through the MERGE statement.
+ADD_KNOWN_AGGREGATED_ORDERS_SQL = """
+    WITH ev AS (
+        SELECT * FROM unnest(%(idx)s::int[], %(user_ids)s::bigint[], %(ip_ids)s::bigint[],
+                             %(first_seen)s::bigint[], %(last_seen)s::bigint[])
+            AS t(idx, user_id, ip_id, first_seen, last_seen)
+    ), found AS (
+        SELECT ev.idx, u.id AS user_id, ip.id AS ip_id, ev.first_seen, ev.last_seen
+        FROM ev
+        JOIN {graph}."User" u ON u.id = ev.user_id::text::graphid
+        JOIN {graph}."IPAddress" ip ON ip.id = ev.ip_id::text::graphid
+        WHERE (SELECT graphid FROM ag_catalog.ag_graph WHERE name = %(graph_name)s) = %(graph_oid)s
+    ), pairs AS (
+        SELECT f.user_id, f.ip_id, MIN(f.first_seen) AS first_seen, MAX(f.last_seen) AS last_seen,
+               array_agg(o.order_id ORDER BY o.order_id) AS order_ids
+        FROM found f
+        JOIN unnest(%(order_idx)s::int[], %(order_ids)s::bigint[]) AS o(idx, order_id) ON o.idx = f.idx
+        GROUP BY f.user_id, f.ip_id
+    ), locked AS (
+        SELECT r.id, r.start_id, r.end_id, r.properties::text::jsonb AS props
+        FROM {graph}."USED_IP" r
+        JOIN pairs p ON r.start_id = p.user_id AND r.end_id = p.ip_id
+        FOR UPDATE OF r
+    ), merged AS (
+        SELECT l.id, l.props, p.first_seen, p.last_seen,
+               ARRAY(SELECT unnest(p.order_ids)
+                     EXCEPT SELECT jsonb_array_elements_text(coalesce(l.props->'recent_orders', '[]'))::bigint
+                     ORDER BY 1) AS fresh
+        FROM locked l
+        JOIN pairs p ON p.user_id = l.start_id AND p.ip_id = l.end_id
+    ), updated AS (
+        UPDATE {graph}."USED_IP" r
+        SET properties = (m.props || jsonb_build_object(
+            'order_count', coalesce((m.props->>'order_count')::bigint, 0) + cardinality(m.fresh),
+            'first_seen', least((m.props->>'first_seen')::bigint, m.first_seen),
+            'last_seen', greatest((m.props->>'last_seen')::bigint, m.last_seen),
+            'recent_orders', (
+                SELECT coalesce(jsonb_agg(k.o ORDER BY k.n), '[]') FROM (
+                    SELECT e.o, e.n
+                    FROM jsonb_array_elements(coalesce(m.props->'recent_orders', '[]') || to_jsonb(m.fresh))
+                        WITH ORDINALITY AS e(o, n)
+                    ORDER BY e.n DESC
+                    LIMIT %(recent_limit)s
+                ) k
+            )
+        ))::text::agtype
+        FROM merged m
+        WHERE r.id = m.id
+        RETURNING r.start_id, r.end_id
+    )
+    SELECT f.idx, EXISTS (
+        SELECT 1 FROM updated w WHERE w.start_id = f.user_id AND w.end_id = f.ip_id
+    )
+    FROM found f
+"""
+
+# Read queries below are templates: {window} becomes `true`, or a filter
+# keeping the USED_IP edges last seen in [$since, $until) (see windowed)
+USER_GRAPH_CYPHER = """
+    MATCH (u:User {{username: $username}})-[r:USED_IP]->(ip:IPAddress)-[:FROM_CITY]->(c:City)
+    WHERE {window}
+    RETURN u.username, ip.address, c.name
+"""
+
+# Fraud traversals leave out supernodes (vertices flagged by graph_degrees.py)
+# unless $include_supernodes is true: the IP is matched and filtered first,
+# so a proxy used by thousands of users is never expanded into user pairs.
+SHARED_IPS_CYPHER = """
+    MATCH (ip:IPAddress)
+    WHERE $include_supernodes OR NOT coalesce(ip.supernode, false)
+    MATCH (u1:User)-[r1:USED_IP]->(ip)<-[r2:USED_IP]-(u2:User)
+    WHERE u1.username <> u2.username AND {window}
+    RETURN DISTINCT u1.username, u2.username, ip.address
+"""
+
+CITY_MISMATCHES_CYPHER = """
+    MATCH (u:User)-[:REGISTERED_IN]->(reg_city:City),
+          (u)-[r:USED_IP]->(ip:IPAddress)-[:FROM_CITY]->(det_city:City)
+    WHERE reg_city.name <> det_city.name AND {window}
+      AND ($include_supernodes
+           OR NOT (coalesce(ip.supernode, false) OR coalesce(det_city.supernode, false)))
+    RETURN u.username, reg_city.name, det_city.name, ip.address
+"""
+
+# One row per IP shared by at least $min_users users, instead of one row per
+# user pair: a NAT address shared by k users stays one row, not k*(k-1).
+_SHARED_IP_GROUPS_CYPHER = """
+    MATCH (ip:IPAddress)
+    WHERE $include_supernodes OR NOT coalesce(ip.supernode, false)
+    MATCH (u:User)-[r:USED_IP]->(ip)
+    WHERE {window}
+    WITH ip, u, max(coalesce(r.last_seen, r.ts)) AS seen
+    WITH ip, count(u) AS user_count, collect(u.username) AS users, max(seen) AS last_seen
+    WHERE user_count >= $min_users
+    RETURN ip.address, user_count, users[0..$sample_size], last_seen
+    ORDER BY {order}
+    LIMIT $limit
+"""
+
+SHARED_IP_RANKINGS = {
+    'users': 'user_count DESC, last_seen DESC, ip.address',
+    'recent': 'last_seen DESC, user_count DESC, ip.address',
+}
+
+SHARED_IP_COUNT_CYPHER = """
+    MATCH (ip:IPAddress)
+    WHERE $include_supernodes OR NOT coalesce(ip.supernode, false)
+    MATCH (u:User)-[:USED_IP]->(ip)
+    WITH ip, count(DISTINCT u) AS user_count
+    WHERE user_count >= $min_users
+    RETURN count(ip)
+"""
+
+# Supernodes with a bounded sample of their neighbors, read from the label
+# tables: each sample stops after $sample edges, whatever the degree.
+SUPERNODES_SQL = """
+    SELECT 'IPAddress', v.properties::text::jsonb->>'address',
+           (v.properties::text::jsonb->>'degree')::bigint,
+           ARRAY(SELECT DISTINCT s.name FROM (
+               SELECT u.properties::text::jsonb->>'username' AS name
+               FROM {graph}."USED_IP" r JOIN {graph}."User" u ON u.id = r.start_id
+               WHERE r.end_id = v.id
+               LIMIT %(sample)s
+           ) s)
+    FROM {graph}."IPAddress" v
+    WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[v.properties, '"supernode"'::ag_catalog.agtype])
+          = 'true'::ag_catalog.agtype
+    UNION ALL
+    SELECT 'City', v.properties::text::jsonb->>'name',
+           (v.properties::text::jsonb->>'degree')::bigint,
+           ARRAY(SELECT DISTINCT s.name FROM (
+               SELECT ip.properties::text::jsonb->>'address' AS name
+               FROM {graph}."FROM_CITY" f JOIN {graph}."IPAddress" ip ON ip.id = f.start_id
+               WHERE f.end_id = v.id
+               LIMIT %(sample)s
+           ) s)
+    FROM {graph}."City" v
+    WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[v.properties, '"supernode"'::ag_catalog.agtype])
+          = 'true'::ag_catalog.agtype
+    ORDER BY 3 DESC NULLS LAST
+"""
+
+# 'skip' leaves supernodes out of fraud traversals, 'sample' also lists them
+# with a few neighbors each (list_supernodes), 'include' traverses them
+SUPERNODE_POLICIES = ('skip', 'sample', 'include')
+
+# Open ends of a time window, in epoch seconds
+WINDOW_START = 0
+WINDOW_END = 2 ** 53
+
+
+def edge_window(edges, since=None, until=None):
+    """Cypher filter keeping the given USED_IP edges seen in [since, until) (literal epoch seconds)"""
+    since = WINDOW_START if since is None else int(since)
+    until = WINDOW_END if until is None else int(until)
+    return ' AND '.join(f'{edge}.last_seen >= {since} AND {edge}.last_seen < {until}' for edge in edges)
+
+
+def windowed(name, cypher_query, columns, edges=('r',)):
     """
-    Add order information to the graph database
-    Creates vertices for: User, IP, City, Email
-    Creates edges for: USED_IP, FROM_CITY, HAS_EMAIL, PLACED_ORDER
+    The statement over the whole history, and its variant matching only the
+    edges last seen in [$since, $until). A separate statement rather than
+    an optional filter, so its plan can use the USED_IP last_seen index.
     """
-    conn = get_db_connection()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cursor = conn.cursor()
+    window = ' AND '.join(f'{edge}.last_seen >= $since AND {edge}.last_seen < $until' for edge in edges)
+    return {
+        False: CypherStatement(name, cypher_query.format(window='true'), columns),
+        True: CypherStatement(f'{name}_window', cypher_query.format(window=window), columns),
+    }
+
+
+def window_params(params, since=None, until=None):
+    """Statement parameters and whether the windowed variant applies"""
+    if since is None and until is None:
+        return params, False
+    return dict(params,
+                since=WINDOW_START if since is None else since,
+                until=WINDOW_END if until is None else until), True
+
+
+ORDER_RESULT_COLUMNS = 'idx agtype, user_id agtype, ip_id agtype'
+ADD_ORDERS = CypherStatement('add_orders', ADD_ORDERS_CYPHER, ORDER_RESULT_COLUMNS)
+ADD_ORDERS_AGGREGATED = CypherStatement('add_orders_aggregated', ADD_ORDERS_AGGREGATED_CYPHER,
+                                        ORDER_RESULT_COLUMNS)
+USER_GRAPH = windowed('user_graph', USER_GRAPH_CYPHER, 'username agtype, ip_address agtype, city agtype')
+SHARED_IPS = windowed('shared_ips', SHARED_IPS_CYPHER, 'user1 agtype, user2 agtype, ip agtype',
+                      edges=('r1', 'r2'))
+CITY_MISMATCHES = windowed('city_mismatches', CITY_MISMATCHES_CYPHER,
+                           'username agtype, registered_city agtype, detected_city agtype, ip agtype')
+SHARED_IP_GROUPS = {
+    rank: windowed(f'shared_ip_groups_{rank}', _SHARED_IP_GROUPS_CYPHER.replace('{order}', order),
+                   'ip agtype, user_count agtype, users agtype, last_seen agtype')
+    for rank, order in SHARED_IP_RANKINGS.items()
+}
+SHARED_IP_COUNT = CypherStatement('shared_ip_count', SHARED_IP_COUNT_CYPHER, 'count agtype')
+
+
+def order_event(user, ip_address, city_detected, order_id, created_at=None, country=None):
+    """Build the graph payload of an order from plain values (country picks the region shard)"""
+    if created_at is not None:
+        ts = int(created_at.replace(tzinfo=timezone.utc).timestamp())
+    else:
+        ts = int(time.time())
+    return {
+        'username': user.username,
+        'email': user.email,
+        'user_city': user.city,
+        'ip_address': ip_address,
+        'city_detected': city_detected or 'Unknown',
+        'order_ids': [order_id],
+        'order_times': [ts],
+        'first_seen': ts,
+        'last_seen': ts,
+        'country': country,
+    }
+
+
+def order_times(event):
+    """Time of each of an event's orders; events without order_times fall back to last_seen"""
+    times = event.get('order_times')
+    if times is None or len(times) != len(event['order_ids']):
+        return [event.get('last_seen')] * len(event['order_ids'])
+    return times
+
+
+def merge_order_events(events):
+    """Collapse events sharing the same (user, IP, city) tuple into one"""
+    merged = {}
+    for event in events:
+        key = (event['username'], event['email'], event['user_city'],
+               event['ip_address'], event['city_detected'])
+        if key in merged:
+            target = merged[key]
+            target['order_times'] = order_times(target) + order_times(event)
+            target['order_ids'] = target['order_ids'] + event['order_ids']
+            seen = [ts for ts in (target.get('first_seen'), event.get('first_seen')) if ts is not None]
+            target['first_seen'] = min(seen) if seen else None
+            seen = [ts for ts in (target.get('last_seen'), event.get('last_seen')) if ts is not None]
+            target['last_seen'] = max(seen) if seen else None
+        else:
+            merged[key] = dict(event)
+    return list(merged.values())
+
+
+def write_order_events(cursor, events, graph_name=GRAPH_NAME, check=False):
+    """
+    Upsert the vertices and edges of a batch of order events using the given cursor.
+    Events whose elements are all known to exist only get their USED_IP edges;
+    the rest go through the full MERGE statement, which refills the cache.
+    With GRAPH_SHARDING, events for restaurant_graph go to their region's shard.
+    With check (and GRAPH_WRITE_CHECKS), the neighborhood of the written events
+    is checked for fraud; returns the alerts, for the caller to emit_alerts
+    once the write has committed.
+    """
+    if Config.GRAPH_SHARDING and graph_name == GRAPH_NAME:
+        return _write_sharded_order_events(cursor, events, check)
+    # In a transaction the lock is held until commit, otherwise for the write
+    autocommit = cursor.connection.autocommit
+    cursor.execute(PRUNE_LOCK_SQL if autocommit else PRUNE_XACT_LOCK_SQL, (prune_lock_key(graph_name),))
+    try:
+        return _write_graph_order_events(cursor, events, graph_name, check)
+    finally:
+        if autocommit:
+            cursor.execute(PRUNE_UNLOCK_SQL, (prune_lock_key(graph_name),))
+
+
+def _write_graph_order_events(cursor, events, graph_name, check):
+    """Write the events to one graph, through the id cache where possible"""
+    scopes = order_scopes(events)
+    written = events
+    events = [dict(event, idx=idx, order_times=order_times(event)) for idx, event in enumerate(events)]
+    if Config.GRAPH_CACHE_ENABLED:
+        events = _write_known_order_events(cursor, events, graph_name)
+    if events:
+        _write_new_order_events(cursor, events, graph_name)
+    graph_results.bump(scopes)
+    if check and Config.GRAPH_WRITE_CHECKS:
+        return check_order_events(cursor, written, graph_name)
+    return []
+
+
+def _write_sharded_order_events(cursor, events, check=False):
+    """Write each event to the shard of its country and record the users' regions"""
+    by_graph = {}
+    for event in events:
+        by_graph.setdefault(shard_graph(region_for_country(event.get('country'))), []).append(event)
+    alerts = []
+    for graph_name, group in by_graph.items():
+        ensure_shard_graph(graph_name)
+        alerts += write_order_events(cursor, group, graph_name, check)
+    record_shard_users(cursor, by_graph)
+    return alerts
+
+
+def order_scopes(events):
+    """Result cache scopes touched by writing the given order events"""
+    return ([('user', event['username']) for event in events] +
+            [('ip', event['ip_address']) for event in events])
+
+
+def _write_known_order_events(cursor, events, graph_name):
+    """Write the cached events by vertex id; returns the events still to write"""
+    known, unknown = {}, []
+    for event in events:
+        ids = known_elements.lookup(graph_name, event)
+        if ids:
+            known[event['idx']] = (event, ids)
+        else:
+            unknown.append(event)
+    if not known:
+        return unknown
+    
+    order_idx, order_ids, times = [], [], []
+    for idx, (event, _) in known.items():
+        order_idx += [idx] * len(event['order_ids'])
+        order_ids += event['order_ids']
+        times += event['order_times']
+    
+    sql = ADD_KNOWN_AGGREGATED_ORDERS_SQL if Config.GRAPH_AGGREGATE_USED_IP else ADD_KNOWN_ORDERS_SQL
+    cursor.execute(sql.format(graph=graph_name), {
+        'idx': list(known),
+        'user_ids': [ids[0] for _, ids in known.values()],
+        'ip_ids': [ids[1] for _, ids in known.values()],
+        'first_seen': [event.get('first_seen') for event, _ in known.values()],
+        'last_seen': [event.get('last_seen') for event, _ in known.values()],
+        'order_idx': order_idx,
+        'order_ids': order_ids,
+        'order_times': times,
+        'recent_limit': Config.GRAPH_RECENT_ORDERS_LIMIT,
+        'graph_name': graph_name,
+        'graph_oid': known_elements.graph_oid(graph_name),
+    })
+    rows = cursor.fetchall()
+    found = {idx for idx, _ in rows}
+    written = {idx for idx, ok in rows if ok}
     
+    if not found:
+        # Nothing matched: the graph was most likely rebuilt or swapped
+        known_elements.invalidate()
+    for idx, (event, _) in known.items():
+        if idx not in found:
+            known_elements.forget(graph_name, event)
+            unknown.append(event)
+        elif idx not in written:
+            # Known vertices, but no aggregated edge between them yet
+            unknown.append(event)
+    return unknown
+
+
+def _write_new_order_events(cursor, events, graph_name):
+    """MERGE every vertex and edge of the events and cache the resulting ids"""
+    if Config.GRAPH_CACHE_ENABLED and known_elements.graph_oid(graph_name) is None:
+        cursor.execute("SELECT graphid FROM ag_catalog.ag_graph WHERE name = %s", (graph_name,))
+        row = cursor.fetchone()
+        if row:
+            known_elements.set_graph_oid(graph_name, row[0])
+    
+    statement = ADD_ORDERS_AGGREGATED if Config.GRAPH_AGGREGATE_USED_IP else ADD_ORDERS
+    statement.execute(cursor, {'events': events}, graph_name)
+    
+    if Config.GRAPH_CACHE_ENABLED:
+        by_idx = {event['idx']: event for event in events}
+        for idx, user_id, ip_id in cursor.fetchall():
+            known_elements.remember(graph_name, by_idx[idx], user_id, ip_id)
+    
+    # Only this path can add a user to an IP or an edge to a city; events
+    # of known (user, IP) pairs leave every degree as it was
+    if Config.GRAPH_DEGREES_ON_WRITE:
+        from graph_degrees import update_written_degrees
+        update_written_degrees(cursor, events, graph_name)
+
+
+def write_order_event(cursor, event, graph_name=GRAPH_NAME, check=False):
+    """Upsert the vertices and edges of one order event using the given cursor"""
+    return write_order_events(cursor, [event], graph_name, check)
+
+
+def add_orders_to_graph(events):
+    """Write a batch of order events to the graph in one statement, then emit its fraud alerts"""
     try:
-        # Load AGE and set search path
-        cursor.execute("LOAD 'age';")
-        cursor.execute("SET search_path = ag_catalog, '$user', public;")
-        
-        username = user.username
-        email = user.email
-        user_city = user.city
-        
-        # Create or merge User vertex
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MERGE (u:User {{username: '{username}', city: '{user_city}'}})
-                RETURN u
-            $$) AS (u agtype);
-        """)
-        
-        # Create or merge Email vertex
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MERGE (e:Email {{address: '{email}'}})
-                RETURN e
-            $$) AS (e agtype);
-        """)
-        
-        # Create or merge IP vertex
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MERGE (ip:IPAddress {{address: '{ip_address}'}})
-                RETURN ip
-            $$) AS (ip agtype);
-        """)
-        
-        # Create or merge detected City vertex
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MERGE (c:City {{name: '{city_detected}'}})
-                RETURN c
-            $$) AS (c agtype);
-        """)
-        
-        # Create or merge user's registered City vertex
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MERGE (c:City {{name: '{user_city}'}})
-                RETURN c
-            $$) AS (c agtype);
-        """)
-        
-        # Create relationships: User HAS_EMAIL Email
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u:User {{username: '{username}'}}), (e:Email {{address: '{email}'}})
-                MERGE (u)-[r:HAS_EMAIL]->(e)
-                RETURN r
-            $$) AS (r agtype);
-        """)
-        
-        # Create relationships: User USED_IP IPAddress
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u:User {{username: '{username}'}}), (ip:IPAddress {{address: '{ip_address}'}})
-                MERGE (u)-[r:USED_IP {{order_id: {order_id}}}]->(ip)
-                RETURN r
-            $$) AS (r agtype);
-        """)
-        
-        # Create relationships: IPAddress FROM_CITY City (detected city)
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (ip:IPAddress {{address: '{ip_address}'}}), (c:City {{name: '{city_detected}'}})
-                MERGE (ip)-[r:FROM_CITY]->(c)
-                RETURN r
-            $$) AS (r agtype);
-        """)
-        
-        # Create relationships: User REGISTERED_IN City (user's city)
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u:User {{username: '{username}'}}), (c:City {{name: '{user_city}'}})
-                MERGE (u)-[r:REGISTERED_IN]->(c)
-                RETURN r
-            $$) AS (r agtype);
-        """)
-        
-        print(f"Order #{order_id} added to graph: {username} -> {ip_address} -> {city_detected}")
-        
-        cursor.close()
-        conn.close()
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            alerts = write_order_events(cursor, events, check=True)
+            cursor.close()
+        emit_alerts(alerts)
         return True
         
     except Exception as e:
-        print(f"Error adding order to graph: {e}")
-        cursor.close()
-        conn.close()
+        print(f"Error adding orders to graph: {e}")
         return False
 
 
-def query_user_graph(username):
-    """Query graph for user relationships"""
-    conn = get_db_connection()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cursor = conn.cursor()
+def add_order_to_graph(user, ip_address, city_detected, order_id, country=None):
+    """
+    Add order information to the graph database
+    Creates vertices for: User, IP, City, Email
+    Creates edges for: USED_IP, FROM_CITY, HAS_EMAIL, REGISTERED_IN
+    """
+    event = order_event(user, ip_address, city_detected, order_id, country=country)
+    if not add_orders_to_graph([event]):
+        return False
     
+    print(f"Order #{order_id} added to graph: {event['username']} -> {ip_address} -> {event['city_detected']}")
+    return True
+
+
+class StaleRows(list):
+    """Cached rows served because a fresh read ran past its budget; age in seconds"""
+    stale = True
+
+    def __init__(self, rows, age):
+        super().__init__(rows)
+        self.age = age
+
+
+def mark_stale(value, age):
+    """Flag a cached result as stale: dicts get stale / stale_age keys, lists become StaleRows"""
+    if isinstance(value, dict):
+        return dict(value, stale=True, stale_age=round(age, 1))
+    if isinstance(value, list):
+        return StaleRows(value, round(age, 1))
+    return value
+
+
+def is_stale(result):
+    """True for a result served from the cache after a read timed out"""
+    if isinstance(result, dict):
+        return bool(result.get('stale'))
+    return getattr(result, 'stale', False)
+
+
+def cached_query(key, loader, scopes, min_refresh=0):
+    """
+    Read through the result cache when it is enabled. If the loader raises
+    GraphReadTimeout, the last result cached for key is returned instead,
+    marked stale (see mark_stale); with nothing cached the timeout is raised.
+    Outcomes are counted per query type, key[0], in read_budget_stats.
+    """
     try:
-        cursor.execute("LOAD 'age';")
-        cursor.execute("SET search_path = ag_catalog, '$user', public;")
-        
-        # Get user's IP addresses and cities
-        cursor.execute(f"""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u:User {{username: '{username}'}})-[:USED_IP]->(ip:IPAddress)-[:FROM_CITY]->(c:City)
-                RETURN u.username, ip.address, c.name
-            $$) AS (username agtype, ip_address agtype, city agtype);
-        """)
-        
-        results = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
+        if not Config.GRAPH_RESULT_CACHE_ENABLED:
+            value = loader()
+        else:
+            value = graph_results.get_or_load(key, loader, scopes, min_refresh)
+    except GraphReadTimeout:
+        last = graph_results.last_result(key) if Config.GRAPH_RESULT_CACHE_ENABLED else None
+        read_budget_stats.record(key[0], 'stale' if last else 'unavailable')
+        if last is None:
+            raise
+        return mark_stale(*last)
+    read_budget_stats.record(key[0])
+    return value
+
+
+def read_graphs(username=None):
+    """
+    Graphs a read covers: restaurant_graph, or with GRAPH_SHARDING every
+    region shard (only the user's shards, from the shard index, for per-user reads)
+    """
+    if not Config.GRAPH_SHARDING:
+        return [GRAPH_NAME]
+    return user_shard_graphs(username) if username is not None else list_shard_graphs()
+
+
+def merge_rows(parts):
+    """Concatenate per-shard row lists, dropping rows found in several shards"""
+    if len(parts) == 1:
+        return parts[0]
+    return list(dict.fromkeys(row for part in parts for row in part))
+
+
+def query_user_graph(username, since=None, until=None, budget=None):
+    """
+    Query graph for user relationships (results are cached; treat them as read-only)
+    since / until (epoch seconds) only keep the IPs used in that window.
+    budget (seconds, see read_budget) caps the query; past it the last
+    cached rows are returned as StaleRows.
+    """
+    params, window = window_params({'username': username}, since, until)
+    budget = read_budget('user_graph', budget)
+    
+    def load_graph(graph_name):
+        with budgeted_connection(budget) as conn:
+            cursor = conn.cursor()
+            
+            # Get user's IP addresses and cities
+            results = USER_GRAPH[window].fetchall(cursor, params, graph_name)
+            cursor.close()
         return results
+    
+    def load():
+        return merge_rows(fan_out(read_graphs(username), load_graph))
+    
+    def scopes(results):
+        # The user's USED_IP edges, and the FROM_CITY edges of each IP
+        return [('user', username)] + [('ip', row[1]) for row in results]
+    
+    try:
+        if Config.GRAPH_BACKEND == 'csr':
+            return csr_snapshot().user_graph(username, since, until)
+        return cached_query(('user_graph', username, since, until), load, scopes)
         
     except Exception as e:
         print(f"Error querying graph: {e}")
-        cursor.close()
-        conn.close()
         return []
 
 
-def detect_fraud_patterns():
-    """Detect potential fraud patterns in the graph"""
-    conn = get_db_connection()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cursor = conn.cursor()
+def supernode_policy(policy=None):
+    """Validated supernode policy, GRAPH_SUPERNODE_POLICY by default"""
+    policy = policy or Config.GRAPH_SUPERNODE_POLICY
+    if policy not in SUPERNODE_POLICIES:
+        raise ValueError(f"supernode policy must be one of: {', '.join(SUPERNODE_POLICIES)}")
+    return policy
+
+
+def list_supernodes(sample_size=None, graph_name=GRAPH_NAME, budget=None):
+    """
+    IPAddress and City vertices flagged as supernodes, highest degree first,
+    each with up to sample_size neighbors (users of an IP, IPs of a city)
+    """
+    sample_size = Config.GRAPH_SUPERNODE_SAMPLE if sample_size is None else sample_size
+    budget = read_budget('supernodes', budget)
+    
+    def load_graph(graph):
+        with budgeted_connection(budget) as conn:
+            cursor = conn.cursor()
+            cursor.execute(SUPERNODES_SQL.format(graph=graph), {'sample': sample_size})
+            rows = cursor.fetchall()
+            cursor.close()
+        return [
+            {'label': label, 'key': key, 'degree': degree, 'sample': sample}
+            for label, key, degree, sample in rows
+        ]
+    
+    def load():
+        graphs = read_graphs() if graph_name == GRAPH_NAME else [graph_name]
+        parts = fan_out(graphs, load_graph)
+        if len(parts) == 1:
+            return parts[0]
+        return sorted((row for part in parts for row in part), key=lambda row: -(row['degree'] or 0))
     
     try:
-        cursor.execute("LOAD 'age';")
-        cursor.execute("SET search_path = ag_catalog, '$user', public;")
-        
-        # Find users using same IP
-        cursor.execute("""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u1:User)-[:USED_IP]->(ip:IPAddress)<-[:USED_IP]-(u2:User)
-                WHERE u1.username <> u2.username
-                RETURN DISTINCT u1.username, u2.username, ip.address
-            $$) AS (user1 agtype, user2 agtype, ip agtype);
-        """)
-        
-        shared_ips = cursor.fetchall()
-        
-        # Find users with city mismatch
-        cursor.execute("""
-            SELECT * FROM cypher('restaurant_graph', $$
-                MATCH (u:User)-[:REGISTERED_IN]->(reg_city:City),
-                      (u)-[:USED_IP]->(ip:IPAddress)-[:FROM_CITY]->(det_city:City)
-                WHERE reg_city.name <> det_city.name
-                RETURN u.username, reg_city.name, det_city.name, ip.address
-            $$) AS (username agtype, registered_city agtype, detected_city agtype, ip agtype);
-        """)
-        
-        mismatches = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
+        if Config.GRAPH_BACKEND == 'csr':
+            return csr_snapshot().supernodes(sample_size)
+        return cached_query(('supernodes', graph_name, sample_size), load,
+                            [GraphResultCache.GLOBAL], Config.GRAPH_RESULT_CACHE_MIN_REFRESH)
+    except Exception as e:
+        print(f"Error listing supernodes: {e}")
+        return []
+
+
+def top_shared_ips(limit=20, rank='users', sample_size=5, min_users=2, since=None, supernodes=None,
+                   until=None, budget=None):
+    """
+    IPs used by several users, ranked by user count ('users') or by most
+    recent use ('recent'). Each row holds the IP, its user count, up to
+    sample_size usernames and the latest edge time. Cached; read-only.
+    Supernode IPs are left out unless the policy is 'include'; since / until
+    only count the edges seen in that window. Past its budget the last
+    cached rows are returned as StaleRows.
+    """
+    policy = supernode_policy(supernodes)
+    params, window = window_params({'limit': limit, 'sample_size': sample_size, 'min_users': min_users,
+                                    'include_supernodes': policy == 'include'}, since, until)
+    budget = read_budget('shared_ip_groups', budget)
+    
+    def load_graph(graph_name):
+        with budgeted_connection(budget) as conn:
+            cursor = conn.cursor()
+            rows = SHARED_IP_GROUPS[rank][window].fetchall(cursor, params, graph_name)
+            cursor.close()
+        return [
+            dict(zip(('ip', 'user_count', 'users', 'last_seen'), row))
+            for row in rows
+        ]
+    
+    def load():
+        parts = fan_out(read_graphs(), load_graph)
+        if len(parts) == 1:
+            return parts[0]
+        # An IP normally lives in one region; if it shows up in several, keep its largest group
+        groups = {}
+        for row in (row for part in parts for row in part):
+            if row['ip'] not in groups or row['user_count'] > groups[row['ip']]['user_count']:
+                groups[row['ip']] = row
+        count, recent = (lambda row: -row['user_count']), (lambda row: -(row['last_seen'] or 0))
+        order = (count, recent) if rank == 'users' else (recent, count)
+        return sorted(groups.values(), key=lambda row: (order[0](row), order[1](row), row['ip']))[:limit]
+    
+    try:
+        if Config.GRAPH_BACKEND == 'csr':
+            return csr_snapshot().shared_ip_groups(limit, rank, sample_size, min_users, since, until,
+                                                   policy == 'include')
+        return cached_query(('shared_ip_groups', rank, limit, sample_size, min_users, since, until, policy),
+                            load, [GraphResultCache.GLOBAL], Config.GRAPH_RESULT_CACHE_MIN_REFRESH)
+    except Exception as e:
+        print(f"Error ranking shared IPs: {e}")
+        return []
+
+
+def count_shared_ips(min_users=2, supernodes=None, budget=None):
+    """Number of IPs used by at least min_users users (cached; the last count once past the budget)"""
+    policy = supernode_policy(supernodes)
+    params = {'min_users': min_users, 'include_supernodes': policy == 'include'}
+    budget = read_budget('shared_ip_count', budget)
+    
+    def load_graph(graph_name):
+        with budgeted_connection(budget) as conn:
+            cursor = conn.cursor()
+            rows = SHARED_IP_COUNT.fetchall(cursor, params, graph_name)
+            cursor.close()
+        return rows[0][0] if rows else 0
+    
+    def load():
+        return sum(fan_out(read_graphs(), load_graph))
+    
+    try:
+        if Config.GRAPH_BACKEND == 'csr':
+            return csr_snapshot().count_shared_ips(min_users, policy == 'include')
+        return cached_query(('shared_ip_count', min_users, policy), load,
+                            [GraphResultCache.GLOBAL], Config.GRAPH_RESULT_CACHE_MIN_REFRESH)
+    except Exception as e:
+        print(f"Error counting shared IPs: {e}")
+        return 0
+
+
+def detect_fraud_patterns(shared_ip_mode='pairs', limit=20, supernodes=None, since=None, until=None,
+                          budget=None):
+    """
+    Detect potential fraud patterns in the graph (results are cached; treat them as read-only)
+    shared_ip_mode='pairs' lists every (user1, user2, ip) row; 'grouped' returns
+    the top `limit` shared IPs from top_shared_ips instead.
+    With the 'sample' supernode policy, 'supernodes' lists the skipped vertices.
+    since / until (epoch seconds) only match USED_IP edges seen in that window:
+    a shared IP needs both users on it within the window.
+    budget (seconds, see read_budget) caps each query run; 'stale' is True
+    when part of the result is a cached one served past its budget.
+    """
+    grouped = shared_ip_mode == 'grouped'
+    policy = supernode_policy(supernodes)
+    params, window = window_params({'include_supernodes': policy == 'include'}, since, until)
+    budget = read_budget('fraud_patterns', budget)
+    
+    def load_graph(graph_name):
+        with budgeted_connection(budget) as conn:
+            cursor = conn.cursor()
+            
+            # Find users using same IP
+            shared_ips = None if grouped else SHARED_IPS[window].fetchall(cursor, params, graph_name)
+            
+            # Find users with city mismatch
+            mismatches = CITY_MISMATCHES[window].fetchall(cursor, params, graph_name)
+            cursor.close()
+        return shared_ips, mismatches
+    
+    def load():
+        parts = fan_out(read_graphs(), load_graph)
         return {
-            'shared_ips': shared_ips,
-            'city_mismatches': mismatches
+            'shared_ips': None if grouped else merge_rows([shared for shared, _ in parts]),
+            'city_mismatches': merge_rows([mismatches for _, mismatches in parts])
         }
+    
+    try:
+        if Config.GRAPH_BACKEND == 'csr':
+            snapshot = csr_snapshot()
+            include = policy == 'include'
+            return {
+                'shared_ips': (snapshot.shared_ip_groups(limit, since=since, until=until, include_supernodes=include)
+                               if grouped else snapshot.shared_ips(since, until, include)),
+                'city_mismatches': snapshot.city_mismatches(since, until, include),
+                'supernodes': snapshot.supernodes(Config.GRAPH_SUPERNODE_SAMPLE) if policy == 'sample' else [],
+                'stale': False
+            }
+        patterns = cached_query(('fraud_patterns', shared_ip_mode, policy, since, until), load,
+                                [GraphResultCache.GLOBAL], Config.GRAPH_RESULT_CACHE_MIN_REFRESH)
+        parts = [patterns]
+        patterns = dict(patterns, supernodes=list_supernodes(budget=budget) if policy == 'sample' else [])
+        parts.append(patterns['supernodes'])
+        if grouped:
+            patterns['shared_ips'] = top_shared_ips(limit, supernodes=policy, since=since, until=until,
+                                                    budget=budget)
+            parts.append(patterns['shared_ips'])
+        if Config.GRAPH_SHARDING:
+            # Cross-shard links come from the shard index, not from a traversal
+            patterns['cross_region_users'] = cross_region_users(limit, since=since)
+        patterns['stale'] = any(is_stale(part) for part in parts)
+        return patterns
         
     except Exception as e:
         print(f"Error detecting fraud: {e}")
-        cursor.close()
-        conn.close()
-        return {'shared_ips': [], 'city_mismatches': []}
+        return {'shared_ips': [], 'city_mismatches': [], 'supernodes': [], 'stale': False}
+
+
+# Fraud patterns streamed page by page (see iter_fraud_patterns). Each row
+# carries the latest edge time seen for it, so a time window can be applied.
+FRAUD_PATTERNS = {
+    'shared_ips': {
+        'cypher': """
+            MATCH (ip:IPAddress)
+            WHERE {include_supernodes} OR NOT coalesce(ip.supernode, false)
+            MATCH (u1:User)-[r1:USED_IP]->(ip)<-[r2:USED_IP]-(u2:User)
+            WHERE u1.username < u2.username AND {window}
+            RETURN ip.address, u1.username, u2.username,
+                   max(coalesce(r1.last_seen, r1.ts)), max(coalesce(r2.last_seen, r2.ts))
+        """,
+        'columns': ['ip', 'user1', 'user2', 'user1_last_seen', 'user2_last_seen'],
+        'key': ['ip', 'user1', 'user2'],
+        # Both users were active on the IP within the window
+        'edges': ['r1', 'r2'],
+    },
+    'city_mismatches': {
+        'cypher': """
+            MATCH (u:User)-[:REGISTERED_IN]->(reg_city:City),
+                  (u)-[r:USED_IP]->(ip:IPAddress)-[:FROM_CITY]->(det_city:City)
+            WHERE reg_city.name <> det_city.name AND {window}
+              AND ({include_supernodes}
+                   OR NOT (coalesce(ip.supernode, false) OR coalesce(det_city.supernode, false)))
+            RETURN u.username, ip.address, det_city.name, reg_city.name, max(coalesce(r.last_seen, r.ts))
+        """,
+        'columns': ['username', 'ip', 'detected_city', 'registered_city', 'last_seen'],
+        'key': ['username', 'ip', 'detected_city', 'registered_city'],
+        'edges': ['r'],
+    },
+}
+
+
+def fraud_pattern_sql(pattern, after=None, since=None, until=None, limit=None, graph_name=GRAPH_NAME,
+                      supernodes=None):
+    """
+    Keyset-paginated SQL around a fraud pattern query.
+    Named cursors cannot run prepared statements, so caller-supplied values
+    are bound in the outer SQL. The time window is the exception: it has to
+    filter the edges inside the Cypher query to use the last_seen index, so
+    it is written there as integer literals.
+    """
+    spec = FRAUD_PATTERNS[pattern]
+    columns = ', '.join(f'{column} agtype' for column in spec['columns'])
+    include = 'true' if supernode_policy(supernodes) == 'include' else 'false'
+    window = edge_window(spec['edges'], since, until) if since is not None or until is not None else 'true'
+    cypher_query = spec['cypher'].format(include_supernodes=include, window=window)
+    sql = f"SELECT * FROM cypher('{graph_name}', $${cypher_query}$$) AS ({columns})"
+    
+    conditions, params = [], []
+    if after:
+        placeholders = ', '.join(['%s::agtype'] * len(spec['key']))
+        conditions.append(f"({', '.join(spec['key'])}) > ({placeholders})")
+        params += [json.dumps(value) for value in after]
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += f" ORDER BY {', '.join(spec['key'])}"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+
+def iter_fraud_patterns(pattern, after=None, since=None, until=None, limit=None, batch_size=500,
+                        supernodes=None):
+    """
+    Yield the rows of a fraud pattern as plain dicts, ordered by its key.
+    Rows come from a server-side cursor in batches of batch_size, so memory
+    stays bounded however many rows match. after is the key of the last row
+    already seen; since / until bound the edge time in epoch seconds.
+    With GRAPH_SHARDING the sorted streams of every shard are merged.
+    """
+    graphs = read_graphs()
+    if len(graphs) == 1:
+        yield from _iter_graph_patterns(pattern, graphs[0], after, since, until, limit, batch_size, supernodes)
+        return
+    # Every shard stream is sorted by the pattern key, so a merge keeps the order
+    key = lambda row: fraud_pattern_key(pattern, row)
+    streams = [_iter_graph_patterns(pattern, graph_name, after, since, until, limit, batch_size, supernodes)
+               for graph_name in graphs]
+    previous = None
+    for row in islice(heapq.merge(*streams, key=key), limit):
+        if row != previous:
+            yield row
+        previous = row
+
+
+def _iter_graph_patterns(pattern, graph_name, after, since, until, limit, batch_size, supernodes):
+    spec = FRAUD_PATTERNS[pattern]
+    sql, params = fraud_pattern_sql(pattern, after, since, until, limit, graph_name, supernodes)
+    with graph_connection() as conn:
+        # Named cursors only live inside a transaction
+        conn.autocommit = False
+        try:
+            cursor = conn.cursor(name=f'fraud_{pattern}')
+            cursor.itersize = batch_size
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(spec['columns'], row))
+            cursor.close()
+        finally:
+            conn.rollback()
+
+
+def fraud_pattern_key(pattern, row):
+    """Pagination key of a row returned by iter_fraud_patterns"""
+    return [row[column] for column in FRAUD_PATTERNS[pattern]['key']]
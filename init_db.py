@@ -16,7 +16,8 @@ with app.app_context():
     
     # Drop all tables from the SQL schema (order_details, etc.)
     print("Dropping SQL schema tables...")
-    sql_tables = ['order_items', 'order_details', 'orders', 'menu', 'users', 'user_locations', 'menu_items']
+    sql_tables = ['order_items', 'order_details', 'orders', 'menu', 'users', 'user_locations', 'menu_items',
+                  'fraud_alerts', 'shared_ip_groups', 'shared_ip_users']
     for table in sql_tables:
         try:
             db.session.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
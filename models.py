@@ -132,6 +132,18 @@ class OrderItem(db.Model):
         }
 
 
+class GraphOutbox(db.Model):
+    """Graph events written in the same transaction as their order, projected into AGE by graph_outbox.py"""
+    __tablename__ = 'graph_outbox'
+    
+    id = db.Column(db.BigInteger, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False, default='order')
+    payload = db.Column(db.JSON, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # Failed projection attempts
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
 class UserLocation(db.Model):
     """Track user IP addresses and locations for security and analytics"""
     __tablename__ = 'user_locations'
@@ -166,3 +178,80 @@ class UserLocation(db.Model):
             'action': self.action,
             'timestamp': self.timestamp.isoformat()
         }
+
+
+class SharedIpUser(db.Model):
+    """Users seen on each IP (fraud_alerts.py), so shared_ip_groups counts each user once"""
+    __tablename__ = 'shared_ip_users'
+    
+    ip_address = db.Column(db.String(45), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    locations = db.Column(db.Integer, nullable=False, default=1)  # Locations recorded for the pair
+
+
+class SharedIpGroup(db.Model):
+    """One row per IP with the number of distinct users seen on it, kept up to date on each insert"""
+    __tablename__ = 'shared_ip_groups'
+    __table_args__ = (
+        db.Index('shared_ip_groups_status_users_idx', 'status', 'user_count'),
+    )
+    
+    ip_address = db.Column(db.String(45), primary_key=True)
+    user_count = db.Column(db.Integer, nullable=False, default=1)
+    users = db.Column(db.ARRAY(db.String(80)), nullable=False, default=list)  # First users seen, up to FRAUD_SHARED_IP_SAMPLE
+    status = db.Column(db.String(20), nullable=False, default='open')  # See FRAUD_ALERT_STATUSES
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert shared IP group to dictionary"""
+        return {
+            'ip': self.ip_address,
+            'user_count': self.user_count,
+            'users': self.users,
+            'status': self.status,
+            'first_seen': self.first_seen.isoformat(),
+            'last_seen': self.last_seen.isoformat()
+        }
+
+
+class FraudAlert(db.Model):
+    """A shared-IP or city-mismatch finding, deduplicated on alert_key (fraud_alerts.py)"""
+    __tablename__ = 'fraud_alerts'
+    __table_args__ = (
+        db.Index('fraud_alerts_status_last_seen_idx', 'status', 'last_seen'),
+    )
+    
+    id = db.Column(db.BigInteger, primary_key=True)
+    alert_key = db.Column(db.String(400), unique=True, nullable=False)
+    alert_type = db.Column(db.String(20), nullable=False)  # 'shared_ip' or 'city_mismatch'
+    status = db.Column(db.String(20), nullable=False, default='open')  # See FRAUD_ALERT_STATUSES
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    username = db.Column(db.String(80), nullable=False)
+    ip_address = db.Column(db.String(45), nullable=False, index=True)
+    registered_city = db.Column(db.String(100))
+    detected_city = db.Column(db.String(100))  # city_mismatch only
+    occurrences = db.Column(db.Integer, nullable=False, default=1)  # Locations that raised it again
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert fraud alert to dictionary"""
+        return {
+            'id': self.id,
+            'type': self.alert_type,
+            'status': self.status,
+            'user_id': self.user_id,
+            'username': self.username,
+            'ip': self.ip_address,
+            'registered_city': self.registered_city,
+            'detected_city': self.detected_city,
+            'occurrences': self.occurrences,
+            'first_seen': self.first_seen.isoformat(),
+            'last_seen': self.last_seen.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
@@ -0,0 +1,249 @@
+"""
+Graph retention job - drops USED_IP edges older than the retention window
+and the IPAddress, City and Email vertices nothing points to any more.
+Works in small batches, each in its own short transaction with a lock
+timeout and a pause in between, so checkout writes are never held up for
+long. The affected label tables are vacuumed and analyzed afterwards.
+
+Vertex deletes hold the graph's prune lock exclusively, which graph writers
+take shared, so a vertex cannot be deleted while an edge to it is being
+written. A dry run deletes nothing: it records what would go in a temp
+table, and the orphan checks ignore those edges, so its counts match a
+real run.
+
+Usage:
+    python prune_graph.py                    # GRAPH_RETENTION_DAYS (default 365)
+    python prune_graph.py --days 90 --dry-run
+
+With GRAPH_SHARDING, the default prunes every region shard instead.
+"""
+import argparse
+import time
+from config import Config
+from graph_pool import graph_connection
+from graph_utils import GRAPH_NAME, prune_lock_key, read_graphs
+
+# An edge's age is last_seen for aggregated edges, otherwise the creation
+# time of its order. Edges with neither are kept. The delete checks the age
+# again, in case a writer updated last_seen since the edge was selected.
+PRUNE_EDGES_SQL = """
+    WITH users AS (
+        SELECT id FROM {graph}."User"
+        WHERE id > %(after_id)s::text::graphid
+        ORDER BY id
+        LIMIT %(batch_size)s
+    ), expired AS (
+        SELECT r.id, EXTRACT(EPOCH FROM o.created_at)::bigint AS created
+        FROM {graph}."USED_IP" r
+        JOIN users u ON r.start_id = u.id
+        LEFT JOIN orders o ON o.id = (r.properties::text::jsonb->>'order_id')::bigint
+        WHERE coalesce((r.properties::text::jsonb->>'last_seen')::bigint,
+                       EXTRACT(EPOCH FROM o.created_at)::bigint) < %(cutoff)s
+    ), deleted AS (
+        {remove}
+    )
+    SELECT (SELECT id FROM users ORDER BY id DESC LIMIT 1)::text::bigint,
+           (SELECT COUNT(*) FROM deleted)
+"""
+
+DELETE_EXPIRED_SQL = """DELETE FROM {graph}."USED_IP" r
+        USING expired e
+        WHERE r.id = e.id
+          AND coalesce((r.properties::text::jsonb->>'last_seen')::bigint, e.created) < %(cutoff)s
+        RETURNING 1"""
+
+# Dry runs record the ids they would delete instead
+DRY_RUN_TABLE_SQL = "CREATE TEMP TABLE IF NOT EXISTS prune_dry_run (id graphid PRIMARY KEY)"
+RECORD_EXPIRED_SQL = "INSERT INTO prune_dry_run SELECT id FROM expired RETURNING 1"
+
+EXCLUSIVE_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext(%(lock_key)s))"
+
+# Vertex label -> edges whose end_id keeps a vertex alive, and edges that
+# start at the vertex and go with it. IPAddress goes first, since removing
+# its FROM_CITY edges can orphan cities.
+ORPHAN_RULES = [
+    ('IPAddress', ['USED_IP'], ['FROM_CITY']),
+    ('City', ['FROM_CITY', 'REGISTERED_IN'], []),
+    ('Email', ['HAS_EMAIL'], []),
+]
+
+
+def prune_orphans_sql(graph_name, label, referenced_by, owned_edges, dry_run=False):
+    """Batch statement deleting (or, for a dry run, recording) unreferenced vertices of one label"""
+    kept = " AND NOT EXISTS (SELECT 1 FROM prune_dry_run d WHERE d.id = r.id)" if dry_run else ""
+    checks = " AND ".join(
+        f'NOT EXISTS (SELECT 1 FROM {graph_name}."{edge}" r WHERE r.end_id = c.id{kept})'
+        for edge in referenced_by
+    )
+    ctes = [
+        f"""chunk AS (
+            SELECT id FROM {graph_name}."{label}"
+            WHERE id > %(after_id)s::text::graphid
+            ORDER BY id
+            LIMIT %(batch_size)s
+        )""",
+        f"orphans AS (SELECT c.id FROM chunk c WHERE {checks})",
+    ]
+    for edge in owned_edges:
+        if dry_run:
+            ctes.append(
+                f'"del_{edge}" AS (INSERT INTO prune_dry_run SELECT r.id FROM {graph_name}."{edge}" r '
+                f'JOIN orphans o ON r.start_id = o.id RETURNING 1)'
+            )
+        else:
+            ctes.append(
+                f'"del_{edge}" AS (DELETE FROM {graph_name}."{edge}" r USING orphans o '
+                f'WHERE r.start_id = o.id RETURNING 1)'
+            )
+    if dry_run:
+        ctes.append('deleted AS (INSERT INTO prune_dry_run SELECT id FROM orphans RETURNING 1)')
+    else:
+        ctes.append(
+            f'deleted AS (DELETE FROM {graph_name}."{label}" v USING orphans o '
+            f'WHERE v.id = o.id RETURNING 1)'
+        )
+    counts = "".join(f', (SELECT COUNT(*) FROM "del_{edge}")' for edge in owned_edges)
+    return (
+        "WITH " + ",\n".join(ctes) +
+        "\nSELECT (SELECT id FROM chunk ORDER BY id DESC LIMIT 1)::text::bigint, "
+        "(SELECT COUNT(*) FROM deleted)" + counts
+    )
+
+
+class GraphPruner:
+    """Runs the batch statements with throttling and keeps the removal counts"""
+
+    def __init__(self, graph_name=GRAPH_NAME, batch_size=1000, pause=0.1,
+                 lock_timeout='2s', dry_run=False):
+        self.graph_name = graph_name
+        self.batch_size = batch_size
+        self.pause = pause
+        self.lock_timeout = lock_timeout
+        self.dry_run = dry_run
+        self.removed = {}
+        self.lock_waits = 0
+
+    def _count(self, label, amount):
+        self.removed[label] = self.removed.get(label, 0) + amount
+
+    def prune(self, cutoff):
+        """Prune edges, then orphans, on one connection, which holds a dry run's temp table"""
+        with graph_connection() as conn:
+            if self.dry_run:
+                cursor = conn.cursor()
+                cursor.execute(DRY_RUN_TABLE_SQL)
+                cursor.execute("TRUNCATE prune_dry_run")
+                cursor.close()
+            try:
+                self.prune_edges(conn, cutoff)
+                self.prune_orphans(conn)
+            finally:
+                if self.dry_run:
+                    conn.rollback()
+                    conn.autocommit = True
+                    cursor = conn.cursor()
+                    cursor.execute("DROP TABLE IF EXISTS prune_dry_run")
+                    cursor.close()
+
+    def _run_batches(self, conn, sql, params, exclusive=False):
+        """
+        Yield the result row of each batch until the keyset scan is done.
+        With exclusive, each batch first waits for in-flight graph writes
+        and holds new ones off until it commits.
+        """
+        after_id = 0
+        conn.autocommit = False
+        cursor = conn.cursor()
+        try:
+            while True:
+                try:
+                    cursor.execute("SET LOCAL lock_timeout = %s", (self.lock_timeout,))
+                    if exclusive:
+                        cursor.execute(EXCLUSIVE_LOCK_SQL, {'lock_key': prune_lock_key(self.graph_name)})
+                    cursor.execute(sql, dict(params, after_id=after_id, batch_size=self.batch_size))
+                    row = cursor.fetchone()
+                except Exception as e:
+                    conn.rollback()
+                    if getattr(e, 'pgcode', None) != '55P03':  # lock_not_available
+                        raise
+                    # A writer holds the rows: back off and retry the batch
+                    self.lock_waits += 1
+                    time.sleep(self.pause * 10)
+                    continue
+
+                if row[0] is None:
+                    conn.rollback()
+                    return
+                # A dry run only wrote to its temp table
+                conn.commit()
+                after_id = row[0]
+                yield row
+                time.sleep(self.pause)
+        finally:
+            cursor.close()
+
+    def prune_edges(self, conn, cutoff):
+        """Delete USED_IP edges last seen before the cutoff (epoch seconds)"""
+        remove = RECORD_EXPIRED_SQL if self.dry_run else DELETE_EXPIRED_SQL
+        sql = PRUNE_EDGES_SQL.format(graph=self.graph_name, remove=remove.format(graph=self.graph_name))
+        for _, deleted in self._run_batches(conn, sql, {'cutoff': cutoff}):
+            self._count('USED_IP', deleted)
+
+    def prune_orphans(self, conn):
+        """Delete vertices left without edges, with the edges they own"""
+        for label, referenced_by, owned_edges in ORPHAN_RULES:
+            sql = prune_orphans_sql(self.graph_name, label, referenced_by, owned_edges, self.dry_run)
+            for row in self._run_batches(conn, sql, {}, exclusive=not self.dry_run):
+                self._count(label, row[1])
+                for edge, deleted in zip(owned_edges, row[2:]):
+                    self._count(edge, deleted)
+
+    def vacuum(self):
+        """VACUUM ANALYZE the label tables rows were removed from"""
+        tables = [label for label, count in self.removed.items() if count]
+        with graph_connection() as conn:
+            cursor = conn.cursor()
+            for label in tables:
+                print(f"VACUUM ANALYZE {self.graph_name}.\"{label}\"...")
+                cursor.execute(f'VACUUM ANALYZE {self.graph_name}."{label}"')
+            cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune old edges and orphaned vertices from the graph')
+    parser.add_argument('--graph', default=GRAPH_NAME)
+    parser.add_argument('--days', type=int, default=Config.GRAPH_RETENTION_DAYS,
+                        help='keep USED_IP edges seen within this many days')
+    parser.add_argument('--batch-size', type=int, default=Config.GRAPH_PRUNE_BATCH_SIZE,
+                        help='vertices scanned per transaction')
+    parser.add_argument('--pause', type=float, default=Config.GRAPH_PRUNE_PAUSE,
+                        help='seconds to sleep between batches')
+    parser.add_argument('--dry-run', action='store_true', help='count what would be removed without removing it')
+    args = parser.parse_args()
+
+    cutoff = int(time.time()) - args.days * 86400
+    graphs = read_graphs() if args.graph == GRAPH_NAME else [args.graph]
+
+    started = time.monotonic()
+    for graph_name in graphs:
+        pruner = GraphPruner(graph_name, args.batch_size, args.pause, dry_run=args.dry_run)
+
+        print("=" * 70)
+        print(f"Pruning '{graph_name}': USED_IP edges older than {args.days} days"
+              + (" (dry run)" if args.dry_run else ""))
+        print("=" * 70)
+
+        pruner.prune(cutoff)
+
+        print()
+        for label in ['USED_IP', 'FROM_CITY', 'IPAddress', 'City', 'Email']:
+            print(f"  {label:<12} {pruner.removed.get(label, 0):>10} removed")
+        print(f"  lock waits   {pruner.lock_waits:>10}")
+
+        if not args.dry_run:
+            pruner.vacuum()
+    print(f"✓ Done in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
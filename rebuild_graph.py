@@ -0,0 +1,337 @@
+"""
+Rebuild / backfill the Apache AGE graph from relational history
+Streams users, orders and user_locations with a server-side cursor and
+bulk-loads them in large UNWIND batches. Progress is checkpointed in the
+same transaction as each batch, so an interrupted run resumes where it
+stopped. With --shadow the graph is built under a separate name and
+swapped in atomically once it is complete; orders placed during the build
+are loaded in the swap transaction, with new checkouts blocked until it
+commits. Order locations and orders that cannot be paired are reported.
+
+Usage:
+    python rebuild_graph.py                  # backfill restaurant_graph in place
+    python rebuild_graph.py --resume         # continue an interrupted run
+    python rebuild_graph.py --shadow         # build a shadow graph, then swap it in
+
+With GRAPH_SHARDING, events are written to the region shards, which are
+created and indexed before loading; --shadow is not supported there.
+"""
+import argparse
+import time
+from config import Config
+from graph_pool import graph_connection, init_age_session
+from graph_degrees import refresh_degrees
+from graph_shards import ensure_shard_graph, region_for_country, shard_graph
+from graph_utils import (GRAPH_NAME, get_db_connection, init_age_graph, read_graphs,
+                         graph_results, known_elements, merge_order_events, write_order_events)
+
+# user_locations has no order_id, so each 'order' location row is paired with
+# the user's order placed closest to it, within ORDER_PAIR_WINDOW seconds: both
+# are written by the same checkout transaction. A location without such an
+# order (a failed checkout) comes back with a NULL order id and is skipped and
+# counted, and it cannot shift the pairing of the user's later orders.
+ORDER_EVENTS_SQL = """
+    SELECT l.id, u.username, u.email, u.city, l.ip_address, l.city, o.id,
+           EXTRACT(EPOCH FROM o.created_at)::bigint, l.country
+    FROM user_locations l
+    JOIN users u ON u.id = l.user_id
+    LEFT JOIN LATERAL (
+        SELECT id, created_at FROM orders
+        WHERE user_id = l.user_id
+          AND created_at BETWEEN l.timestamp - make_interval(secs => %(window)s)
+                             AND l.timestamp + make_interval(secs => %(window)s)
+        ORDER BY abs(EXTRACT(EPOCH FROM created_at - l.timestamp)), id
+        LIMIT 1
+    ) o ON true
+    WHERE l.action = 'order' AND l.id > %(after_id)s
+      AND l.user_id BETWEEN %(min_user_id)s AND %(max_user_id)s
+    ORDER BY l.id
+"""
+
+# Orders with no order location in the pairing window, which a rebuild cannot load
+UNPAIRED_ORDERS_SQL = """
+    SELECT COUNT(*) FROM orders o
+    WHERE NOT EXISTS (
+        SELECT 1 FROM user_locations l
+        WHERE l.user_id = o.user_id AND l.action = 'order'
+          AND l.timestamp BETWEEN o.created_at - make_interval(secs => %(window)s)
+                              AND o.created_at + make_interval(secs => %(window)s)
+    )
+"""
+
+ORDER_PAIR_WINDOW = 60  # Seconds between an order and its location row
+
+CHECKPOINT_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS graph_rebuild_checkpoints (
+        graph_name VARCHAR(100) PRIMARY KEY,
+        last_location_id BIGINT NOT NULL DEFAULT 0,
+        rows_loaded BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'utc')
+    )
+"""
+
+SAVE_CHECKPOINT_SQL = """
+    INSERT INTO graph_rebuild_checkpoints (graph_name, last_location_id, rows_loaded)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (graph_name) DO UPDATE
+    SET last_location_id = EXCLUDED.last_location_id,
+        rows_loaded = EXCLUDED.rows_loaded,
+        updated_at = NOW() AT TIME ZONE 'utc'
+"""
+
+MAX_USER_ID = 2 ** 31 - 1
+
+
+def iter_order_events(batch_size, after_id=0, min_user_id=0, max_user_id=MAX_USER_ID, unpaired=None):
+    """
+    Stream (last_location_id, events) batches from the relational tables
+    using a server-side cursor, so memory stays bounded by batch_size.
+    Ids of order locations with no matching order are appended to unpaired.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor(name='graph_order_events')
+        cursor.itersize = batch_size
+        cursor.execute(ORDER_EVENTS_SQL, {
+            'after_id': after_id,
+            'min_user_id': min_user_id,
+            'max_user_id': max_user_id,
+            'window': ORDER_PAIR_WINDOW
+        })
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            events = [{
+                'username': username,
+                'email': email,
+                'user_city': user_city,
+                'ip_address': ip_address,
+                'city_detected': city_detected or 'Unknown',
+                'order_ids': [order_id],
+                'order_times': [ts],
+                'first_seen': ts,
+                'last_seen': ts,
+                'country': country,
+            } for _, username, email, user_city, ip_address, city_detected, order_id, ts, country in rows
+                if order_id is not None]
+            if unpaired is not None:
+                unpaired += [row[0] for row in rows if row[6] is None]
+            yield rows[-1][0], events
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def count_pending_rows(after_id):
+    """Number of order locations left to load after a checkpoint"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM user_locations WHERE action = 'order' AND id > %s", (after_id,)
+        )
+        total = cursor.fetchone()[0]
+        cursor.close()
+    return total
+
+
+def order_shard_graphs(after_id=0):
+    """Region shards the order locations after a checkpoint are written to"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT country FROM user_locations WHERE action = 'order' AND id > %s", (after_id,)
+        )
+        countries = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return sorted({shard_graph(region_for_country(country)) for country in countries})
+
+
+def count_unpaired_orders():
+    """Orders that have no order location to be loaded from"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UNPAIRED_ORDERS_SQL, {'window': ORDER_PAIR_WINDOW})
+        total = cursor.fetchone()[0]
+        cursor.close()
+    return total
+
+
+def load_checkpoint(graph_name):
+    """(last_location_id, rows_loaded) of the previous run, or zeros"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CHECKPOINT_TABLE_SQL)
+        cursor.execute(
+            "SELECT last_location_id, rows_loaded FROM graph_rebuild_checkpoints WHERE graph_name = %s",
+            (graph_name,)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+    return row if row else (0, 0)
+
+
+def reset_checkpoint(graph_name):
+    """Forget the progress of a previous run"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CHECKPOINT_TABLE_SQL)
+        cursor.execute("DELETE FROM graph_rebuild_checkpoints WHERE graph_name = %s", (graph_name,))
+        cursor.close()
+
+
+def load_graph(graph_name, batch_size, after_id=0, rows_loaded=0, unpaired=None):
+    """
+    Bulk-load order events into graph_name, committing each batch together
+    with its checkpoint. Returns (last_location_id, rows_loaded).
+    """
+    total = count_pending_rows(after_id)
+    started = time.monotonic()
+    done = 0
+    print(f"Loading {total} order locations into '{graph_name}' (after location #{after_id})...")
+
+    with graph_connection() as conn:
+        conn.autocommit = False
+        cursor = conn.cursor()
+        for last_id, events in iter_order_events(batch_size, after_id, unpaired=unpaired):
+            write_order_events(cursor, merge_order_events(events), graph_name)
+            done += len(events)
+            rows_loaded += len(events)
+            cursor.execute(SAVE_CHECKPOINT_SQL, (graph_name, last_id, rows_loaded))
+            conn.commit()
+            after_id = last_id
+
+            elapsed = time.monotonic() - started
+            rate = done / elapsed if elapsed else 0.0
+            percent = done * 100.0 / total if total else 100.0
+            eta = (total - done) / rate if rate else 0.0
+            print(f"  {done}/{total} ({percent:5.1f}%)  {rate:8.0f} rows/s  ETA {eta:6.0f}s  "
+                  f"checkpoint=#{last_id}")
+        cursor.close()
+
+    return after_id, rows_loaded
+
+
+def recreate_graph(graph_name):
+    """Drop graph_name if it exists and create it empty"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM ag_catalog.ag_graph WHERE name = %s", (graph_name,))
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT drop_graph(%s, true)", (graph_name,))
+        cursor.execute("SELECT create_graph(%s)", (graph_name,))
+        cursor.close()
+
+
+def swap_graphs(shadow_name, live_name, batch_size=1000, after_id=None, rows_loaded=0, unpaired=None):
+    """
+    Replace live_name with shadow_name in a single transaction.
+    Writers block on the transaction's locks and continue against the new
+    graph once it commits. With after_id, order locations recorded since
+    that checkpoint are first loaded into the shadow graph while new
+    locations are blocked, so no order placed during the rebuild is lost.
+    Returns (last_location_id, rows_loaded).
+    """
+    retired_name = f"{live_name}_retired"
+    conn = get_db_connection()
+    try:
+        init_age_session(conn)
+        conn.autocommit = False
+        cursor = conn.cursor()
+        if after_id is not None:
+            # SHARE waits for in-flight checkouts and blocks new ones until the swap commits
+            cursor.execute("LOCK TABLE user_locations IN SHARE MODE")
+            for last_id, events in iter_order_events(batch_size, after_id, unpaired=unpaired):
+                write_order_events(cursor, merge_order_events(events), shadow_name)
+                rows_loaded += len(events)
+                after_id = last_id
+            cursor.execute(SAVE_CHECKPOINT_SQL, (shadow_name, after_id, rows_loaded))
+        cursor.execute("SELECT COUNT(*) FROM ag_catalog.ag_graph WHERE name = %s", (live_name,))
+        live_exists = cursor.fetchone()[0] > 0
+        if live_exists:
+            cursor.execute("SELECT alter_graph(%s, 'RENAME', %s)", (live_name, retired_name))
+        cursor.execute("SELECT alter_graph(%s, 'RENAME', %s)", (shadow_name, live_name))
+        if live_exists:
+            cursor.execute("SELECT drop_graph(%s, true)", (retired_name,))
+        cursor.execute("UPDATE graph_rebuild_checkpoints SET graph_name = %s WHERE graph_name = %s",
+                       (live_name, shadow_name))
+        conn.commit()
+        cursor.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return after_id, rows_loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the Apache AGE graph from relational history')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per UNWIND batch')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint')
+    parser.add_argument('--shadow', action='store_true',
+                        help='build into a shadow graph and swap it in when complete')
+    args = parser.parse_args()
+    if args.shadow and Config.GRAPH_SHARDING:
+        parser.error("--shadow cannot swap region shards: with GRAPH_SHARDING, rebuild them in place")
+
+    target = f"{GRAPH_NAME}_shadow" if args.shadow else GRAPH_NAME
+
+    print("=" * 70)
+    print(f"Rebuilding graph '{GRAPH_NAME}'" + (f" via shadow graph '{target}'" if args.shadow else ""))
+    print("=" * 70)
+
+    if args.resume:
+        after_id, rows_loaded = load_checkpoint(target)
+        print(f"Resuming after location #{after_id} ({rows_loaded} rows already loaded)")
+    else:
+        reset_checkpoint(target)
+        after_id, rows_loaded = 0, 0
+        if args.shadow:
+            recreate_graph(target)
+
+    if Config.GRAPH_SHARDING:
+        # Events for restaurant_graph go to their region's shard
+        graphs = order_shard_graphs(after_id)
+        for graph_name in graphs:
+            ensure_shard_graph(graph_name)
+    elif init_age_graph(target):
+        graphs = [target]
+    else:
+        return
+    
+    # Label indexes keep MERGE lookups fast while loading and carry over on swap
+    from create_indexes import create_graph_indexes
+    for graph_name in graphs:
+        create_graph_indexes(graph_name)
+
+    started = time.monotonic()
+    unpaired = []
+    after_id, rows_loaded = load_graph(target, args.batch_size, after_id, rows_loaded, unpaired)
+
+    if args.shadow:
+        # Catch up with orders placed while the shadow graph was loading
+        after_id, rows_loaded = load_graph(target, args.batch_size, after_id, rows_loaded, unpaired)
+    # Flag supernodes before the graph is queried
+    for graph_name in (read_graphs() if Config.GRAPH_SHARDING else [target]):
+        refresh_degrees(graph_name)
+
+    if args.shadow:
+        print(f"Swapping '{target}' in as '{GRAPH_NAME}' (new checkouts wait for the final catch-up)...")
+        after_id, rows_loaded = swap_graphs(target, GRAPH_NAME, args.batch_size, after_id, rows_loaded, unpaired)
+        # Other processes notice the new graph instance on their next write
+        known_elements.invalidate()
+        graph_results.bump_all()
+
+    print()
+    if unpaired:
+        print(f"Warning: {len(unpaired)} order locations have no order within {ORDER_PAIR_WINDOW}s and were "
+              f"skipped (location #{', #'.join(map(str, unpaired[:10]))}{', ...' if len(unpaired) > 10 else ''})")
+    orphans = count_unpaired_orders()
+    if orphans:
+        print(f"Warning: {orphans} orders have no order location within {ORDER_PAIR_WINDOW}s and are not in the graph")
+    print(f"✓ Loaded {rows_loaded} order locations in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Consistency reconciler between the relational tables and restaurant_graph
+Users are split into id ranges that worker threads check in parallel: each
+chunk's (user, IP, order) tuples from user_locations/orders are compared
+with its USED_IP edges, and the (IP, city) tuples of the IPs involved with
+their FROM_CITY edges. Drift is written to a JSON report and, with
+--repair, fixed in batches.
+
+The graph is read before the relational tables, so every edge read
+belongs to an order the relational read can see. Orders and edges newer
+than SETTLE_SECONDS before the scan started may still be on their way to
+the graph and are left alone, and repairs only delete edges that have not
+been written to since then, so it is safe to run against a live system.
+
+With GRAPH_SHARDING, every region shard is checked against the orders
+whose detected country maps to its region; the relational rows of a chunk
+are read once and split between the shards. The report then has one
+entry per shard.
+
+Usage:
+    python reconcile_graph.py                       # report only
+    python reconcile_graph.py --workers 8 --repair
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from config import Config
+from graph_pool import graph_connection
+from graph_statements import CypherStatement
+from graph_shards import record_shard_users, region_for_country, shard_region
+from graph_utils import GRAPH_NAME, merge_order_events, read_graphs, write_order_events
+from rebuild_graph import iter_order_events
+
+USED_IP_SQL = """
+    SELECT ru.username,
+           ip.properties::text::jsonb->>'address',
+           r.id::text::bigint,
+           r.properties::text::jsonb
+    FROM users ru
+    JOIN {graph}."User" u
+      ON ag_catalog.agtype_access_operator(VARIADIC ARRAY[u.properties, '"username"'::ag_catalog.agtype])
+         = to_jsonb(ru.username)::text::ag_catalog.agtype
+    JOIN {graph}."USED_IP" r ON r.start_id = u.id
+    JOIN {graph}."IPAddress" ip ON ip.id = r.end_id
+    WHERE ru.id BETWEEN %s AND %s
+"""
+
+FROM_CITY_SQL = """
+    SELECT ip.properties::text::jsonb->>'address',
+           c.properties::text::jsonb->>'name',
+           f.id::text::bigint
+    FROM {graph}."IPAddress" ip
+    JOIN {graph}."FROM_CITY" f ON f.start_id = ip.id
+    JOIN {graph}."City" c ON c.id = f.end_id
+    WHERE ag_catalog.agtype_access_operator(VARIADIC ARRAY[ip.properties, '"address"'::ag_catalog.agtype])
+          = ANY(%s::text[]::ag_catalog.agtype[])
+"""
+
+IP_CITIES_SQL = """
+    SELECT ip_address, COALESCE(city, 'Unknown'), country, MIN(EXTRACT(EPOCH FROM timestamp))::bigint
+    FROM user_locations
+    WHERE action = 'order' AND ip_address = ANY(%s)
+    GROUP BY 1, 2, 3
+"""
+
+# Repairs skip edges written to since the scan, e.g. an aggregated edge
+# that took a new order
+DELETE_SETTLED_USED_IP_SQL = """
+    DELETE FROM {graph}."USED_IP"
+    WHERE id = ANY(%s::text[]::graphid[])
+      AND coalesce((properties::text::jsonb->>'last_seen')::bigint,
+                   (properties::text::jsonb->>'ts')::bigint, 0) < %s
+    RETURNING id::text::bigint
+"""
+
+SETTLE_SECONDS = 300  # Orders and edges this recent at scan start may still be in flight
+
+ADD_FROM_CITY = CypherStatement('add_from_city', """
+    UNWIND $pairs AS p
+    MERGE (ip:IPAddress {address: p.ip})
+    MERGE (c:City {name: p.city})
+    MERGE (ip)-[:FROM_CITY]->(c)
+    RETURN count(*)
+""", 'count agtype')
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def graph_region(graph_name):
+    """Region whose orders a shard graph holds, or None for an unsharded graph"""
+    if graph_name.startswith(Config.GRAPH_SHARD_PREFIX):
+        return shard_region(graph_name)
+    return None
+
+
+def user_id_chunks(chunk_size):
+    """(min_id, max_id) ranges covering every user"""
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(id), MAX(id) FROM users")
+        low, high = cursor.fetchone()
+        cursor.close()
+    if low is None:
+        return []
+    return [(start, min(start + chunk_size - 1, high)) for start in range(low, high + 1, chunk_size)]
+
+
+class ChunkResult:
+    """Drift found in one user id range, and the repairs it needs"""
+
+    def __init__(self, graph_name, min_id, max_id):
+        self.graph_name = graph_name
+        self.min_id = min_id
+        self.max_id = max_id
+        self.pairs_checked = 0
+        self.missing_orders = []   # (username, ip, order_id)
+        self.extra_orders = []     # (username, ip, order_id or None)
+        self.count_mismatches = []  # (username, ip, graph_count, expected_count)
+        self.missing_cities = []   # (ip, city)
+        self.extra_cities = []     # (ip, city)
+        self.write_events = []
+        self.rewrites = []         # (edge ids, events): pairs rewritten as one aggregated edge
+        self.delete_used_ip = []
+        self.delete_from_city = []
+        self.seconds = 0.0
+
+    def drift(self):
+        return (len(self.missing_orders) + len(self.extra_orders) + len(self.count_mismatches)
+                + len(self.missing_cities) + len(self.extra_cities))
+
+
+def edge_time(props):
+    """When a USED_IP edge was last written to (epoch seconds), 0 if unknown"""
+    return props.get('last_seen') or props.get('ts') or 0
+
+
+def read_used_ip(graph_name, min_id, max_id):
+    """(username, ip) -> [(edge_id, properties)] for one user id range of a graph"""
+    actual = {}
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(USED_IP_SQL.format(graph=graph_name), (min_id, max_id))
+        for username, ip, edge_id, props in cursor.fetchall():
+            actual.setdefault((username, ip), []).append((edge_id, props))
+        cursor.close()
+    return actual
+
+
+def check_chunk(graph_names, min_id, max_id, cutoff, settled, batch_size):
+    """Compare one user id range with each graph; returns a ChunkResult per graph"""
+    regions = {graph_name: graph_region(graph_name) for graph_name in graph_names}
+    # Graph first: the orders of the edges read are committed before the relational read
+    actual = {graph_name: read_used_ip(graph_name, min_id, max_id) for graph_name in graph_names}
+    expected = {graph_name: {} for graph_name in graph_names}  # (username, ip) -> {order_id: event}
+    for _, events in iter_order_events(batch_size, 0, min_id, max_id):
+        for event in events:
+            region = region_for_country(event.get('country'))
+            for graph_name in graph_names:
+                if regions[graph_name] in (None, region):
+                    pair = (event['username'], event['ip_address'])
+                    expected[graph_name].setdefault(pair, {})[event['order_ids'][0]] = event
+    return [_check_graph(graph_name, regions[graph_name], expected[graph_name], actual[graph_name],
+                         min_id, max_id, cutoff, settled)
+            for graph_name in graph_names]
+
+
+def _check_graph(graph_name, region, expected, actual, min_id, max_id, cutoff, settled):
+    """Compare the expected orders of one user id range with the edges read from one graph"""
+    started = time.monotonic()
+    result = ChunkResult(graph_name, min_id, max_id)
+
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        live_ips = set()
+        for pair in expected.keys() | actual.keys():
+            result.pairs_checked += 1
+            if _check_pair(result, pair, expected.get(pair, {}), actual.get(pair, []), cutoff, settled):
+                live_ips.add(pair[1])
+
+        ips = sorted({ip for _, ip in expected} | {ip for _, ip in actual})
+        if ips:
+            # FROM_CITY first, for the same reason as USED_IP
+            cursor.execute(FROM_CITY_SQL.format(graph=graph_name), ([json.dumps(ip) for ip in ips],))
+            actual_cities = {(ip, city): edge_id for ip, city, edge_id in cursor.fetchall()}
+            cursor.execute(IP_CITIES_SQL, (ips,))
+            first_seen = {(ip, city): seen for ip, city, country, seen in cursor.fetchall()
+                          if region in (None, region_for_country(country))}
+            expected_cities = set(first_seen)
+
+            for ip, city in sorted(expected_cities - actual_cities.keys()):
+                if ip in live_ips and first_seen[(ip, city)] < settled:
+                    result.missing_cities.append((ip, city))
+            for (ip, city), edge_id in sorted(actual_cities.items()):
+                if (ip, city) not in expected_cities:
+                    result.extra_cities.append((ip, city))
+                    result.delete_from_city.append(edge_id)
+        cursor.close()
+
+    result.seconds = time.monotonic() - started
+    return result
+
+
+def _check_pair(result, pair, orders, edges, cutoff, settled):
+    """
+    Record the drift of one (user, IP) pair, leaving orders and edges from
+    settled (epoch seconds) on alone. Returns True when the pair has (or
+    will have after repair) an edge.
+    """
+    username, ip = pair
+    if not orders:
+        for edge_id, props in edges:
+            if edge_time(props) < settled:
+                result.extra_orders.append((username, ip, props.get('order_id')))
+                result.delete_used_ip.append(edge_id)
+        return False
+
+    aggregated = [props for _, props in edges if 'order_count' in props]
+    if aggregated or (not edges and Config.GRAPH_AGGREGATE_USED_IP):
+        if (any(event['last_seen'] >= settled for event in orders.values())
+                or any(edge_time(props) >= settled for _, props in edges)):
+            return True  # Still being written: compared on a later run
+        graph_count = sum(props['order_count'] for props in aggregated)
+        recent = any(event['last_seen'] >= cutoff for event in orders.values())
+        if len(edges) == 1 and graph_count == len(orders):
+            return True
+        if not edges and not recent:
+            return False  # Pruned by retention
+        # Rewrite the pair as a single edge holding every order
+        result.count_mismatches.append((username, ip, graph_count, len(orders)))
+        result.rewrites.append(([edge_id for edge_id, _ in edges], merge_order_events(list(orders.values()))))
+        return True
+
+    in_graph = {}
+    for edge_id, props in edges:
+        order_id = props.get('order_id')
+        if order_id in orders and order_id not in in_graph:
+            in_graph[order_id] = edge_id
+        elif edge_time(props) < settled:
+            result.extra_orders.append((username, ip, order_id))
+            result.delete_used_ip.append(edge_id)
+
+    missing = [event for order_id, event in sorted(orders.items())
+               if order_id not in in_graph and cutoff <= event['last_seen'] < settled]
+    result.missing_orders += [(username, ip, event['order_ids'][0]) for event in missing]
+    result.write_events += missing
+    return bool(in_graph or missing)
+
+
+def repair(graph_name, results, batch_size, settled):
+    """
+    Apply the repairs collected by check_chunk, batch by batch. A pair is
+    only rewritten once all its old edges are deleted, and edges written
+    to since settled are kept.
+    """
+    rewrites = [rewrite for r in results for rewrite in r.rewrites]
+    delete_used_ip = ([edge_id for r in results for edge_id in r.delete_used_ip]
+                      + [edge_id for edge_ids, _ in rewrites for edge_id in edge_ids])
+    delete_from_city = sorted({edge_id for r in results for edge_id in r.delete_from_city})
+    missing_cities = sorted({pair for r in results for pair in r.missing_cities})
+
+    with graph_connection() as conn:
+        cursor = conn.cursor()
+        deleted = set()
+        for batch in batches(delete_used_ip, batch_size):
+            cursor.execute(DELETE_SETTLED_USED_IP_SQL.format(graph=graph_name),
+                           ([str(edge_id) for edge_id in batch], settled))
+            deleted.update(row[0] for row in cursor.fetchall())
+        for batch in batches(delete_from_city, batch_size):
+            cursor.execute(
+                f'DELETE FROM {graph_name}."FROM_CITY" WHERE id = ANY(%s::text[]::graphid[])',
+                ([str(edge_id) for edge_id in batch],)
+            )
+        rewritten = [events for edge_ids, events in rewrites if deleted.issuperset(edge_ids)]
+        write_events = merge_order_events([event for r in results for event in r.write_events]
+                                          + [event for events in rewritten for event in events])
+        for batch in batches(write_events, batch_size):
+            write_order_events(cursor, batch, graph_name)
+            if graph_region(graph_name) is not None:
+                record_shard_users(cursor, {graph_name: batch})
+        for batch in batches(missing_cities, batch_size):
+            ADD_FROM_CITY.execute(cursor, {'pairs': [{'ip': ip, 'city': city} for ip, city in batch]},
+                                  graph_name)
+        cursor.close()
+
+    return {
+        'used_ip_deleted': len(deleted),
+        'used_ip_kept': len(delete_used_ip) - len(deleted),
+        'rewrites_skipped': len(rewrites) - len(rewritten),
+        'from_city_deleted': len(delete_from_city),
+        'events_written': len(write_events),
+        'from_city_added': len(missing_cities),
+    }
+
+
+def build_report(graph_name, results, cutoff, seconds, repaired=None):
+    """JSON-serializable drift report"""
+    def rows(attr, keys):
+        return [dict(zip(keys, row)) for r in results for row in getattr(r, attr)]
+
+    report = {
+        'graph': graph_name,
+        'generated_at': datetime.utcnow().isoformat(),
+        'aggregated_used_ip': Config.GRAPH_AGGREGATE_USED_IP,
+        'missing_since': datetime.utcfromtimestamp(cutoff).isoformat(),
+        'seconds': round(seconds, 1),
+        'chunks': len(results),
+        'pairs_checked': sum(r.pairs_checked for r in results),
+        'missing_orders': rows('missing_orders', ('username', 'ip', 'order_id')),
+        'extra_orders': rows('extra_orders', ('username', 'ip', 'order_id')),
+        'count_mismatches': rows('count_mismatches', ('username', 'ip', 'graph_count', 'expected_count')),
+        'missing_from_city': sorted({(ip, city) for r in results for ip, city in r.missing_cities}),
+        'extra_from_city': sorted({(ip, city) for r in results for ip, city in r.extra_cities}),
+    }
+    report['summary'] = {key: len(report[key]) for key in (
+        'missing_orders', 'extra_orders', 'count_mismatches', 'missing_from_city', 'extra_from_city')}
+    if repaired is not None:
+        report['repaired'] = repaired
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare restaurant_graph with the relational tables')
+    parser.add_argument('--graph', default=GRAPH_NAME)
+    parser.add_argument('--chunk-size', type=int, default=2000, help='users per chunk')
+    parser.add_argument('--workers', type=int, default=4, help='parallel chunk checkers')
+    parser.add_argument('--batch-size', type=int, default=500, help='rows per fetch and per repair statement')
+    parser.add_argument('--days', type=int, default=Config.GRAPH_RETENTION_DAYS,
+                        help='only report orders from this window as missing (older ones may be pruned)')
+    parser.add_argument('--repair', action='store_true', help='fix the drift that was found')
+    parser.add_argument('--report', default='graph_drift_report.json', help='where to write the report')
+    args = parser.parse_args()
+
+    cutoff = int(time.time()) - args.days * 86400
+    settled = int(time.time()) - SETTLE_SECONDS
+    chunks = user_id_chunks(args.chunk_size)
+    # With GRAPH_SHARDING, the default checks every region shard
+    graphs = read_graphs() if args.graph == GRAPH_NAME else [args.graph]
+
+    print("=" * 70)
+    print(f"Reconciling '{', '.join(graphs)}': {len(chunks)} chunks of {args.chunk_size} users, "
+          f"{args.workers} workers")
+    print("=" * 70)
+
+    started = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(check_chunk, graphs, low, high, cutoff, settled, args.batch_size)
+                   for low, high in chunks]
+        for done, future in enumerate(as_completed(futures), 1):
+            chunk_results = future.result()
+            results += chunk_results
+            first = chunk_results[0]
+            print(f"  users {first.min_id}-{first.max_id}: {sum(r.pairs_checked for r in chunk_results)} pairs, "
+                  f"{sum(r.drift() for r in chunk_results)} drifted "
+                  f"({sum(r.seconds for r in chunk_results):.1f}s)  [{done}/{len(chunks)}]")
+    results.sort(key=lambda r: r.min_id)
+
+    reports = []
+    for graph_name in graphs:
+        graph_results = [r for r in results if r.graph_name == graph_name]
+        repaired = repair(graph_name, graph_results, args.batch_size, settled) if args.repair else None
+        reports.append(build_report(graph_name, graph_results, cutoff, time.monotonic() - started, repaired))
+    with open(args.report, 'w') as f:
+        json.dump(reports[0] if len(reports) == 1 else {'graphs': reports}, f, indent=2)
+
+    for report in reports:
+        print()
+        if len(reports) > 1:
+            print(f"  {report['graph']}")
+        for key, count in report['summary'].items():
+            print(f"  {key:<20} {count:>8}")
+        if report.get('repaired'):
+            print(f"  repaired: {report['repaired']}")
+    print(f"✓ Checked {sum(report['pairs_checked'] for report in reports)} user-IP pairs "
+          f"in {time.monotonic() - started:.1f}s, report written to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
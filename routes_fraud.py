@@ -0,0 +1,266 @@
+import base64
+import json
+from datetime import datetime, timezone
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from utils import admin_required
+from config import Config
+from models import db, FraudAlert, SharedIpGroup
+from fraud_alerts import FRAUD_ALERT_STATUSES, FRAUD_ALERT_TYPES, shared_ip_groups
+from graph_utils import (FRAUD_PATTERNS, SHARED_IP_RANKINGS, SUPERNODE_POLICIES, cross_region_users,
+                         fraud_pattern_key, is_stale, iter_fraud_patterns, top_shared_ips)
+
+fraud_bp = Blueprint('fraud', __name__, url_prefix='/api/fraud')
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_SHARED_IP_SAMPLE = 100
+
+
+def encode_cursor(key):
+    """Opaque pagination cursor for the key of the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(key, list):
+        raise ValueError('invalid cursor')
+    return key
+
+
+def parse_time(value):
+    """ISO 8601 timestamp (UTC if no offset) or epoch seconds -> epoch seconds"""
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp())
+
+
+@fraud_bp.route('/patterns', methods=['GET'])
+@admin_required
+def get_patterns():
+    """
+    Shared IPs or city mismatches found in the graph (Admin only)
+    Query params: type, limit, cursor, since, until, stream, supernodes
+    """
+    pattern = request.args.get('type', 'shared_ips')
+    if pattern not in FRAUD_PATTERNS:
+        return jsonify({'error': f"type must be one of: {', '.join(FRAUD_PATTERNS)}"}), 400
+    supernodes = request.args.get('supernodes')
+    if supernodes is not None and supernodes not in SUPERNODE_POLICIES:
+        return jsonify({'error': f"supernodes must be one of: {', '.join(SUPERNODE_POLICIES)}"}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid limit, cursor, since or until'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+
+    # Every match as newline-delimited JSON, without paging
+    if request.args.get('stream', 'false').lower() == 'true':
+        rows = iter_fraud_patterns(pattern, after, since, until, supernodes=supernodes)
+        return Response(
+            stream_with_context(json.dumps(row) + '\n' for row in rows),
+            mimetype='application/x-ndjson'
+        )
+
+    # One extra row tells whether another page follows
+    rows = list(iter_fraud_patterns(pattern, after, since, until, limit=limit + 1, supernodes=supernodes))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return jsonify({
+        'type': pattern,
+        'results': rows,
+        'count': len(rows),
+        'next_cursor': encode_cursor(fraud_pattern_key(pattern, rows[-1])) if has_more else None
+    }), 200
+
+
+@fraud_bp.route('/shared-ips', methods=['GET'])
+@admin_required
+def get_shared_ips():
+    """
+    Top IPs shared by several users, one row per IP (Admin only)
+    Query params: rank (users|recent), limit, sample, min_users, since, until, supernodes
+    """
+    rank = request.args.get('rank', 'users')
+    if rank not in SHARED_IP_RANKINGS:
+        return jsonify({'error': f"rank must be one of: {', '.join(SHARED_IP_RANKINGS)}"}), 400
+    supernodes = request.args.get('supernodes')
+    if supernodes is not None and supernodes not in SUPERNODE_POLICIES:
+        return jsonify({'error': f"supernodes must be one of: {', '.join(SUPERNODE_POLICIES)}"}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        sample = min(int(request.args.get('sample', 5)), MAX_SHARED_IP_SAMPLE)
+        min_users = int(request.args.get('min_users', 2))
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid limit, sample, min_users, since or until'}), 400
+    if limit < 1 or sample < 0 or min_users < 2:
+        return jsonify({'error': 'limit must be at least 1, sample at least 0 and min_users at least 2'}), 400
+
+    rows = top_shared_ips(limit, rank, sample, min_users, since, supernodes, until)
+    return jsonify({
+        'rank': rank,
+        'results': rows,
+        'count': len(rows),
+        'stale': is_stale(rows)
+    }), 200
+
+
+@fraud_bp.route('/cross-region', methods=['GET'])
+@admin_required
+def get_cross_region_users():
+    """
+    Users seen in several region shards, from the shard index (Admin only)
+    Query params: limit, min_regions, since
+    """
+    if not Config.GRAPH_SHARDING:
+        return jsonify({'error': 'Graph sharding is disabled (GRAPH_SHARDING)'}), 404
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        min_regions = int(request.args.get('min_regions', 2))
+        since = parse_time(request.args.get('since'))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid limit, min_regions or since'}), 400
+    if limit < 1 or min_regions < 2:
+        return jsonify({'error': 'limit must be at least 1 and min_regions at least 2'}), 400
+
+    rows = cross_region_users(limit, min_regions, since)
+    return jsonify({
+        'results': rows,
+        'count': len(rows)
+    }), 200
+
+
+def parse_status_filter():
+    """status query param: one of FRAUD_ALERT_STATUSES, or 'all'; 'open' by default"""
+    status = request.args.get('status', 'open')
+    if status != 'all' and status not in FRAUD_ALERT_STATUSES:
+        raise ValueError(f"status must be 'all' or one of: {', '.join(FRAUD_ALERT_STATUSES)}")
+    return None if status == 'all' else status
+
+
+@fraud_bp.route('/alerts', methods=['GET'])
+@admin_required
+def get_alerts():
+    """
+    Persisted fraud alerts, most recently seen first (Admin only)
+    Query params: status, type, username, ip, limit, cursor
+    """
+    try:
+        status = parse_status_filter()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    alert_type = request.args.get('type')
+    if alert_type is not None and alert_type not in FRAUD_ALERT_TYPES:
+        return jsonify({'error': f"type must be one of: {', '.join(FRAUD_ALERT_TYPES)}"}), 400
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        if after:
+            after = (datetime.fromisoformat(after[0]), int(after[1]))
+    except (ValueError, TypeError, IndexError):
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+
+    query = FraudAlert.query
+    if status:
+        query = query.filter(FraudAlert.status == status)
+    if alert_type:
+        query = query.filter(FraudAlert.alert_type == alert_type)
+    if request.args.get('username'):
+        query = query.filter(FraudAlert.username == request.args['username'])
+    if request.args.get('ip'):
+        query = query.filter(FraudAlert.ip_address == request.args['ip'])
+    if after:
+        query = query.filter(db.tuple_(FraudAlert.last_seen, FraudAlert.id) < after)
+    alerts = query.order_by(FraudAlert.last_seen.desc(), FraudAlert.id.desc()).limit(limit + 1).all()
+    has_more = len(alerts) > limit
+    alerts = alerts[:limit]
+
+    return jsonify({
+        'results': [alert.to_dict() for alert in alerts],
+        'count': len(alerts),
+        'next_cursor': encode_cursor([alerts[-1].last_seen.isoformat(), alerts[-1].id]) if has_more else None
+    }), 200
+
+
+@fraud_bp.route('/alerts/<int:alert_id>/status', methods=['PUT'])
+@admin_required
+def update_alert_status(alert_id):
+    """Update a fraud alert's status (Admin only)"""
+    alert = FraudAlert.query.get(alert_id)
+    if not alert:
+        return jsonify({'error': 'Alert not found'}), 404
+
+    data = request.get_json() or {}
+    if data.get('status') not in FRAUD_ALERT_STATUSES:
+        return jsonify({'error': f"status must be one of: {', '.join(FRAUD_ALERT_STATUSES)}"}), 400
+
+    alert.status = data['status']
+    db.session.commit()
+
+    return jsonify({
+        'message': 'Alert status updated successfully',
+        'alert': alert.to_dict()
+    }), 200
+
+
+@fraud_bp.route('/shared-ip-groups', methods=['GET'])
+@admin_required
+def get_shared_ip_groups():
+    """
+    Persisted shared-IP groups, most users first (Admin only)
+    Query params: status, min_users, limit
+    """
+    try:
+        status = parse_status_filter()
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        min_users = int(request.args.get('min_users', 2))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    if limit < 1 or min_users < 2:
+        return jsonify({'error': 'limit must be at least 1 and min_users at least 2'}), 400
+
+    groups = shared_ip_groups(limit, min_users, status)
+    return jsonify({
+        'results': [group.to_dict() for group in groups],
+        'count': len(groups)
+    }), 200
+
+
+@fraud_bp.route('/shared-ip-groups/<ip>/status', methods=['PUT'])
+@admin_required
+def update_shared_ip_group_status(ip):
+    """Update a shared-IP group's status (Admin only)"""
+    group = SharedIpGroup.query.get(ip)
+    if not group:
+        return jsonify({'error': 'Shared IP group not found'}), 404
+
+    data = request.get_json() or {}
+    if data.get('status') not in FRAUD_ALERT_STATUSES:
+        return jsonify({'error': f"status must be one of: {', '.join(FRAUD_ALERT_STATUSES)}"}), 400
+
+    group.status = data['status']
+    db.session.commit()
+
+    return jsonify({
+        'message': 'Shared IP group status updated successfully',
+        'group': group.to_dict()
+    }), 200
@@ -0,0 +1,100 @@
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from utils import admin_required
+from graph_pool import get_graph_pool, read_budget_stats
+from graph_alerts import write_check_stats
+from graph_csr import get_csr_graph
+from graph_ingest import get_ingest_worker
+from graph_outbox import outbox_lag
+from graph_utils import GRAPH_NAME, graph_results, known_elements, list_supernodes
+from graph_statements import statement_stats
+from graph_paths import find_path
+from config import Config
+from export_graph import EXPORT_FORMATS, exportable_graphs, iter_export
+
+graph_bp = Blueprint('graph', __name__, url_prefix='/api/graph')
+
+
+@graph_bp.route('/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Graph pipeline metrics (Admin only)"""
+    return jsonify({
+        'ingest': get_ingest_worker().stats(),
+        'outbox': outbox_lag(),
+        'write_cache': known_elements.stats(),
+        'result_cache': graph_results.stats(),
+        'statements': statement_stats.snapshot(),
+        'read_budgets': read_budget_stats.snapshot(),
+        'csr': get_csr_graph().stats(),
+        'write_checks': write_check_stats.snapshot(),
+        'pool': get_graph_pool().status()
+    }), 200
+
+
+@graph_bp.route('/supernodes', methods=['GET'])
+@admin_required
+def get_supernodes():
+    """IPAddress and City vertices treated as supernodes, with a sample of neighbors (Admin only)"""
+    try:
+        sample = min(int(request.args.get('sample', 20)), 100)
+    except ValueError:
+        return jsonify({'error': 'sample must be an integer'}), 400
+    if sample < 0:
+        return jsonify({'error': 'sample must be at least 0'}), 400
+    
+    supernodes = list_supernodes(sample)
+    return jsonify({
+        'supernodes': supernodes,
+        'count': len(supernodes)
+    }), 200
+
+
+@graph_bp.route('/path', methods=['GET'])
+@admin_required
+def get_path():
+    """
+    Shortest link between two users through shared IPs, emails and cities (Admin only)
+    Query params: from, to, max_depth
+    """
+    from_user = request.args.get('from')
+    to_user = request.args.get('to')
+    if not from_user or not to_user:
+        return jsonify({'error': 'from and to are required'}), 400
+    try:
+        max_depth = int(request.args.get('max_depth', Config.GRAPH_PATH_MAX_DEPTH))
+    except ValueError:
+        return jsonify({'error': 'max_depth must be an integer'}), 400
+    if not 1 <= max_depth <= Config.GRAPH_PATH_MAX_DEPTH:
+        return jsonify({'error': f'max_depth must be between 1 and {Config.GRAPH_PATH_MAX_DEPTH}'}), 400
+    
+    result = find_path(from_user, to_user, max_depth)
+    if result['status'] == 'unknown_user':
+        return jsonify({'error': 'User not found in graph', **result}), 404
+    return jsonify(result), 200
+
+
+@graph_bp.route('/export', methods=['GET'])
+@admin_required
+def export():
+    """
+    Stream the whole graph as ndjson, graphml or npz (Admin only)
+    Query params: format, graph (required with GRAPH_SHARDING: one region shard)
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(sorted(EXPORT_FORMATS))}"}), 400
+    graph_name = request.args.get('graph', GRAPH_NAME)
+    graphs = exportable_graphs()
+    if graph_name not in graphs:
+        if Config.GRAPH_SHARDING and graph_name == GRAPH_NAME:
+            error = 'The graph is sharded by region: export one shard at a time with ?graph='
+        else:
+            error = f'Unknown graph: {graph_name}'
+        return jsonify({'error': error, 'graphs': graphs}), 400
+    
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    return Response(
+        stream_with_context(iter_export(fmt, graph_name)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={graph_name}.{extension}'}
+    )
@@ -2,6 +2,8 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import get_jwt_identity
 from models import db, Order, OrderItem, MenuItem, User, UserLocation
 from utils import login_required, admin_required, get_ip_address, get_location_from_ip
+from graph_utils import order_event
+from graph_sync import stage_order_event, publish_order_event
 
 orders_bp = Blueprint('orders', __name__, url_prefix='/api/orders')
 
@@ -90,8 +92,15 @@ def create_order():
         )
         db.session.add(order_item)
     
+    # Sync the order to the graph database (see GRAPH_SYNC_MODE)
+    graph_event = order_event(user, ip_address, location_data['city'], order.id, order.created_at,
+                              location_data['country'])
+    stage_order_event(graph_event)
+    
     db.session.commit()
     
+    publish_order_event(graph_event)
+    
     return jsonify({
         'message': 'Order created successfully',
         'order': order.to_dict(),
@@ -2,7 +2,10 @@ from flask import Blueprint, render_template, request, redirect, url_for, sessio
 from models import db, User, MenuItem, Order, OrderItem, UserLocation
 from utils import get_ip_address, get_location_from_ip
 from collections import defaultdict
-from graph_utils import add_order_to_graph, detect_fraud_patterns
+from graph_utils import order_event, detect_fraud_patterns, list_supernodes
+from fraud_alerts import count_shared_ip_groups, recent_alerts, shared_ip_groups
+from config import Config
+from graph_sync import stage_order_event, publish_order_event
 from sqlalchemy.exc import OperationalError, DBAPIError
 import time
 
@@ -286,18 +289,14 @@ def checkout():
         )
         db.session.add(order_item)
     
+    # Sync the order to the graph database (see GRAPH_SYNC_MODE)
+    graph_event = order_event(user, ip_address, location_data['city'], order.id, order.created_at,
+                              location_data['country'])
+    stage_order_event(graph_event)
+    
     db.session.commit()
     
-    # Add order to graph database
-    try:
-        add_order_to_graph(
-            user=user,
-            ip_address=ip_address,
-            city_detected=location_data['city'],
-            order_id=order.id
-        )
-    except Exception as e:
-        print(f"Warning: Could not add order to graph: {e}")
+    publish_order_event(graph_event)
     
     # Clear cart
     session['cart'] = []
@@ -659,34 +658,26 @@ def admin_graph():
     }
     
     # Calculate statistics
-    ip_usage = {}
-    for loc in locations:
-        if loc.ip_address not in ip_usage:
-            ip_usage[loc.ip_address] = set()
-        ip_usage[loc.ip_address].add(loc.user_id)
-    
-    suspicious_ips = {ip: users for ip, users in ip_usage.items() if len(users) > 1}
-    
     stats = {
         'total_users': len(users),
         'total_ips': len(set(loc.ip_address for loc in locations)),
         'total_cities': len(set(loc.city for loc in locations if loc.city)),
         'total_regions': len(set(loc.region for loc in locations if loc.region)),
         'total_countries': len(set(loc.country for loc in locations if loc.country)),
-        'suspicious_ips': len(suspicious_ips)
+        'suspicious_ips': count_shared_ip_groups()
     }
     
-    # Fraud alerts
-    fraud_alerts = []
-    for ip, user_ids in suspicious_ips.items():
-        user_names = [User.query.get(uid).username for uid in user_ids]
-        fraud_alerts.append({
-            'ip': ip,
-            'user_count': len(user_ids),
-            'users': user_names
-        })
+    # Fraud alerts: open shared-IP groups and city mismatches, kept up to date as locations are recorded
+    fraud_alerts = [group.to_dict() for group in shared_ip_groups(Config.FRAUD_TOP_SHARED_IPS)]
+    mismatch_alerts = [alert.to_dict() for alert in recent_alerts(Config.FRAUD_RECENT_ALERTS, 'city_mismatch')]
+    
+    # High-degree vertices left out of the fraud traversals
+    supernodes = list_supernodes()
     
     return render_template('admin_graph.html', 
                          graph_data=graph_data, 
                          stats=stats,
-                         fraud_alerts=fraud_alerts)
+                         fraud_alerts=fraud_alerts,
+                         mismatch_alerts=mismatch_alerts,
+                         supernodes=supernodes,
+                         supernode_policy=Config.GRAPH_SUPERNODE_POLICY)